@@ -14,9 +14,13 @@ import scrapy
 from twisted.web.client import ResponseFailed
 from scrapy.utils.python import to_unicode
 
+from tse.common.city_catalog import CityCatalog
 from tse.common.index import Index
 from tse.common.pathinfo import PathInfo
-from tse.parsers import CityConfigParser
+from tse.common.shards import ShardLocation, ShardStore
+from tse.common.storage import StorageCodec
+from tse.middlewares import KEPT_ENCODING_META
+from tse.signals import index_opened
 from tse.utils import log_progress
 
 
@@ -28,7 +32,9 @@ class BaseSpider(scrapy.Spider):
         self.shutdown = False
         self._sigHandler = None
 
-        self._city_state_map = None
+        self._city_catalog = None
+        self.storage = StorageCodec()
+        self.shards: ShardStore = None
 
     def _handle_sigint(self, signum, frame):
         self.shutdown = True
@@ -60,17 +66,16 @@ class BaseSpider(scrapy.Spider):
         return PathInfo.get_full_url(self.settings, path)
 
     def archive_version(self, path):
-        dirname, filename = os.path.split(path)
-        index_version = self.index.get_current_version(filename)
-        if index_version == 0 or not os.path.exists(path):
+        index_version = self.index.get_current_version(os.path.basename(path))
+        stored_path = self.storage.find(path)
+        if index_version == 0 or not stored_path:
             return 0
         
-        ver_dir = os.path.join(dirname, ".ver")
-        root, ext = os.path.splitext(filename)
-        ver_path = os.path.join(ver_dir, f"{root}_{index_version:04}{ext}")
+        # Keeps the stored form (ex: .zst)
+        ver_path = PathInfo.get_version_path(path, index_version) + stored_path[len(path):]
 
-        os.makedirs(ver_dir, exist_ok=True)
-        os.rename(path, ver_path)
+        os.makedirs(os.path.dirname(ver_path), exist_ok=True)
+        os.rename(stored_path, ver_path)
 
         return index_version
         
@@ -113,57 +118,68 @@ class BaseSpider(scrapy.Spider):
         index_entry: Index.Entry
         body: bytes
         is_new_file: bool
+        storage: StorageCodec = None
+        encoding: str = None        # Of the body, when kept encoded as received
 
+        # Decoded on every access, read it once
         @property
         def contents(self) -> bytes:
+            storage = self.storage or StorageCodec()
             if self.body: 
-                return self.body
+                return storage.decode_body(self.encoding, self.body, self.local_path)
 
-            with open(self.local_path, "rb") as f:
-                return f.read()
+            return storage.read(self.local_path)
 
         @property
         def filename(self) -> str:
             return os.path.basename(self.local_path)
 
-    def write_result_file(self, path, body, date):
+    def write_result_file(self, path, body, date, encoding=None):
         os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, "wb") as f:
-            f.write(body)
+        stored_path = self.storage.write(path, body, encoding)
 
         dt_epoch = date.replace(tzinfo=datetime.timezone.utc).timestamp()
-        os.utime(path, (dt_epoch, dt_epoch))
+        os.utime(stored_path, (dt_epoch, dt_epoch))
 
     def get_path_from_url(self, url):
         return urllib.parse.urlparse(url).path.strip("/")
 
+    # Last modified and etag to index, falling back to the server date (or now) and the body md5
+    def get_index_validators(self, response):
+        last_modified, etag, server_date = self.get_http_cache_headers(response)
+
+        last_modified = (last_modified or 
+                        server_date or 
+                        datetime.datetime.utcnow().replace(tzinfo=None, microsecond=0))
+
+        # Of the body as received (still gzipped when kept), toggling KEEP_GZIP_RESPONSES changes it once for files without ETag
+        etag = etag or hashlib.md5(response.body).hexdigest()
+
+        return (last_modified, etag)
+
     def persist_response(self, response) -> PersistedResult:
         local_path = os.path.join(self.settings["FILES_STORE"], self.get_path_from_url(response.url))
         filename = os.path.basename(local_path)
 
-        last_modified, etag, server_date = self.get_http_cache_headers(response)
         index_entry = self.index.get(filename)
+        encoding = response.meta.get(KEPT_ENCODING_META)
 
         if response.status == 304:
             if index_entry:
-                return self.PersistedResult(local_path, index_entry, None, False)
+                return self.PersistedResult(local_path, index_entry, None, False, self.storage)
             else:
                 raise ResponseFailed(response)
 
-        last_modified = (last_modified or 
-                        server_date or 
-                        datetime.datetime.utcnow().replace(tzinfo=None, microsecond=0))
-
-        etag = etag or hashlib.md5(response.body).hexdigest()
+        last_modified, etag = self.get_index_validators(response)
 
         # Same indexed contents (etag or body md5)
         if index_entry and (index_entry.etag == etag):
-            if not os.path.exists(local_path):
-                self.write_result_file(local_path, response.body, last_modified)
+            if not self.storage.find(local_path):
+                self.write_result_file(local_path, response.body, last_modified, encoding)
             if index_entry.last_modified != last_modified:    
                 self.index[filename] = index_entry._replace(last_modified=last_modified)
 
-            return self.PersistedResult(local_path, index_entry, response.body, False)
+            return self.PersistedResult(local_path, index_entry, response.body, False, self.storage, encoding)
 
         # We have a new file
         index_entry = Index.Entry(last_modified, etag)
@@ -174,9 +190,9 @@ class BaseSpider(scrapy.Spider):
         else:
             self.index[filename] = index_entry
 
-        self.write_result_file(local_path, response.body, last_modified)
+        self.write_result_file(local_path, response.body, last_modified, encoding)
 
-        return self.PersistedResult(local_path, index_entry, response.body, True)
+        return self.PersistedResult(local_path, index_entry, response.body, True, self.storage, encoding)
 
     @property
     def plea(self):
@@ -213,41 +229,45 @@ class BaseSpider(scrapy.Spider):
         logging.info("Elections: %s", self.elections)
         logging.info("States: %s", self.states)
 
-        db_dir = os.path.join(self.settings["FILES_STORE"], self.settings["ENVIRONMENT"])
-        os.makedirs(db_dir, exist_ok=True)
-        self.index = Index(os.path.join(db_dir, f"index_{self.name}_{self.plea}.db"))
+        self.open_storage()
+
+        index_path = PathInfo.get_index_path(self.settings, self.name)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        self.index = Index(index_path, 
+            mmap_size=self.settings.getint("INDEX_MMAP_SIZE"), 
+            checkpoint_interval=self.settings.getfloat("INDEX_CHECKPOINT_INTERVAL"))
         logging.info("Index size %d", len(self.index))
 
+        if hasattr(self, "crawler"):
+            self.crawler.signals.send_catch_log(signal=index_opened, index=self.index, spider=self)
+
         if self.settings["VALIDATE_INDEX"]:
             self.validate_index()
 
+    # Where the files are stored, opened before the index as validating it reads them
+    def open_storage(self):
+        self.storage = StorageCodec.from_settings(self.settings)
+        if self.storage.codec:
+            logging.info("Storage codec: %s", self.storage.codec)
+
     def closed(self, reason):
         if hasattr(self, "index"):
             self.index.close()
 
+        if self.shards:
+            self.shards.close()
+
     def find_local_path_elections(self):
         for entry in os.scandir(self.get_local_path("")):
             if entry.is_dir and not entry.name.startswith(".") and entry.name.isdigit():
                 yield entry.name
 
     def get_state(self, city):
-        if self._city_state_map:
-            return self._city_state_map[city]
-
-        config_paths = ["data/mun-default-cm.json", PathInfo.get_cities_config_path(self.elections[0])]
+        if not self._city_catalog:
+            config_paths = ("data/mun-default-cm.json", PathInfo.get_cities_config_path(self.elections[0]))
+            self._city_catalog = CityCatalog.load(config_paths)
 
-        self._city_state_map = {}
-
-        for config_path in config_paths:
-            try:
-                with open(config_path, "rb") as f:
-                    data = orjson.loads(f.read())
-                    map = {ccity: cstate for cstate, ccity, _, _, _, _ in CityConfigParser.expand_cities(data)}
-                    self._city_state_map.update(map)
-            except FileNotFoundError:
-                continue
-        
-        return self._city_state_map[city]
+        return self._city_catalog.get_state(city)
 
     def get_valid_index_entry(self, filename):
         entry = self.index.get(filename)
@@ -263,6 +283,10 @@ class BaseSpider(scrapy.Spider):
 
     def validate_index_entry(self, filename, entry: Index.Entry):
         info = PathInfo(filename)
+
+        location = ShardLocation.from_metadata(entry.metadata)
+        if location:
+            return self.validate_shard_entry(info, entry, location)
         
         if not info.path:
             if info.match == "voting_machine":
@@ -281,12 +305,12 @@ class BaseSpider(scrapy.Spider):
                 logging.debug("Index: Missing path %s", info.filename)
                 return False
 
-        local_path = self.get_local_path(info.path)
-        if not os.path.exists(local_path):
+        stored_path = self.storage.find(self.get_local_path(info.path))
+        if not stored_path:
             logging.debug("Index: Local path not found %s", info.filename)
             return False
 
-        modified_time = datetime.datetime.utcfromtimestamp(os.path.getmtime(local_path)).replace(microsecond=0)
+        modified_time = datetime.datetime.utcfromtimestamp(os.path.getmtime(stored_path)).replace(microsecond=0)
         
         # Some tolerance, as some processes may change precision (ex: unzipping has two seconds precision)
         delta = modified_time - entry.last_modified
@@ -304,6 +328,22 @@ class BaseSpider(scrapy.Spider):
 
         return True
 
+    def validate_shard_entry(self, info: PathInfo, entry: Index.Entry, location: ShardLocation):
+        member = self.shards.get_member(location, info.filename) if self.shards else None
+        if not member:
+            logging.debug("Index: Shard member not found %s", info.filename)
+            return False
+
+        if abs(member.mtime - Index.to_epoch(entry.last_modified)) > 2:
+            logging.debug("Index: Modified date mismatch %s %s > %s", info.filename, Index.from_epoch(member.mtime), entry.last_modified)
+            return False
+
+        if info.plea and info.plea != self.plea:
+            logging.debug("Index: Plea mismatch %s %s > %s", info.filename, info.plea, self.plea)
+            return False
+
+        return True
+
     def validate_index(self):
         logging.info("Validating index...")
 
@@ -0,0 +1,248 @@
+from typing import Iterable, NamedTuple, Optional
+
+import pyarrow as pa
+
+# Minimal DER reader for the voting machine bulletins (.bu/.busa), just enough of the published BU ASN.1 spec
+# to get the vote totals, walking the TLVs in place instead of materializing the whole structure.
+#
+# A bulletin is an EntidadeEnvelopeGenerico whose conteudo holds the DER of an EntidadeBoletimUrna,
+# every SEQUENCE field is context tagged [0], [1], ... (implicit, CHOICEs are explicit):
+#
+# EntidadeEnvelopeGenerico:     conteudo [4] OCTET STRING
+# EntidadeBoletimUrna:          resultadosVotacaoPorEleicao [8] SEQUENCE OF ResultadoVotacaoPorEleicao
+# ResultadoVotacaoPorEleicao:   idEleicao [0], qtdEleitoresAptos [1], resultadosVotacao [2] SEQUENCE OF ResultadoVotacao
+# ResultadoVotacao:             tipoVoto [0], qtdComparecimento [1], totaisVotosCargo [2] SEQUENCE OF TotalVotosCargo
+# TotalVotosCargo:              codigoCargo [0] CHOICE { cargoConstitucional [0], numeroCargoConsultaLivre [1] },
+#                               ordemImpressao [1], votosVotaveis [2] SEQUENCE OF TotalVotosVotavel
+# TotalVotosVotavel:            tipoVoto [0], quantidadeVotos [1], identificacaoVotavel [2] { partido [0], codigo [1] } OPTIONAL
+#
+# data/bulletin_sample.bu is a bulletin encoded by this layout, decoded as data/bulletin_sample.json, checked along the
+# totals of real bulletins by python -m tse.utils.decode_bulletins --check
+class BulletinDecoder:
+    class Vote(NamedTuple):
+        election: int
+        eligible_voters: int
+        turnout: int
+        office: int             # CargoConstitucional, or the number of a free consultation question
+        office_name: Optional[str]
+        vote_type: str
+        party: Optional[int]
+        candidate: Optional[int]
+        votes: int
+
+    CONTEXT = 0x80
+    CONSTRUCTED = 0x20
+    SEQUENCE = 0x30
+
+    ENVELOPE_CONTENT = 4
+    BULLETIN_RESULTS = 8
+
+    OFFICES = {
+        1: "presidente",
+        2: "vicePresidente",
+        3: "governador",
+        4: "viceGovernador",
+        5: "senador",
+        6: "deputadoFederal",
+        7: "deputadoEstadual",
+        8: "deputadoDistrital",
+        9: "primeiroSuplenteSenador",
+        10: "segundoSuplenteSenador",
+        11: "prefeito",
+        12: "vicePrefeito",
+        13: "vereador",
+    }
+
+    VOTE_TYPES = {
+        1: "nominal",
+        2: "branco",
+        3: "nulo",
+        4: "legenda",
+        5: "cargoSemCandidato",
+    }
+
+    # Reads the TLV at pos, returns (identifier octet, tag number, value start, value end)
+    @staticmethod
+    def read_tlv(data: memoryview, pos: int, end: int) -> tuple[int, int, int, int]:
+        if pos + 2 > end:
+            raise ValueError(f"Truncated TLV at {pos}")
+
+        identifier = data[pos]
+        number = identifier & 0x1F
+        pos += 1
+
+        if number == 0x1F:
+            number = 0
+            while True:
+                octet = data[pos]
+                pos += 1
+                number = (number << 7) | (octet & 0x7F)
+                if not octet & 0x80:
+                    break
+
+        length = data[pos]
+        pos += 1
+
+        if length & 0x80:
+            octets = length & 0x7F
+            if octets == 0 or octets > 4:
+                raise ValueError(f"Unsupported length form at {pos - 1}")
+            length = int.from_bytes(data[pos:pos + octets], "big")
+            pos += octets
+
+        if pos + length > end:
+            raise ValueError(f"TLV at {pos} overruns its parent")
+
+        return identifier, number, pos, pos + length
+
+    @classmethod
+    def children(cls, data: memoryview, start: int, end: int) -> Iterable[tuple[int, int, int, int]]:
+        pos = start
+        while pos < end:
+            tlv = cls.read_tlv(data, pos, end)
+            yield tlv
+            pos = tlv[3]
+
+    # Context tagged fields of a SEQUENCE, by tag number
+    @classmethod
+    def fields(cls, data: memoryview, start: int, end: int) -> dict[int, tuple[int, int, int]]:
+        return {number: (identifier, s, e) for identifier, number, s, e in cls.children(data, start, end)
+                    if identifier & 0xC0 == cls.CONTEXT}
+
+    # Field of a decoded SEQUENCE, failing on a missing one (ex: a layout change)
+    @staticmethod
+    def require(fields: dict[int, tuple[int, int, int]], number: int, name: str) -> tuple[int, int, int]:
+        field = fields.get(number)
+        if field is None:
+            raise ValueError(f"Missing {name} [{number}], found {sorted(fields)}")
+
+        return field
+
+    # Start and end of the value of the SEQUENCE at the start of data
+    @classmethod
+    def read_sequence(cls, data: memoryview, name: str) -> tuple[int, int]:
+        identifier, _, start, end = cls.read_tlv(data, 0, len(data))
+        if identifier != cls.SEQUENCE:
+            raise ValueError(f"Expected a {name} SEQUENCE, found identifier 0x{identifier:02x}")
+
+        return start, end
+
+    @staticmethod
+    def to_int(data: memoryview, field: tuple[int, int, int]) -> int:
+        return int.from_bytes(data[field[1]:field[2]], "big", signed=True)
+
+    # Elements of a SEQUENCE OF field
+    @classmethod
+    def items(cls, data: memoryview, field: tuple[int, int, int]) -> Iterable[tuple[int, int]]:
+        for _, _, s, e in cls.children(data, field[1], field[2]):
+            yield s, e
+
+    @classmethod
+    def get_content(cls, envelope: bytes) -> memoryview:
+        data = memoryview(envelope)
+        start, end = cls.read_sequence(data, "EntidadeEnvelopeGenerico")
+        content = cls.require(cls.fields(data, start, end), cls.ENVELOPE_CONTENT, "EntidadeEnvelopeGenerico.conteudo")
+        return data[content[1]:content[2]]
+
+    @classmethod
+    def decode(cls, envelope: bytes) -> Iterable[Vote]:
+        require = cls.require
+        data = cls.get_content(envelope)
+        start, end = cls.read_sequence(data, "EntidadeBoletimUrna")
+        results = require(cls.fields(data, start, end), cls.BULLETIN_RESULTS, "EntidadeBoletimUrna.resultadosVotacaoPorEleicao")
+
+        for s, e in cls.items(data, results):
+            election = cls.fields(data, s, e)
+            election_id = cls.to_int(data, require(election, 0, "ResultadoVotacaoPorEleicao.idEleicao"))
+            eligible_voters = cls.to_int(data, require(election, 1, "ResultadoVotacaoPorEleicao.qtdEleitoresAptos"))
+
+            for s, e in cls.items(data, require(election, 2, "ResultadoVotacaoPorEleicao.resultadosVotacao")):
+                result = cls.fields(data, s, e)
+                turnout = cls.to_int(data, require(result, 1, "ResultadoVotacao.qtdComparecimento"))
+
+                for s, e in cls.items(data, require(result, 2, "ResultadoVotacao.totaisVotosCargo")):
+                    office_totals = cls.fields(data, s, e)
+
+                    # Explicitly tagged CHOICE, the alternative is the only child
+                    office_code = require(office_totals, 0, "TotalVotosCargo.codigoCargo")
+                    office_choice = cls.fields(data, office_code[1], office_code[2])
+                    if 0 in office_choice:
+                        office = cls.to_int(data, office_choice[0])
+                        office_name = cls.OFFICES.get(office)
+                    else:
+                        office = cls.to_int(data, require(office_choice, 1, "CodigoCargoConsulta.numeroCargoConsultaLivre"))
+                        office_name = None
+
+                    for s, e in cls.items(data, require(office_totals, 2, "TotalVotosCargo.votosVotaveis")):
+                        votes = cls.fields(data, s, e)
+                        vote_type = cls.to_int(data, require(votes, 0, "TotalVotosVotavel.tipoVoto"))
+
+                        party = candidate = None
+                        identification = votes.get(2)
+                        if identification is not None:
+                            identification = cls.fields(data, identification[1], identification[2])
+                            party = cls.to_int(data, require(identification, 0, "IdentificacaoVotavel.partido"))
+                            candidate = cls.to_int(data, require(identification, 1, "IdentificacaoVotavel.codigo"))
+
+                        yield cls.Vote(election_id, eligible_voters, turnout, office, office_name, cls.VOTE_TYPES.get(vote_type, str(vote_type)),
+                            party, candidate, cls.to_int(data, require(votes, 1, "TotalVotosVotavel.quantidadeVotos")))
+
+    # Inconsistencies of decoded votes, every voter who showed up votes once per seat of an office (blank and null included),
+    # so the office totals are multiples of the turnout, fields read from the wrong tags rarely keep that
+    @staticmethod
+    def check_totals(votes: Iterable[Vote]) -> list[str]:
+        problems = []
+        totals = {}
+        for vote in votes:
+            if vote.turnout > vote.eligible_voters:
+                problems.append(f"Election {vote.election} turnout {vote.turnout} over {vote.eligible_voters} eligible voters")
+
+            key = (vote.election, vote.turnout, vote.office)
+            totals[key] = totals.get(key, 0) + vote.votes
+
+        for (election, turnout, office), total in totals.items():
+            if (total % turnout != 0) if turnout > 0 else (total != 0):
+                problems.append(f"Election {election} office {office} total {total} isn't a multiple of the turnout {turnout}")
+
+        return problems
+
+# Decoded bulletins of many sections, one row per candidate (or blank/null total) per office
+class BulletinVotesTable:
+    _dict_string = pa.dictionary(pa.int32(), pa.string())
+
+    schema = pa.schema([
+        ("state", _dict_string),
+        ("city", _dict_string),
+        ("zone", pa.string()),
+        ("section", pa.string()),
+        ("election", pa.uint32()),
+        ("eligible_voters", pa.uint32()),
+        ("turnout", pa.uint32()),
+        ("office", pa.uint16()),
+        ("office_name", _dict_string),
+        ("vote_type", _dict_string),
+        ("party", pa.uint16()),
+        ("candidate", pa.uint32()),
+        ("votes", pa.uint32()),
+    ])
+
+    def __init__(self):
+        self._rows = {f.name: [] for f in self.schema}
+
+    def __len__(self):
+        return len(self._rows["votes"])
+
+    def add_section(self, keyfields: dict, votes: Iterable[BulletinDecoder.Vote]):
+        for vote in votes:
+            self._rows["state"].append(keyfields["state"])
+            self._rows["city"].append(keyfields["city"])
+            self._rows["zone"].append(keyfields["zone"])
+            self._rows["section"].append(keyfields["section"])
+            for key, value in zip(BulletinDecoder.Vote._fields, vote):
+                self._rows[key].append(value)
+
+    # Returns the rows added so far and starts over
+    def to_table(self) -> pa.Table:
+        table = pa.Table.from_pydict(self._rows, schema=self.schema)
+        self._rows = {f.name: [] for f in self.schema}
+        return table
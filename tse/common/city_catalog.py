@@ -0,0 +1,114 @@
+import functools
+import hashlib
+import logging
+import marshal
+import os
+import tempfile
+from typing import Iterable, NamedTuple, Optional
+
+import orjson
+
+from tse.parsers import CityConfigParser
+
+# Read-only lookup of the cities from the cities config files (mun-*-cm.json), keys are as in CityConfigParser:
+# lowercase state and city code without leading zeros
+class CityCatalog:
+    class City(NamedTuple):
+        state: str
+        city: str
+        ibge: str
+        name: str
+        capital: bool
+
+    def __init__(self, cities: Iterable[City]):
+        self._cities = {}
+        self._city_states = {}
+
+        # Later entries replace earlier ones
+        for city in cities:
+            self._cities[(city.state, city.city)] = city
+            self._city_states[city.city] = city.state
+
+    def __len__(self):
+        return len(self._cities)
+
+    def __getitem__(self, key: tuple[str, str]) -> City:
+        return self._cities[key]
+
+    def __contains__(self, key: tuple[str, str]):
+        return key in self._cities
+
+    def get(self, state: str, city: str, default: City = None) -> Optional[City]:
+        return self._cities.get((state, city), default)
+
+    # TSE city codes are unique across states
+    def get_state(self, city: str) -> str:
+        return self._city_states[city]
+
+    @staticmethod
+    def _read_config(path: str) -> list[tuple]:
+        with open(path, "rb") as f:
+            data = orjson.loads(f.read())
+
+        return [(state, city, ibge, name, capital) for state, city, ibge, name, capital, _ in CityConfigParser.expand_cities(data)]
+
+    # Modification time of each config file, None when missing
+    @staticmethod
+    def _get_sources(paths: tuple[str, ...]) -> tuple:
+        sources = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                sources.append((path, stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                sources.append((path, None, None))
+
+        return tuple(sources)
+
+    @staticmethod
+    def get_cache_path(cache_dir: str, paths: tuple[str, ...]) -> str:
+        return os.path.join(cache_dir, f"city_catalog-{hashlib.md5(repr(paths).encode()).hexdigest()[:16]}.marshal")
+
+    # Cities of the cache file if built from the same versions of the config files
+    @staticmethod
+    def _read_cache(cache_path: str, sources: tuple) -> Optional[list[tuple]]:
+        try:
+            with open(cache_path, "rb") as f:
+                cached_sources, cities = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+        return cities if cached_sources == sources else None
+
+    @staticmethod
+    def _write_cache(cache_path: str, sources: tuple, cities: list[tuple]):
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(cache_path))
+            with open(fd, "wb") as f:
+                marshal.dump((sources, cities), f)
+            os.replace(tmp_path, cache_path)
+        except OSError as ex:
+            logging.debug("Failed writing the city catalog cache %s: %s", cache_path, repr(ex))
+
+    # Built once per process for a given set of config files, missing files are skipped
+    # Also cached on disk (cache_dir, None to skip it), rebuilt when a config file changes
+    @classmethod
+    @functools.lru_cache(maxsize=8)
+    def load(cls, paths: tuple[str, ...] = ("data/mun-default-cm.json",), cache_dir: Optional[str] = "data/cache") -> "CityCatalog":
+        sources = cls._get_sources(paths)
+        cache_path = cls.get_cache_path(cache_dir, paths) if cache_dir else None
+
+        cities = cls._read_cache(cache_path, sources) if cache_path else None
+        if cities is None:
+            cities = []
+            for path, mtime, _ in sources:
+                try:
+                    cities.extend(cls._read_config(path))
+                except FileNotFoundError:
+                    continue
+
+            if cache_path:
+                cls._write_cache(cache_path, sources, cities)
+
+        return cls(cls.City(*c) for c in cities)
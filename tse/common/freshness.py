@@ -0,0 +1,108 @@
+import datetime
+import math
+import time
+from collections import deque
+from typing import NamedTuple, Optional
+
+from tse.common.index import Index
+
+# Publication to disk latency of the divulga files, from the index date (the dh of the state index, when TSE published
+# the file) to when it was scheduled, sent and persisted, per file type and state, over the latest samples of each
+#
+# Segments:
+# discover: published -> scheduled, how long until a state index listing it was parsed (reindex interval, index lag)
+# queue:    scheduled -> sent, waiting in the scheduler (priorities, deferred dupe retries), sent is when the request is
+#           handed to the downloader (SentTimeMiddleware)
+# download: sent -> persisted, the downloader slot (concurrency, delays), the request and body transfer, and persisting it
+# total:    published -> persisted
+class FreshnessTracker:
+    SEGMENTS = ("discover", "queue", "download", "total")
+    PERCENTILES = (50, 90, 99)
+
+    class Summary(NamedTuple):
+        count: int
+        percentiles: tuple[float, ...]      # As PERCENTILES
+
+    # utc_offset: hours of the index dates (Brasília time, -3 since there's no more daylight saving)
+    # window: latest samples kept per segment, type and state
+    def __init__(self, utc_offset: float = -3.0, window: int = 1000):
+        self.utc_offset = utc_offset
+        self.window = window
+        self._scheduled: dict[str, float] = {}                          # Epoch, by filename
+        self._samples: dict[tuple[str, str, str], deque] = {}           # By segment, type and state
+
+    def get_published_time(self, index_date: datetime.datetime) -> float:
+        return Index.to_epoch(index_date) - self.utc_offset * 3600
+
+    # Also when a pending file is bumped to a newer date, it's that version which is queued from then on
+    def schedule(self, filename, now: Optional[float] = None):
+        self._scheduled[filename] = now or time.time()
+
+    def discard(self, filename):
+        self._scheduled.pop(filename, None)
+
+    def persisted(self, file_type, state, filename, index_date: datetime.datetime, sent: float, now: Optional[float] = None):
+        scheduled = self._scheduled.pop(filename, None)
+        if scheduled is None or index_date is None:
+            return
+
+        persisted = now or time.time()
+        published = self.get_published_time(index_date)
+        durations = (scheduled - published, sent - scheduled, persisted - sent, persisted - published)
+
+        for segment, duration in zip(self.SEGMENTS, durations):
+            key = (segment, file_type or "-", state or "-")
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(duration)
+
+    # Nearest rank
+    @classmethod
+    def get_percentiles(cls, values: list[float]) -> tuple[float, ...]:
+        values = sorted(values)
+        return tuple(values[max(math.ceil(p / 100 * len(values)) - 1, 0)] for p in cls.PERCENTILES)
+
+    # Samples of a segment grouped by "type" or "state"
+    def summarize(self, segment, by="type") -> dict[str, Summary]:
+        groups = {}
+        for (s, file_type, state), samples in self._samples.items():
+            if s == segment:
+                groups.setdefault(file_type if by == "type" else state, []).extend(samples)
+
+        return {k: self.Summary(len(v), self.get_percentiles(v)) for k, v in groups.items()}
+
+    def summarize_all(self, segment) -> Optional[Summary]:
+        values = [d for (s, _, _), samples in self._samples.items() if s == segment for d in samples]
+        return self.Summary(len(values), self.get_percentiles(values)) if values else None
+
+    # divulga/freshness/<segment>/<type>/p<N> and divulga/freshness/total/state/<state>/p<N>, in seconds
+    def update_stats(self, stats, prefix="divulga/freshness"):
+        for segment in self.SEGMENTS:
+            for file_type, summary in self.summarize(segment, "type").items():
+                for p, value in zip(self.PERCENTILES, summary.percentiles):
+                    stats.set_value(f"{prefix}/{segment}/{file_type}/p{p}", round(value, 3))
+
+        for state, summary in self.summarize("total", "state").items():
+            for p, value in zip(self.PERCENTILES, summary.percentiles):
+                stats.set_value(f"{prefix}/total/state/{state}/p{p}", round(value, 3))
+
+    @classmethod
+    def format_summary(cls, summary: Summary) -> str:
+        return "/".join(f"{v:.1f}" for v in summary.percentiles)
+
+    # Single log line, each segment p50/p90/p99 of every sample, and the slowest states by the total p90
+    def format_line(self, slowest: int = 5) -> Optional[str]:
+        parts = []
+        for segment in self.SEGMENTS:
+            summary = self.summarize_all(segment)
+            if summary:
+                parts.append(f"{segment}: {self.format_summary(summary)}")
+
+        if not parts:
+            return None
+
+        states = sorted(self.summarize("total", "state").items(), key=lambda t: t[1].percentiles[1], reverse=True)
+        parts.append("slowest states (total p90): " + ", ".join(f"{s} {summary.percentiles[1]:.1f}" for s, summary in states[:slowest]))
+
+        return f"p{'/p'.join(str(p) for p in self.PERCENTILES)} seconds, " + ", ".join(parts)
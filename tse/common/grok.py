@@ -7,7 +7,9 @@ except ImportError as e:
 
 import datetime
 import functools
-from typing import Callable, Dict, Iterable, Any, Tuple, Union
+import os
+import tempfile
+from typing import Callable, Dict, Iterable, Any, Optional, Tuple, Union
 
 from .lru import LRU
 
@@ -19,11 +21,22 @@ class GrokProcessor:
         regex: re.Pattern
         type_map: dict[str, str]
         can_cache_format: bool
+        id: int
+        source: str
+        schema: tuple[tuple[str, str], ...]
+        schema_keys: tuple[str, ...]
 
-        def __init__(self, regex: re.Pattern, type_map: dict[str, str], can_cache_format):
+        def __init__(self, regex: re.Pattern, type_map: dict[str, str], can_cache_format, id: int = 0, source: str = None):
             self.regex = regex
             self.type_map = type_map
             self.can_cache_format = can_cache_format
+            self.id = id
+            self.source = source
+
+            # Named params in pattern order with their type, "str" when not annotated
+            keys = [k for k, _ in sorted(regex.groupindex.items(), key=lambda i: i[1]) if k != "__del__"]
+            self.schema = tuple((k, type_map.get(k, "str")) for k in keys)
+            self.schema_keys = tuple(keys)
 
     # https://github.com/garyelephant/pygrok/blob/master/pygrok/patterns/grok-patterns
     _base_predefined: dict[str, str] = {
@@ -81,31 +94,92 @@ class GrokProcessor:
         self._matchCache = LRU(1024)
         self._string_lru_cache.cache_clear()
 
+    def _next_id(self) -> int:
+        return max((m.id for m in self._matchers), default=0) + 1
+
     def add_matchers(self, matchers: Iterable[str], flags: re.RegexFlag = 0) -> GrokProcessor:
-        self._matchers.extend((self._build_matcher(p, flags) for p in matchers))
+        for p in matchers:
+            self._matchers.append(self._build_matcher(p, flags=flags, id=self._next_id(), source=p))
+
         self._invalidate_caches()
         return self
 
-    def load_matchers_from_file(self, file: str, flags: re.RegexFlag = 0) -> GrokProcessor:
-        with open(file, 'r', encoding='utf-8') as file:
-            for line in (l.strip() for l in file):
-                if line == '':
-                    continue
+    # Template ids registry, one "<id>\t<matcher line>" per line
+    @staticmethod
+    def read_ids_file(file: str) -> dict[str, int]:
+        try:
+            with open(file, 'r', encoding='utf-8') as f:
+                return {source: int(id) for id, source in (l.rstrip("\n").split("\t", 1) for l in f if l.strip() != '')}
+        except FileNotFoundError:
+            return {}
+
+    # Unique temp file in the same dir, so concurrent writers never share it
+    @staticmethod
+    def write_ids_file(file: str, ids: dict[str, int]):
+        fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(file) + ".", suffix=".tmp", dir=os.path.dirname(file) or ".")
+        try:
+            with open(fd, 'w', encoding='utf-8') as f:
+                for source, id in sorted(ids.items(), key=lambda i: i[1]):
+                    f.write(f"{id}\t{source}\n")
+
+            os.replace(tmp_file, file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+
+    @staticmethod
+    def read_matcher_lines(file: str) -> Iterable[str]:
+        with open(file, 'r', encoding='utf-8') as f:
+            yield from (l for l in (l.strip() for l in f) if l != '')
+
+    # Ids are kept stable across edits of the matchers file, new lines get new ids and removed ones are never reused
+    # Returns the new lines, see tse.utils.update_matcher_ids
+    @classmethod
+    def update_ids_file(cls, file: str, ids_file: str) -> list[str]:
+        ids = cls.read_ids_file(ids_file)
+        next_id = max(ids.values(), default=0) + 1
+
+        added = []
+        for source in cls.read_matcher_lines(file):
+            if source not in ids:
+                ids[source] = next_id
+                next_id += 1
+                added.append(source)
+
+        if added:
+            cls.write_ids_file(ids_file, ids)
+
+        return added
+
+    # With an ids file every line must already have its id there (read only, see update_ids_file)
+    def load_matchers_from_file(self, file: str, flags: re.RegexFlag = 0, *, ids_file: str = None) -> GrokProcessor:
+        ids = self.read_ids_file(ids_file) if ids_file else None
+        next_id = self._next_id()
+
+        for line in self.read_matcher_lines(file):
+            source = line
+            if ids is None:
+                id = next_id
+                next_id += 1
+            else:
+                id = ids.get(source)
+                if id is None:
+                    raise ValueError(f"Matcher without id in {ids_file}, run python -m tse.utils.update_matcher_ids: {source}")
 
-                can_cache_format = True
+            can_cache_format = True
 
-                if line.startswith(r"\\"):
-                    line = line[1:]
-                    can_cache_format = False
-                else:
-                    line = re.sub(r"%\\{([:\w]+)\\}", r"%{\1}", re.escape(line, literal_spaces=True))
+            if line.startswith(r"\\"):
+                line = line[1:]
+                can_cache_format = False
+            else:
+                line = re.sub(r"%\\{([:\w]+)\\}", r"%{\1}", re.escape(line, literal_spaces=True))
 
-                self._matchers.append(self._build_matcher(line, can_cache_format, flags))
+            self._matchers.append(self._build_matcher(line, can_cache_format, flags, id, source))
 
         self._invalidate_caches()
         return self
 
-    def _build_matcher(self, pattern: str, can_cache_format = False, flags: re.RegexFlag = 0) -> Matcher:
+    def _build_matcher(self, pattern: str, can_cache_format = False, flags: re.RegexFlag = 0, id: int = 0, source: str = None) -> Matcher:
         iterations = 100
 
         type_map = {}
@@ -132,80 +206,42 @@ class GrokProcessor:
                 can_cache_format = False
             
             if re.search('%{\w+(:\w+)?(:\w+)?}', pattern) is None:
-                return GrokProcessor.Matcher(re.compile(pattern, flags), type_map, can_cache_format)
+                return GrokProcessor.Matcher(re.compile(pattern, flags), type_map, can_cache_format, id, source)
+
+    # Type of each named param across all matchers, "str" when untyped or conflicting
+    def get_param_types(self) -> dict[str, str]:
+        types = {}
+        for matcher in self._matchers:
+            for key, type in matcher.schema:
+                types[key] = type if types.get(key, type) == type else "str"
+
+        return types
+
+    # Template id -> ((param, type), ...) as returned by match_template
+    def get_template_schemas(self) -> dict[int, tuple[tuple[str, str], ...]]:
+        return {m.id: m.schema for m in sorted(self._matchers, key=lambda m: m.id)}
+
+    # Template id -> matcher source line
+    def get_templates(self) -> dict[int, str]:
+        return {m.id: m.source for m in sorted(self._matchers, key=lambda m: m.id)}
 
     # Reuse common strings for field names
     def __string_lru_cache(self, string: str) -> str:
         return string
 
-    def match(self, text: str, *, fullmatch=True, pos_msg_params=False) -> Tuple[str, Union[dict, list]]:
+    def _find_match(self, text: str, fullmatch: bool) -> Tuple[Optional[Matcher], Optional[re.Match]]:
         if text in self._noMatchCache:
-            return (text, None)
+            return (None, None)
 
         def try_matcher(matcher: GrokProcessor.Matcher):
-            match = matcher.regex.fullmatch(text, concurrent=True) if fullmatch else matcher.regex.match(text, concurrent=True)
-            if not match:
-                return (False, (text, None))
-
-            matcherkey = (matcher, pos_msg_params)
-            params = match.groupdict()
-            format = None
-
-            def process_param(key, value):
-                if not value:
-                    return
-                try:
-                    type = matcher.type_map[key]
-                    converter = self._type_converters[type]
-                    params[key] = converter(value)
-                except KeyError:
-                    if len(value) < 32:
-                        params[key] = self._string_lru_cache(value)
-
-            if matcher.can_cache_format and matcherkey in self._matcher_format_cache:
-                format = self._matcher_format_cache[matcherkey]
-                for key, value in list(params.items()):
-                    if key == "__del__":
-                        del params[key]
-                        continue
-
-                    process_param(key, value)
-            else:
-                split = []
-                lbound = 0
-                for key, value, l, r in [(key, value, *match.span(key)) for key, value in params.items()]:                        
-                    if key == "__del__":
-                        del params[key]
-                        if l > 0:
-                            split.append(text[lbound:l])
-                            lbound = r
-                        continue
-
-                    process_param(key, value)
-
-                    if l > 0:
-                        split.append(text[lbound:l])
-                        lbound = r
-
-                        if pos_msg_params:
-                            split.append("%s")
-                        else:
-                            split.append(f"%({key})s")
-
-                split.append(text[lbound:])
-                format = "".join(split)
-
-                if matcher.can_cache_format:
-                    self._matcher_format_cache[matcherkey] = format
-
-            return (True, (format, params if not pos_msg_params else list(params.values())))
+            return matcher.regex.fullmatch(text, concurrent=True) if fullmatch else matcher.regex.match(text, concurrent=True)
 
         cachedMatcher = None
         try:
             cachedMatcher = self._matchCache[text]
-            res, ret = try_matcher(cachedMatcher)
-            if res:
-                return ret
+            match = try_matcher(cachedMatcher)
+            if match:
+                return (cachedMatcher, match)
         except KeyError:
             pass
 
@@ -214,14 +250,96 @@ class GrokProcessor:
             if matcher == cachedMatcher:
                 continue
 
-            res, ret = try_matcher(self._matchers[i])
-            if res:
+            match = try_matcher(matcher)
+            if match:
                 # Optimization: Bubble up the matched one so most common goes first in the list
                 if i > 0:
                     self._matchers[i - 1], self._matchers[i] = self._matchers[i], self._matchers[i - 1]
 
                 self._matchCache[text] = matcher
-                return ret            
+                return (matcher, match)
 
         self._noMatchCache.add(text)
-        return (text, None)
+        return (None, None)
+
+    def _convert_param(self, matcher: Matcher, key: str, value: str) -> Any:
+        type = matcher.type_map.get(key)
+        if type:
+            return self._type_converters[type](value)
+
+        return self._string_lru_cache(value) if len(value) < 32 else value
+
+    def match(self, text: str, *, fullmatch=True, pos_msg_params=False) -> Tuple[str, Union[dict, list]]:
+        return self.match_with_id(text, fullmatch=fullmatch, pos_msg_params=pos_msg_params)[1:]
+
+    def match_with_id(self, text: str, *, fullmatch=True, pos_msg_params=False) -> Tuple[int, str, Union[dict, list]]:
+        matcher, match = self._find_match(text, fullmatch)
+        if not match:
+            return (0, text, None)
+
+        matcherkey = (matcher, pos_msg_params)
+        params = match.groupdict()
+        format = None
+
+        def process_param(key, value):
+            if not value:
+                return
+            try:
+                type = matcher.type_map[key]
+                converter = self._type_converters[type]
+                params[key] = converter(value)
+            except KeyError:
+                if len(value) < 32:
+                    params[key] = self._string_lru_cache(value)
+
+        if matcher.can_cache_format and matcherkey in self._matcher_format_cache:
+            format = self._matcher_format_cache[matcherkey]
+            for key, value in list(params.items()):
+                if key == "__del__":
+                    del params[key]
+                    continue
+
+                process_param(key, value)
+        else:
+            split = []
+            lbound = 0
+            for key, value, l, r in [(key, value, *match.span(key)) for key, value in params.items()]:                        
+                if key == "__del__":
+                    del params[key]
+                    if l > 0:
+                        split.append(text[lbound:l])
+                        lbound = r
+                    continue
+
+                process_param(key, value)
+
+                if l > 0:
+                    split.append(text[lbound:l])
+                    lbound = r
+
+                    if pos_msg_params:
+                        split.append("%s")
+                    else:
+                        split.append(f"%({key})s")
+
+            split.append(text[lbound:])
+            format = "".join(split)
+
+            if matcher.can_cache_format:
+                self._matcher_format_cache[matcherkey] = format
+
+        return (matcher.id, format, params if not pos_msg_params else list(params.values()))
+
+    # Compact form, values follow the template schema order, (0, None) when nothing matches
+    # Text captured by unnamed groups isn't kept, use the original message if needed
+    def match_template(self, text: str, *, fullmatch=True) -> Tuple[int, Optional[tuple]]:
+        matcher, match = self._find_match(text, fullmatch)
+        if not match:
+            return (0, None)
+
+        values = []
+        for key in matcher.schema_keys:
+            value = match.group(key)
+            values.append(self._convert_param(matcher, key, value) if value else None)
+
+        return (matcher.id, tuple(values))
@@ -1,12 +1,52 @@
+import calendar
+import contextlib
 import datetime
+import functools
 import orjson
 import logging
 import sqlite3
+import time
+import urllib.parse
 from collections.abc import Iterable
-from typing import NamedTuple, Tuple
+from typing import Callable, NamedTuple, Optional, Tuple
 
+from tse.common.pathinfo import PathInfo
+
+# Reports the duration of the index operations to the index observers (see Index.observers), only timed when there's any
+def _timed(method):
+    op = method.__name__.strip("_")
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self.observers:
+            return method(self, *args, **kwargs)
+
+        start_time = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start_time
+            for observer in self.observers:
+                observer(op, elapsed)
+
+    return wrapper
 
 class Index():
+    # Bumped on every schema change, stored in PRAGMA user_version, see _migrate
+    SCHEMA_VERSION = 2
+
+    _EPOCH = datetime.datetime(1970, 1, 1)
+
+    # Timestamps are stored as integer epochs (of the naive datetimes, taken as UTC), instead of TIMESTAMP text
+    # parsed back by PARSE_DECLTYPES on every row
+    @staticmethod
+    def to_epoch(value: datetime.datetime) -> Optional[int]:
+        return calendar.timegm(value.timetuple()) if value is not None else None
+
+    @classmethod
+    def from_epoch(cls, value: int) -> Optional[datetime.datetime]:
+        return cls._EPOCH + datetime.timedelta(seconds=value) if value is not None else None
+
     class Entry(NamedTuple):
         last_modified: datetime.datetime
         etag: str
@@ -19,56 +59,234 @@ class Index():
 
         @property
         def sql_dict(self):
-            return {"lmod": self.last_modified, "etag": self.etag, "idx": self.index_date, "meta": self.meta_json}
+            return {"lmod": Index.to_epoch(self.last_modified), "etag": self.etag, "idx": Index.to_epoch(self.index_date), 
+                "meta": self.meta_json}
 
         @classmethod
         def from_row(cls, row):
-            return cls(row[0], row[1], row[2], orjson.loads(row[3]) if row[3] else None)
+            return cls(Index.from_epoch(row[0]), row[1], Index.from_epoch(row[2]), orjson.loads(row[3]) if row[3] else None)
 
-    def __init__(self, persist_path=None):
-        self.con = sqlite3.connect(persist_path if persist_path else ":memory:", 
-            detect_types=sqlite3.PARSE_DECLTYPES)
+    # A version of a file, the current one is at the file local path, older ones at the .ver dir (see VersionReader)
+    class Version(NamedTuple):
+        filename: str
+        version: int
+        current: bool
+        entry: "Index.Entry"
 
-        with self.con:
+        @classmethod
+        def from_row(cls, row):
+            return cls(row[0], row[1], row[1] == row[2], Index.Entry.from_row(row[3:]))
+
+    # Structured columns of file_entries, parsed from the filename (PathInfo) and completed by the key metadata
+    # fields (ex: state and hash of voting machine files, election of pictures), queried by find
+    PATH_COLUMNS = ("match", "election", "state", "city", "zone", "section", "type", "ext", "hash")
+    _path_params = ", ".join(f":{c}" for c in PATH_COLUMNS)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _parse_path(filename: str) -> dict:
+        try:
+            info = PathInfo(filename)
+        except ValueError:
+            return {c: None for c in Index.PATH_COLUMNS}
+
+        return {"match": info.match, "election": info.election, "state": info.state, "city": info.city, 
+            "zone": info.zone, "section": info.section, "type": info.type, "ext": info.ext, "hash": None}
+
+    @classmethod
+    def path_columns(cls, filename: str, metadata: Optional[dict]) -> dict:
+        columns = cls._parse_path(filename)
+        if not metadata:
+            return columns
+
+        columns = columns.copy()
+        for key in ("election", "state", "hash"):
+            if columns[key] is None and metadata.get(key) is not None:
+                columns[key] = str(metadata[key])
+
+        return columns
+
+    @classmethod
+    def entry_dict(cls, filename: str, version: int, entry: Entry) -> dict:
+        return {"fn": filename, "ver": version} | entry.sql_dict | cls.path_columns(filename, entry.metadata)
+
+    # WAL caps, the file is truncated back to this size once checkpointed
+    JOURNAL_SIZE_LIMIT = 64 * 1024 * 1024
+
+    # WAL journal, so readers (see open_readonly) see consistent snapshots while the crawler keeps writing, and a crash
+    # can't corrupt the database (synchronous NORMAL is crash safe under WAL)
+    #
+    # mmap_size: bytes of the database memory mapped, the pages are then shared through the OS page cache among
+    #            every process with the index open instead of copied in each connection cache
+    # checkpoint_interval: seconds between passive checkpoints, done after writes, besides the automatic ones by size
+    def __init__(self, persist_path=None, readonly=False, mmap_size=0, checkpoint_interval=None):
+        self.readonly = readonly
+        self.checkpoint_interval = checkpoint_interval
+        self.observers: list[Callable[[str, float], None]] = []     # Called with each operation name and seconds
+        self._last_checkpoint = time.monotonic()
+
+        if readonly:
+            self.con = sqlite3.connect(f"file:{urllib.parse.quote(persist_path)}?mode=ro", uri=True)
+        else:
+            self.con = sqlite3.connect(persist_path if persist_path else ":memory:")
+
+        if mmap_size:
+            self.con.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+
+        if readonly:
+            self.con.execute("PRAGMA query_only = ON")
+
+            schema_version = self.con.execute("PRAGMA user_version").fetchone()[0]
+            if schema_version != self.SCHEMA_VERSION:
+                self.con.close()
+                raise RuntimeError(f"Index schema version {schema_version} isn't {self.SCHEMA_VERSION}, open it for writing first to migrate")
+        else:
+            self.con.execute("PRAGMA journal_mode = WAL")
+            self.con.execute("PRAGMA synchronous = NORMAL")
+            self.con.execute(f"PRAGMA journal_size_limit = {self.JOURNAL_SIZE_LIMIT}")
+
+            self._migrate()
             self.con.execute("PRAGMA foreign_keys = ON")
-            self.con.execute("PRAGMA synchronous = OFF")
-            self.con.execute("PRAGMA journal_mode = TRUNCATE")
-
-            self.con.execute((
-                "CREATE TABLE IF NOT EXISTS file_versions ("
-                "  filename TEXT,"
-                "  version INTEGER,"
-                "  last_modified TIMESTAMP NOT NULL,"
-                "  etag TEXT NOT NULL,"
-                "  index_date TIMESTAMP,"
-                "  metadata BLOB,"
-                "  PRIMARY KEY(filename,version)"
-                ") WITHOUT ROWID"
-            ))
-
-            self.con.execute((
-                "CREATE TABLE IF NOT EXISTS file_entries ("
-                "  filename TEXT PRIMARY KEY,"
-                "  version INTEGER,"
-                "  FOREIGN KEY(filename,version) REFERENCES file_versions(filename,version)"
-                ") WITHOUT ROWID"
-            ))
-
-            self.con.execute((
-                "CREATE VIEW IF NOT EXISTS file_items AS"
-                " SELECT file_entries.filename, file_entries.version, last_modified, etag, index_date, metadata"
-                " FROM file_entries NATURAL LEFT JOIN file_versions;"
-            ))
 
         if persist_path:
-            logging.info("Index persist path: %s",  persist_path)
+            logging.info("Index persist path: %s%s", persist_path, " (read-only)" if readonly else "")
+
+    # For analysis tools (notebooks, parse_logs, etc), never blocks nor is blocked by the crawler writes
+    @classmethod
+    def open_readonly(cls, persist_path, mmap_size=0) -> "Index":
+        return cls(persist_path, readonly=True, mmap_size=mmap_size)
+
+    # Every read inside sees the same snapshot of the index, otherwise each query sees the latest commit
+    @contextlib.contextmanager
+    def read_transaction(self):
+        self.con.execute("BEGIN")
+        try:
+            yield self
+        finally:
+            self.con.rollback()
+
+    # Returns (busy, wal frames, checkpointed frames), a passive checkpoint doesn't wait on readers
+    @_timed
+    def checkpoint(self, mode="PASSIVE") -> tuple[int, int, int]:
+        start_time = time.monotonic()
+        result = self.con.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+        self._last_checkpoint = time.monotonic()
+
+        logging.debug("Index checkpoint %s, busy: %d, wal frames: %d, checkpointed: %d in %.3fs", 
+            mode, *result, self._last_checkpoint - start_time)
+        return result
+
+    def _maybe_checkpoint(self):
+        if self.checkpoint_interval and time.monotonic() - self._last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def _create_schema(self):
+        self.con.execute((
+            "CREATE TABLE IF NOT EXISTS file_versions ("
+            "  filename TEXT,"
+            "  version INTEGER,"
+            "  last_modified INTEGER NOT NULL,"
+            "  etag TEXT NOT NULL,"
+            "  index_date INTEGER,"
+            "  metadata BLOB,"
+            "  PRIMARY KEY(filename,version)"
+            ") WITHOUT ROWID"
+        ))
+
+        # Time travel, the version of each file at a given index date (snapshot_at) and the changes over time (replay)
+        self.con.execute("CREATE INDEX IF NOT EXISTS file_versions_filename_date ON file_versions(filename, index_date)")
+        self.con.execute("CREATE INDEX IF NOT EXISTS file_versions_date ON file_versions(index_date)")
+
+        self.con.execute((
+            "CREATE TABLE IF NOT EXISTS file_entries ("
+            "  filename TEXT PRIMARY KEY,"
+            "  version INTEGER,"
+            "  match TEXT,"
+            "  election TEXT,"
+            "  state TEXT,"
+            "  city TEXT,"
+            "  zone TEXT,"
+            "  section TEXT,"
+            "  type TEXT,"
+            "  ext TEXT,"
+            "  hash TEXT,"
+            "  FOREIGN KEY(filename,version) REFERENCES file_versions(filename,version)"
+            ") WITHOUT ROWID"
+        ))
+
+        # Covering (the filename primary key is part of every index of a WITHOUT ROWID table)
+        self.con.execute("CREATE INDEX IF NOT EXISTS file_entries_type ON file_entries(type, ext, election, state)")
+        self.con.execute("CREATE INDEX IF NOT EXISTS file_entries_match ON file_entries(match, state, city, zone, section)")
+        self.con.execute("CREATE INDEX IF NOT EXISTS file_entries_ext ON file_entries(ext)")
+
+        self.con.execute((
+            "CREATE VIEW IF NOT EXISTS file_items AS"
+            " SELECT file_entries.filename, file_entries.version, last_modified, etag, index_date, metadata"
+            " FROM file_entries NATURAL LEFT JOIN file_versions;"
+        ))
+
+    def _migrate(self):
+        schema_version = self.con.execute("PRAGMA user_version").fetchone()[0]
+        if schema_version == self.SCHEMA_VERSION:
+            return
+
+        if schema_version > self.SCHEMA_VERSION:
+            raise RuntimeError(f"Index schema version {schema_version} is newer than supported {self.SCHEMA_VERSION}")
+
+        # All or nothing, DDL included
+        self.con.execute("BEGIN")
+        try:
+            legacy = self.con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='file_versions'").fetchone()
+            if legacy and schema_version == 0:
+                self._migrate_v0()
+            else:
+                # Later versions only add tables and indexes
+                self._create_schema()
+
+            self.con.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            self.con.commit()
+        except BaseException:
+            self.con.rollback()
+            raise
+
+    # v0: TIMESTAMP text columns, filename only file_entries
+    def _migrate_v0(self):
+        logging.info("Migrating index schema to version %d...", self.SCHEMA_VERSION)
+
+        self.con.execute("DROP VIEW IF EXISTS file_items")
+        self.con.execute("ALTER TABLE file_entries RENAME TO file_entries_v0")
+        self.con.execute("ALTER TABLE file_versions RENAME TO file_versions_v0")
+
+        self._create_schema()
+
+        self.con.execute((
+            "INSERT INTO file_versions SELECT filename, version,"
+            " CAST(strftime('%s', last_modified) AS INTEGER), etag, CAST(strftime('%s', index_date) AS INTEGER), metadata"
+            " FROM file_versions_v0"
+        ))
+
+        rows = self.con.execute(("SELECT file_entries_v0.filename, file_entries_v0.version, metadata FROM file_entries_v0"
+                                 " NATURAL LEFT JOIN file_versions_v0"))
+
+        self.con.executemany(f"INSERT INTO file_entries VALUES (:fn, :ver, {self._path_params})",
+            ({"fn": fn, "ver": ver} | self.path_columns(fn, orjson.loads(meta) if meta else None) for fn, ver, meta in rows))
+
+        self.con.execute("DROP TABLE file_entries_v0")
+        self.con.execute("DROP TABLE file_versions_v0")
+
+        logging.info("Migrated %d index entries", len(self))
 
     def close(self):
         if self.con:
-            with self.con:
-                self.con.execute("PRAGMA journal_mode = DELETE")
-                
+            if not self.readonly:
+                try:
+                    self.checkpoint("TRUNCATE")
+                except sqlite3.OperationalError as e:
+                    # Someone else still has it open, the last of them cleans up the WAL
+                    logging.debug("Index final checkpoint skipped: %s", e)
+
             self.con.close()
+            self.con = None
 
     def __enter__(self):
         return self
@@ -77,6 +295,7 @@ class Index():
         self.close()
         return
 
+    @_timed
     def __getitem__(self, filename: str) -> Entry:
         row = self.con.execute((
             "SELECT last_modified, etag, index_date, metadata FROM file_entries" 
@@ -87,21 +306,24 @@ class Index():
         
         return Index.Entry.from_row(row)
 
+    @_timed
     def __len__(self):
         row = self.con.execute("SELECT COUNT(*) FROM file_entries").fetchone()
         return row[0]
 
+    @_timed
     def __setitem__(self, filename: str, entry: Entry):
         with self.con:
             row = self.con.execute("SELECT version FROM file_entries WHERE filename=:fn", {"fn": filename}).fetchone()
             version = row[0] if row else 1
 
-            self.con.execute("REPLACE INTO file_versions VALUES (:fn, :ver, :lmod, :etag, :idx, :meta)", 
-                    {"fn": filename, "ver": version} | entry.sql_dict)
+            data = self.entry_dict(filename, version, entry)
+            self.con.execute("REPLACE INTO file_versions VALUES (:fn, :ver, :lmod, :etag, :idx, :meta)", data)
+            self.con.execute(f"REPLACE INTO file_entries VALUES (:fn, :ver, {self._path_params})", data)
 
-            self.con.execute("REPLACE INTO file_entries VALUES (:fn, :ver)", 
-                    {"fn": filename, "ver": version})
+        self._maybe_checkpoint()
 
+    @_timed
     def __contains__(self, filename: str):
         row = self.con.execute("SELECT COUNT(*) FROM file_entries WHERE filename=:fn", {"fn": filename}).fetchone()
         return row and row[0] != 0
@@ -115,11 +337,31 @@ class Index():
                                      " NATURAL LEFT JOIN file_versions")):
             yield (row[0], Index.Entry.from_row(row[1:]))
 
+    # Full scan, prefer find when the pattern is about the structured columns
     def search(self, filename_pattern) -> Iterable[Tuple[str, Entry]]: 
         for row in self.con.execute(("SELECT file_entries.filename, last_modified, etag, index_date, metadata FROM file_entries"
                                      " NATURAL LEFT JOIN file_versions WHERE file_entries.filename LIKE :fnp"), {"fnp": filename_pattern}):
             yield (row[0], Index.Entry.from_row(row[1:]))
 
+    @classmethod
+    def _where_columns(cls, columns: dict) -> str:
+        unknown = columns.keys() - set(cls.PATH_COLUMNS)
+        if unknown:
+            raise ValueError(f"Not a structured index column: {', '.join(sorted(unknown))}")
+
+        return " AND ".join(f"file_entries.{c} = :{c}" for c in columns) or "1"
+
+    # Entries matching all the given structured columns (ex: find(type="f", ext="json")), an index lookup
+    def find(self, **columns) -> Iterable[Tuple[str, Entry]]:
+        for row in self.con.execute(("SELECT file_entries.filename, last_modified, etag, index_date, metadata FROM file_entries"
+                                     f" NATURAL LEFT JOIN file_versions WHERE {self._where_columns(columns)}"), columns):
+            yield (row[0], Index.Entry.from_row(row[1:]))
+
+    # Same as find, but only the filenames, answered from the covering indexes alone
+    def find_files(self, **columns) -> Iterable[str]:
+        for row in self.con.execute(f"SELECT filename FROM file_entries WHERE {self._where_columns(columns)}", columns):
+            yield row[0]
+
     def add(self, filename: str, entry: Entry):
         self[filename] = entry
 
@@ -129,11 +371,15 @@ class Index():
         except KeyError:
             return default
 
+    @_timed
     def discard(self, filename: str):
         with self.con:
             self.con.execute("DELETE FROM file_entries WHERE filename=:fname", {"fname": filename})
             self.con.execute("DELETE FROM file_versions WHERE filename=:fname", {"fname": filename})
 
+        self._maybe_checkpoint()
+
+    @_timed
     def add_many(self, iterable: Iterable[tuple[str,Entry]]):
         with self.con:
             data = [{"fn": f, "e": e} for f, e in iterable]
@@ -144,32 +390,127 @@ class Index():
 
             versions = dict(rows) if rows else dict()
 
-            replace_data = list(({"fn": d["fn"], "ver": versions.get(d["fn"], 1)} | d["e"].sql_dict) for d in data)
+            replace_data = list(self.entry_dict(d["fn"], versions.get(d["fn"], 1), d["e"]) for d in data)
 
             self.con.executemany("REPLACE INTO file_versions VALUES (:fn, :ver, :lmod, :etag, :idx, :meta)", replace_data)
-            self.con.executemany("REPLACE INTO file_entries VALUES (:fn, :ver)", replace_data)
+            self.con.executemany(f"REPLACE INTO file_entries VALUES (:fn, :ver, {self._path_params})", replace_data)
+
+        self._maybe_checkpoint()
 
+    @_timed
     def remove_many(self, iterable: Iterable[str]):
         with self.con:
             data = [{"fn": f} for f in iterable]
             self.con.executemany("DELETE FROM file_entries WHERE filename=:fn", data)
             self.con.executemany("DELETE FROM file_versions WHERE filename=:fn", data)
 
+        self._maybe_checkpoint()
+
+    @_timed
     def get_current_version(self, filename: str, default: int = 0 ) -> int:
         row = self.con.execute("SELECT version FROM file_entries WHERE filename=:fn", {"fn": filename}).fetchone()
         return row[0] if row else default
 
+    @_timed
     def add_version(self, filename: str, version: int, entry: Entry):
         with self.con:
-            data = {"fn": filename, "ver": version } | entry.sql_dict
+            data = self.entry_dict(filename, version, entry)
 
             self.con.execute("REPLACE INTO file_versions VALUES (:fn, :ver, :lmod, :etag, :idx, :meta)", data)
-            self.con.execute("REPLACE INTO file_entries VALUES (:fn, :ver)", data)
+            self.con.execute(f"REPLACE INTO file_entries VALUES (:fn, :ver, {self._path_params})", data)
+
+        self._maybe_checkpoint()
+
+    _version_columns = ("file_versions.filename, file_versions.version, file_entries.version,"
+                        " last_modified, etag, index_date, metadata")
+
+    # Version of each file current at the index date ts (the latest with index_date <= ts), files without any index date
+    # (ex: pictures, the index files themselves) or not yet published at ts are left out, ts is in the same (local) time
+    # of the index files dates, columns filters as in find
+    # CROSS JOIN pins the join order, one file_versions_filename_date seek per entry instead of a scan of every version
+    @_timed
+    def snapshot_at(self, ts: datetime.datetime, **columns) -> dict[str, Version]:
+        rows = self.con.execute((
+            f"SELECT {self._version_columns} FROM file_entries CROSS JOIN file_versions"
+            " ON file_versions.filename = file_entries.filename AND file_versions.version = ("
+            "   SELECT version FROM file_versions AS v WHERE v.filename = file_entries.filename AND v.index_date <= :ts"
+            "   ORDER BY v.index_date DESC, v.version DESC LIMIT 1)"
+            f" WHERE {self._where_columns(columns)}"), {"ts": self.to_epoch(ts)} | columns)
+
+        return {row[0]: Index.Version.from_row(row) for row in rows}
+
+    # Versions published after start up to end, in index date order
+    def changes_between(self, start: datetime.datetime, end: datetime.datetime, **columns) -> Iterable[Version]:
+        rows = self.con.execute((
+            f"SELECT {self._version_columns} FROM file_versions JOIN file_entries USING (filename)"
+            f" WHERE index_date > :start AND index_date <= :end AND {self._where_columns(columns)}"
+            " ORDER BY index_date, file_versions.version"), {"start": self.to_epoch(start), "end": self.to_epoch(end)} | columns)
+
+        for row in rows:
+            yield Index.Version.from_row(row)
+
+    # Snapshots every step from start to end, built from the one at start plus the changes, the same dict is updated 
+    # and yielded along with the versions changed since the previous step
+    def replay(self, start: datetime.datetime, end: datetime.datetime, step: datetime.timedelta, 
+            **columns) -> Iterable[tuple[datetime.datetime, dict[str, Version], list[Version]]]:
+        snapshot = self.snapshot_at(start, **columns)
+        yield start, snapshot, list(snapshot.values())
+
+        changes = self.changes_between(start, end, **columns)
+        change = next(changes, None)
+
+        ts = start
+        while ts < end:
+            ts = min(ts + step, end)
+
+            changed = []
+            while change is not None and change.entry.index_date <= ts:
+                snapshot[change.filename] = change
+                changed.append(change)
+                change = next(changes, None)
+
+            yield ts, snapshot, changed
+
+    # Files with old versions besides the current one, candidates for pruning
+    @_timed
+    def get_versioned_files(self, **columns) -> list[str]:
+        rows = self.con.execute((
+            "SELECT file_entries.filename FROM file_entries JOIN file_versions USING (filename)"
+            f" WHERE {self._where_columns(columns)} GROUP BY file_entries.filename HAVING COUNT(*) > 1"), columns)
+
+        return [row[0] for row in rows]
+
+    # Every version of the files, oldest first
+    @_timed
+    def get_versions(self, filenames: Iterable[str]) -> dict[str, list[Version]]:
+        versions = {}
+        for filename in filenames:
+            rows = self.con.execute((
+                f"SELECT {self._version_columns} FROM file_versions JOIN file_entries USING (filename)"
+                " WHERE file_versions.filename = :fn ORDER BY file_versions.version"), {"fn": filename})
+            versions[filename] = [Index.Version.from_row(row) for row in rows]
+
+        return versions
+
+    # Deletes old versions rows in a single transaction, current versions are never removed, returns the deleted count
+    @_timed
+    def remove_versions(self, versions: Iterable[tuple[str, int]]) -> int:
+        with self.con:
+            cursor = self.con.executemany((
+                "DELETE FROM file_versions WHERE filename = :fn AND version = :ver"
+                " AND version != (SELECT version FROM file_entries WHERE file_entries.filename = :fn)"), 
+                [{"fn": f, "ver": v} for f, v in versions])
+            removed = cursor.rowcount
+
+        self._maybe_checkpoint()
+        return removed
 
+    @_timed
     def optimize(self):
         with self.con:
             self.con.execute("PRAGMA optimize")
  
+    @_timed
     def vacuum(self):
         with self.con:
             self.con.execute("VACUUM")
@@ -0,0 +1,272 @@
+import datetime
+import logging
+import os
+import uuid
+from typing import Iterable
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from tse.common.voting_machine_files import VotingMachineLogProcessor
+
+# Writes parsed log rows as a hive partitioned dataset: <root>/state=<state>/city=<city>/part-*.parquet
+# Readable with pyarrow.dataset.dataset(root, partitioning="hive") or dask.dataframe.read_parquet(root)
+# Every flush writes a file per partition, when flushed often (ex: per batch) compact the dataset afterwards (see compact)
+class VotingMachineLogParquetWriter:
+    _param_arrow_types = {
+        "int": pa.int64(),
+        "base16int": pa.int64(),
+        "float": pa.float64(),
+        "bool": pa.bool_(),
+        "datebr": pa.date32(),
+        "time": pa.time32("s"),
+        "str": pa.string(),
+    }
+
+    _param_python_types = {
+        "int": int,
+        "base16int": int,
+        "float": float,
+        "bool": bool,
+        "datebr": datetime.date,
+        "time": datetime.time,
+        "str": str,
+    }
+
+    _dict_string = pa.dictionary(pa.int32(), pa.string())
+
+    def __init__(self, root: str, param_types: dict[str, str], *, row_group_size: int = 1_000_000,
+                        compression: str = "zstd", basename: str = None):
+        self.root = root
+        self.row_group_size = row_group_size
+        self.compression = compression
+        # Unique per writer, pids get recycled between runs over the same dataset
+        self.basename = basename or f"part-{uuid.uuid4().hex}"
+        self._param_types = dict(sorted(param_types.items()))
+        self._file_count = 0
+        self._buffers = {}
+        # Per file columns, kept as is until flushed
+        self._columns = {}
+        # What was written since mark(), (partition, buffer length before) or (partition, None) for columns
+        self._since_mark = []
+
+        self.schema = pa.schema([
+            ("plea", self._dict_string),
+            ("zone", self._dict_string),
+            ("section", self._dict_string),
+            ("logfilename", self._dict_string),
+            ("logtype", self._dict_string),
+            ("rownum", pa.int32()),
+            ("timestamp", pa.timestamp("s")),
+            ("level", self._dict_string),
+            ("vm_id", self._dict_string),
+            ("app", self._dict_string),
+            ("message", pa.string()),
+            ("message_template", self._dict_string),
+            ("template_id", pa.uint16()),
+            ("hash", pa.uint64()),
+        ] + [("param_" + k, self._param_arrow_types[t]) for k, t in self._param_types.items()])
+
+    def _get_buffer(self, state: str, city: str) -> dict[str, list]:
+        buffer = self._buffers.get((state, city))
+        if buffer is None:
+            buffer = self._buffers[(state, city)] = {k: [] for k in ("plea", "zone", "section", "logfilename", "logtype",
+                "rownum", "timestamp", "level", "vm_id", "app", "message", "message_template", "template_id", "hash", "params")}
+
+        return buffer
+
+    def write_log(self, commonfields: dict, filename: str, rows: Iterable[VotingMachineLogProcessor.Row]) -> int:
+        partition = (commonfields["state"], commonfields["city"])
+        buffer = self._get_buffer(*partition)
+        self._since_mark.append((partition, len(buffer["rownum"])))
+        logtype = "contingency" if os.path.splitext(filename)[1] == ".jez" else "main"
+
+        count = 0
+        for row in rows:
+            buffer["rownum"].append(row.number)
+            buffer["timestamp"].append(row.timestamp)
+            buffer["level"].append(row.level)
+            buffer["vm_id"].append(row.vm_id)
+            buffer["app"].append(row.app)
+            buffer["message"].append(row.message)
+            buffer["message_template"].append(row.message_template)
+            buffer["template_id"].append(row.message_template_id)
+            buffer["hash"].append(row.hash)
+            buffer["params"].append(row.message_params)
+            count += 1
+
+        # Constant per log file
+        for key, value in (("plea", commonfields["plea"]), ("zone", commonfields["zone"]), ("section", commonfields["section"]),
+                            ("logfilename", filename), ("logtype", logtype)):
+            buffer[key].extend([value] * count)
+
+        return count
+
+    def write_columns(self, commonfields: dict, columns: VotingMachineLogProcessor.Columns) -> int:
+        partition = (commonfields["state"], commonfields["city"])
+        self._columns.setdefault(partition, []).append((commonfields, columns))
+        self._since_mark.append((partition, None))
+        return len(columns)
+
+    # Keeps what was written so far, rollback() only drops what comes after
+    def mark(self):
+        self._since_mark.clear()
+
+    # Drops what was written since the last mark() or flush(), rows of a log failing midway included, returns the rows dropped
+    def rollback(self) -> int:
+        dropped = 0
+        for partition, length in reversed(self._since_mark):
+            if length is None:
+                _, columns = self._columns[partition].pop()
+                dropped += len(columns)
+            else:
+                buffer = self._buffers[partition]
+                # A log failing midway leaves the per row fields longer than the constant ones, all are cut back
+                dropped += len(buffer["rownum"]) - length
+                for values in buffer.values():
+                    del values[length:]
+
+        self._since_mark.clear()
+        return dropped
+
+    @staticmethod
+    def _from_array(type: pa.DataType, values) -> pa.Array:
+        # Typed arrays are wrapped without copying
+        return pa.Array.from_buffers(type, len(values), [None, pa.py_buffer(values)])
+
+    def _from_dictionary(self, dictionary: VotingMachineLogProcessor.Columns.Dictionary) -> pa.Array:
+        index_type = pa.uint16() if dictionary.codes.itemsize == 2 else pa.uint32()
+        indices = self._from_array(index_type, dictionary.codes).cast(pa.int32())
+        return pa.DictionaryArray.from_arrays(indices, pa.array(dictionary.values, pa.string()))
+
+    def _build_columns_table(self, commonfields: dict, columns: VotingMachineLogProcessor.Columns) -> pa.Table:
+        count = len(columns)
+        logtype = "contingency" if os.path.splitext(columns.source_name)[1] == ".jez" else "main"
+
+        arrays = {
+            "rownum": self._from_array(pa.int32(), columns.number),
+            "timestamp": self._from_array(pa.timestamp("s"), columns.timestamp),
+            "level": self._from_dictionary(columns.level),
+            "vm_id": self._from_dictionary(columns.vm_id),
+            "app": self._from_dictionary(columns.app),
+            "message": self._from_dictionary(columns.message).dictionary_decode(),
+            "message_template": self._from_dictionary(columns.message_template),
+            "template_id": self._from_array(pa.uint16(), columns.message_template_id),
+            "hash": self._from_array(pa.uint64(), columns.hash),
+        }
+
+        for key, value in (("plea", commonfields["plea"]), ("zone", commonfields["zone"]), ("section", commonfields["section"]),
+                            ("logfilename", columns.source_name), ("logtype", logtype)):
+            arrays[key] = pa.array([value] * count, self._dict_string)
+
+        params = columns.message_params
+        used_params = {k for p in params if p for k in p}
+        for key, type in self._param_types.items():
+            if key in used_params:
+                arrays["param_" + key] = self._param_column(params, key, type)
+            else:
+                arrays["param_" + key] = pa.nulls(count, self._param_arrow_types[type])
+
+        return pa.Table.from_arrays([arrays[f.name] for f in self.schema], schema=self.schema)
+
+    def _param_column(self, params: list, key: str, type: str) -> pa.Array:
+        python_type = self._param_python_types[type]
+        # Values that failed to convert (ex: empty) stay as null
+        values = [p.get(key) if p else None for p in params]
+        return pa.array([v if isinstance(v, python_type) else None for v in values], self._param_arrow_types[type])
+
+    def _build_table(self, buffer: dict[str, list]) -> pa.Table:
+        params = buffer.pop("params")
+        used_params = {k for p in params if p for k in p}
+
+        columns = [pa.array(buffer[f.name], f.type) for f in self.schema if not f.name.startswith("param_")]
+        for key, type in self._param_types.items():
+            if key in used_params:
+                columns.append(self._param_column(params, key, type))
+            else:
+                columns.append(pa.nulls(len(params), self._param_arrow_types[type]))
+
+        return pa.Table.from_arrays(columns, schema=self.schema)
+
+    def flush(self):
+        for partition in sorted(self._buffers.keys() | self._columns.keys()):
+            tables = []
+
+            buffer = self._buffers.get(partition)
+            if buffer and len(buffer["rownum"]) > 0:
+                tables.append(self._build_table(buffer))
+
+            for commonfields, columns in self._columns.get(partition, ()):
+                if len(columns) > 0:
+                    tables.append(self._build_columns_table(commonfields, columns))
+
+            if len(tables) == 0:
+                continue
+
+            table = pa.concat_tables(tables) if len(tables) > 1 else tables[0]
+            state, city = partition
+
+            dir = os.path.join(self.root, f"state={state}", f"city={city}")
+            os.makedirs(dir, exist_ok=True)
+
+            # Write under a hidden name first, so partial files are never picked up by readers
+            filename = f"{self.basename}-{self._file_count:06}.parquet"
+            tmp_path = os.path.join(dir, "." + filename)
+            pq.write_table(table, tmp_path, row_group_size=self.row_group_size, compression=self.compression)
+            os.replace(tmp_path, os.path.join(dir, filename))
+            self._file_count += 1
+
+        self._buffers.clear()
+        self._columns.clear()
+        self._since_mark.clear()
+
+    def close(self):
+        self.flush()
+
+# Merges the small files of each partition into one with full row groups, the files already holding a row group are
+# left alone, so it can be run again after resuming, rows are streamed a row group at a time
+# The sources are removed only after the merged file is in place, a crash in between leaves duplicated rows behind
+def compact(root: str, *, row_group_size: int = 1_000_000, compression: str = "zstd") -> int:
+    compacted = 0
+    for dir, dirs, files in os.walk(root):
+        dirs.sort()
+        paths = [os.path.join(dir, f) for f in sorted(files) if f.endswith(".parquet") and not f.startswith((".", "_"))]
+        paths = [p for p in paths if pq.ParquetFile(p).metadata.num_rows < row_group_size]
+        if len(paths) < 2:
+            continue
+
+        filename = f"compact-{uuid.uuid4().hex}.parquet"
+        tmp_path = os.path.join(dir, "." + filename)
+
+        writer = None
+        pending = []
+        pending_rows = 0
+        try:
+            for path in paths:
+                table = pq.ParquetFile(path).read()
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_path, table.schema, compression=compression)
+
+                pending.append(table)
+                pending_rows += table.num_rows
+                if pending_rows >= row_group_size:
+                    table = pa.concat_tables(pending)
+                    full_rows = pending_rows - pending_rows % row_group_size
+                    writer.write_table(table.slice(0, full_rows), row_group_size=row_group_size)
+                    pending = [table.slice(full_rows)]
+                    pending_rows -= full_rows
+
+            if pending_rows > 0:
+                writer.write_table(pa.concat_tables(pending), row_group_size=row_group_size)
+        finally:
+            if writer is not None:
+                writer.close()
+
+        os.replace(tmp_path, os.path.join(dir, filename))
+        for path in paths:
+            os.remove(path)
+
+        logging.debug("Compacted %d files into %s", len(paths), os.path.join(dir, filename))
+        compacted += len(paths)
+
+    return compacted
@@ -0,0 +1,520 @@
+import base64
+import logging
+import os
+import random
+import time
+from collections import deque
+from datetime import datetime, timezone
+from threading import Condition, Lock, Thread
+from typing import BinaryIO, Callable, Iterable, Optional
+
+import mmh3
+import orjson
+
+from tse.common.voting_machine_files import VotingMachineLogProcessor
+
+# Destinations for the parsed voting machine logs, all sinks share the same interface:
+#   write_log(commonfields, filename, rows) -> docs written, called for each log file of a section
+#   write_log_file(log_processor, commonfields, filename, bio) parses and writes, in the row or columnar form the sink prefers
+#   end_section(key, commonfields, section_filename) once all logs of a section were written
+#   discard_section() when a section fails partway, drops what the local sinks hold of it (elasticsearch ids are stable,
+#   a section sent again overwrites its docs)
+#   flush() blocks until everything written is durable, close() flushes and releases resources
+# on_done(key, success) is called once a section is durable (or failed), in whichever thread that happens
+
+OnDone = Callable[[str, bool], None]
+
+def get_logtype(filename: str) -> str:
+    return "contingency" if os.path.splitext(filename)[1] == ".jez" else "main"
+
+class SinkMetrics:
+    def __init__(self, name: str):
+        self.name = name
+        self.docs = 0
+        self.bytes = 0
+        self.batches = 0
+        self.retries = 0
+        self.failures = 0
+        # Time spent writing or waiting on the destination, summed across threads
+        # Rows are generated lazily, so on synchronous sinks it includes the parsing
+        self.busy_seconds = 0.0
+        self.start_time = time.monotonic()
+        self._lock = Lock()
+
+    def record(self, docs: int, bytes: int, seconds: float):
+        with self._lock:
+            self.docs += docs
+            self.bytes += bytes
+            self.batches += 1
+            self.busy_seconds += seconds
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def record_failure(self, docs: int):
+        with self._lock:
+            self.failures += docs
+
+    def as_dict(self) -> dict:
+        elapsed = max(time.monotonic() - self.start_time, 1e-6)
+        return {
+            "sink": self.name,
+            "docs": self.docs,
+            "bytes": self.bytes,
+            "batches": self.batches,
+            "retries": self.retries,
+            "failures": self.failures,
+            "busy_seconds": self.busy_seconds,
+            "docs_per_second": self.docs / elapsed,
+            "mb_per_second": self.bytes / 1e6 / elapsed,
+        }
+
+    def log(self, logger: logging.Logger = logging.root, prefix: str = ""):
+        m = self.as_dict()
+        logger.info("%s%s sink: %d docs (%.0f/s), %.1f MB (%.2f MB/s), %d batches (%.1f ms avg), %d retries, %d failed docs",
+            prefix, self.name, m["docs"], m["docs_per_second"], m["bytes"] / 1e6, m["mb_per_second"], m["batches"],
+            1000 * m["busy_seconds"] / max(m["batches"], 1), m["retries"], m["failures"])
+
+class LogSink:
+    name = "sink"
+
+    def __init__(self, on_done: Optional[OnDone] = None):
+        self.metrics = SinkMetrics(self.name)
+        self.on_done = on_done
+        self._unflushed = []
+
+    def write_log(self, commonfields: dict, filename: str, rows: Iterable[VotingMachineLogProcessor.Row]) -> int:
+        raise NotImplementedError()
+
+    def write_log_file(self, log_processor: VotingMachineLogProcessor, commonfields: dict, filename: str, bio: BinaryIO) -> int:
+        return self.write_log(commonfields, filename, log_processor.parse_log(bio, filename))
+
+    # Synchronous sinks report sections as done on the next flush
+    def end_section(self, key: str, commonfields: dict, section_filename: str):
+        self._unflushed.append(key)
+
+    def discard_section(self):
+        pass
+
+    def _flush(self):
+        pass
+
+    def flush(self):
+        success = False
+        try:
+            self._flush()
+            success = True
+        finally:
+            if self.on_done:
+                for key in self._unflushed:
+                    self.on_done(key, success)
+            self._unflushed.clear()
+
+    # A section left unended is incomplete, it isn't flushed
+    def close(self):
+        self.discard_section()
+        self.flush()
+
+    def get_stats(self) -> dict:
+        return self.metrics.as_dict()
+
+# Only parses, to measure the pure parsing throughput
+class NullSink(LogSink):
+    name = "null"
+
+    def write_log(self, commonfields: dict, filename: str, rows: Iterable[VotingMachineLogProcessor.Row]) -> int:
+        start_time = time.perf_counter()
+        count = sum(1 for _ in rows)
+        self.metrics.record(count, 0, time.perf_counter() - start_time)
+        return count
+
+# Newline delimited json, zstd compressed when the path ends with .zst
+class NdjsonSink(LogSink):
+    name = "ndjson"
+
+    def __init__(self, path: str, *, compression_level: int = 3, on_done: Optional[OnDone] = None):
+        super().__init__(on_done)
+        self.path = path
+        self._raw = open(path, "ab")
+        self._zstd = None
+        # Written to the file once the section ends, a section failing partway leaves nothing behind
+        self._section = bytearray()
+
+        if path.endswith(".zst"):
+            import zstandard
+            self._zstd = zstandard
+            # Every flush closes a frame, concatenated frames are a valid zstd stream
+            self.file = zstandard.ZstdCompressor(level=compression_level).stream_writer(self._raw, closefd=False)
+        else:
+            self.file = self._raw
+
+    def write_log(self, commonfields: dict, filename: str, rows: Iterable[VotingMachineLogProcessor.Row]) -> int:
+        logtype = get_logtype(filename)
+        buffer = bytearray()
+        count = 0
+
+        start_time = time.perf_counter()
+        for row in rows:
+            buffer += orjson.dumps(commonfields | {
+                "logfilename": filename,
+                "logtype": logtype,
+                "rownum": row.number,
+                "timestamp": row.timestamp,
+                "level": row.level,
+                "vm_id": row.vm_id,
+                "app": row.app,
+                "message": row.message,
+                "message_template": row.message_template,
+                "message_template_id": row.message_template_id,
+                "message_params": row.message_params,
+                "hash": "{:016X}".format(row.hash),
+            }, option=orjson.OPT_APPEND_NEWLINE)
+            count += 1
+
+        self._section += buffer
+        self.metrics.record(count, len(buffer), time.perf_counter() - start_time)
+        return count
+
+    def end_section(self, key: str, commonfields: dict, section_filename: str):
+        self.file.write(self._section)
+        self._section.clear()
+        super().end_section(key, commonfields, section_filename)
+
+    def discard_section(self):
+        self._section.clear()
+
+    def _flush(self):
+        if self._zstd:
+            self.file.flush(self._zstd.FLUSH_FRAME)
+        self._raw.flush()
+
+    def close(self):
+        if self._raw:
+            self.discard_section()
+            self.flush()
+            if self._zstd:
+                self.file.close()
+            self._raw.close()
+            self._raw = None
+
+class ParquetSink(LogSink):
+    name = "parquet"
+
+    def __init__(self, root: str, param_types: dict[str, str], *, on_done: Optional[OnDone] = None, **kwargs):
+        super().__init__(on_done)
+        from tse.common.log_parquet import VotingMachineLogParquetWriter
+        self.writer = VotingMachineLogParquetWriter(root, param_types, **kwargs)
+        self._buffered_docs = 0
+
+    def write_log(self, commonfields: dict, filename: str, rows: Iterable[VotingMachineLogProcessor.Row]) -> int:
+        count = self.writer.write_log(commonfields, filename, rows)
+        self._buffered_docs += count
+        return count
+
+    # Buffered until flushed, the columnar form takes a fraction of the memory of the rows
+    def write_log_file(self, log_processor: VotingMachineLogProcessor, commonfields: dict, filename: str, bio: BinaryIO) -> int:
+        count = self.writer.write_columns(commonfields, log_processor.parse_log_columns(bio, filename))
+        self._buffered_docs += count
+        return count
+
+    def end_section(self, key: str, commonfields: dict, section_filename: str):
+        self.writer.mark()
+        super().end_section(key, commonfields, section_filename)
+
+    def discard_section(self):
+        self._buffered_docs -= self.writer.rollback()
+
+    # Encoding and writing only happens on flush, so that's what is measured
+    def _flush(self):
+        if self._buffered_docs == 0:
+            return
+
+        start_time = time.perf_counter()
+        self.writer.flush()
+        self.metrics.record(self._buffered_docs, 0, time.perf_counter() - start_time)
+        self._buffered_docs = 0
+
+def get_index_id_bytes(filename, row_num = 0):
+    return base64.urlsafe_b64encode(mmh3.hash_bytes(filename + str(row_num))).rstrip(b"=")
+
+def encode_bulk_action(index, id):
+    return b'{"index":{"_index":"' + index + b'","_id":"' + id + b'"}}\n'
+
+# Bounded by the size of the queued items instead of their count, logs vary from few kb to dozens of mb
+class ByteBoundedQueue:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._items = deque()
+        self._cond = Condition()
+
+    def put(self, item, size):
+        with self._cond:
+            # An item bigger than the limit is still accepted when the queue is empty
+            self._cond.wait_for(lambda: self.bytes == 0 or self.bytes + size <= self.max_bytes)
+            self._items.append((item, size))
+            self.bytes += size
+            self._cond.notify_all()
+
+    def get(self):
+        with self._cond:
+            self._cond.wait_for(lambda: len(self._items) > 0)
+            item, size = self._items.popleft()
+            self.bytes -= size
+            self._cond.notify_all()
+            return item
+
+# Docs per bulk request, steered towards a target request latency
+class AdaptiveChunkSize:
+    def __init__(self, initial: int = 5000, *, min: int = 500, max: int = 50_000, target_seconds: float = 1.0, smoothing: float = 0.2):
+        self.min = min
+        self.max = max
+        self.target_seconds = target_seconds
+        self.smoothing = smoothing
+        self._value = float(initial)
+        self._lock = Lock()
+
+    @property
+    def value(self) -> int:
+        return int(self._value)
+
+    def observe(self, docs: int, seconds: float):
+        # Small tail chunks are dominated by the request overhead and would drag the size down
+        if docs < self._value / 4 or seconds <= 0:
+            return
+
+        ideal = docs * self.target_seconds / seconds
+        with self._lock:
+            value = self._value + self.smoothing * (ideal - self._value)
+            self._value = min(self.max, max(self.min, value))
+
+    # Cluster is rejecting work, back off quickly
+    def shrink(self):
+        with self._lock:
+            self._value = max(self.min, self._value / 2)
+
+class Backoff:
+    def __init__(self, retries: int = 5, base_seconds: float = 0.5, max_seconds: float = 30.0):
+        self.retries = retries
+        self.base_seconds = base_seconds
+        self.max_seconds = max_seconds
+
+    # Exponential with jitter, so the sender threads don't retry in lockstep
+    def delays(self):
+        for attempt in range(self.retries):
+            yield min(self.max_seconds, self.base_seconds * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+class ElasticsearchSink(LogSink):
+    name = "elasticsearch"
+
+    RETRY_STATUSES = {429, 502, 503, 504}
+
+    def __init__(self, client, *, threads: int = 8, queue_bytes: int = 64 * 1024 * 1024, chunk_size: AdaptiveChunkSize = None,
+                    backoff: Backoff = None, logs_index: str = "voting-machine-logs", logfiles_index: str = "voting-machine-logfiles",
+                    on_done: Optional[OnDone] = None):
+        super().__init__(on_done)
+        self.client = client
+        self.chunk_size = chunk_size or AdaptiveChunkSize()
+        self.backoff = backoff or Backoff()
+        self.logs_index = logs_index.encode()
+        self.logfiles_index = logfiles_index.encode()
+
+        self._queue = ByteBoundedQueue(queue_bytes)
+        self._lock = Condition()
+        self._inflight = 0
+        # Sections are written one at a time, chunks hold a reference to their section entry
+        self._current = self._new_entry()
+        # Last log read of each section, the logfile doc id comes from it
+        self._last_filename = None
+
+        self._senders = [Thread(target=self._send_thread, daemon=True) for _ in range(threads)]
+        for sender in self._senders:
+            sender.start()
+
+    def _encode_chunks(self, filename, commonfields, rows):
+        # Common fields are encoded once per log file and spliced into each document
+        common = orjson.dumps(commonfields | {
+            "logfilename": filename,
+            "logtype": get_logtype(filename),
+            "event": { "dataset": "vmlogs" },
+        })[:-1] + b","
+
+        # Logs are in local time, same as astimezone() would use, Brazil has no DST since 2019 so a single offset holds for a file
+        tz = None
+        # Rows of the same second share the timestamp object (see LogTimestampDecoder), so it's converted once
+        last_timestamp = None
+        timestamp = None
+
+        buffer = bytearray()
+        count = 0
+        chunk_docs = self.chunk_size.value
+        for row in rows:
+            if tz is None:
+                tz = timezone(row.timestamp.astimezone().utcoffset())
+
+            if row.timestamp is not last_timestamp:
+                last_timestamp = row.timestamp
+                timestamp = row.timestamp.replace(tzinfo=tz)
+
+            buffer += encode_bulk_action(self.logs_index, get_index_id_bytes(filename, row.number))
+            buffer += common
+            buffer += orjson.dumps({
+                "rownum": row.number,
+                "timestamp": timestamp,
+                "level": row.level,
+                "vm_id": row.vm_id,
+                "app": row.app,
+                "message": row.message,
+                "message_template": row.message_template,
+                "message_params": row.message_params or None,
+                "hash": "%016X" % row.hash,
+            })[1:]
+            buffer += b"\n"
+            count += 1
+
+            if count >= chunk_docs:
+                yield bytes(buffer), count
+                buffer.clear()
+                count = 0
+                chunk_docs = self.chunk_size.value
+
+        if count > 0:
+            yield bytes(buffer), count
+
+    def _put(self, body, count):
+        with self._lock:
+            self._current[0] += 1
+            self._inflight += 1
+
+        self._queue.put((self._current, body, count), len(body))
+
+    def write_log(self, commonfields: dict, filename: str, rows: Iterable[VotingMachineLogProcessor.Row]) -> int:
+        docs = 0
+        for body, count in self._encode_chunks(filename, commonfields, rows):
+            self._put(body, count)
+            docs += count
+
+        self._last_filename = filename
+        return docs
+
+    def end_section(self, key: str, commonfields: dict, section_filename: str):
+        # Last id is from the last read log, kept as is to match already indexed files
+        doc = orjson.dumps(commonfields | {
+            "logfilename": section_filename,
+            "timestamp": datetime.utcnow(),
+            "event": { "dataset": "vmlogfiles" }
+        })
+        body = encode_bulk_action(self.logfiles_index, get_index_id_bytes(self._last_filename or section_filename)) + doc + b"\n"
+        self._put(body, 1)
+
+        entry = self._current
+        with self._lock:
+            entry[1] = True
+            entry[3] = key
+            self._check(entry)
+
+        self._current = self._new_entry()
+        self._last_filename = None
+
+    # Entry: [outstanding chunks, all chunks queued, any failure, section key]
+    @staticmethod
+    def _new_entry():
+        return [0, False, False, None]
+
+    def _check(self, entry):
+        outstanding, sealed, failed, key = entry
+        if not sealed or outstanding > 0:
+            return
+
+        if self.on_done:
+            self.on_done(key, not failed)
+
+    def _bulk(self, body: bytes, count: int) -> int:
+        from elasticsearch import ApiError, TransportError
+
+        delays = self.backoff.delays()
+        while True:
+            retry = False
+            start_time = time.perf_counter()
+            try:
+                # Only the errors are needed back, avoids parsing the whole response
+                res = self.client.bulk(operations=body, filter_path="errors,items.*.error,items.*.status")
+                seconds = time.perf_counter() - start_time
+
+                if not res.get("errors"):
+                    self.metrics.record(count, len(body), seconds)
+                    self.chunk_size.observe(count, seconds)
+                    return 0
+
+                statuses = [op.get("status") for item in res.get("items", []) for op in item.values() if "error" in op]
+                # Rejected by full write queues, the whole chunk is sent again, ids are stable so it's idempotent
+                if len(statuses) > 0 and all(s == 429 for s in statuses):
+                    self.metrics.record(0, 0, seconds)
+                    self.chunk_size.shrink()
+                    retry = True
+                else:
+                    self.metrics.record(count, len(body), seconds)
+                    return len(statuses)
+            except ApiError as ex:
+                if ex.meta.status not in self.RETRY_STATUSES:
+                    raise
+                if ex.meta.status == 429:
+                    self.chunk_size.shrink()
+                retry = True
+            except TransportError:
+                retry = True
+
+            delay = next(delays, None) if retry else None
+            if delay is None:
+                raise RuntimeError(f"Giving up after {self.backoff.retries} retries")
+
+            self.metrics.record_retry()
+            time.sleep(delay)
+
+    def _send_thread(self):
+        logger = logging.getLogger("distributed.worker")
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                # Let the other senders finish too
+                self._queue.put(None, 0)
+                break
+
+            entry, body, count = item
+            key = entry[3] or "current section"
+            try:
+                errors = self._bulk(body, count)
+                if errors > 0:
+                    logger.warning("Failed %d of %d docs of %s", errors, count, key)
+            except Exception as ex:
+                # Never let a sender die, the producer would block on a full queue
+                logger.warning("Failed sending %d docs of %s: %s", count, key, repr(ex))
+                errors = count
+
+            if errors > 0:
+                self.metrics.record_failure(errors)
+
+            with self._lock:
+                entry[0] -= 1
+                entry[2] = entry[2] or errors > 0
+                self._check(entry)
+
+                self._inflight -= 1
+                self._lock.notify_all()
+
+    def flush(self):
+        with self._lock:
+            self._lock.wait_for(lambda: self._inflight == 0)
+
+    def close(self):
+        if self._senders:
+            self.flush()
+            self._queue.put(None, 0)
+            for sender in self._senders:
+                sender.join()
+            self._senders = None
+
+    def get_stats(self) -> dict:
+        return super().get_stats() | { "chunk_docs": self.chunk_size.value }
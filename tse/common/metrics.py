@@ -0,0 +1,131 @@
+import bisect
+import math
+from typing import Callable, Iterable
+
+# Minimal in process metrics rendered in the Prometheus text exposition format (0.0.4), so the crawler can be scraped
+# without extra dependencies, everything runs on the reactor thread so there's no locking
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}    # By label values
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[l]) for l in self.labels)
+
+    @staticmethod
+    def _escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def _format_labels(self, key: tuple, extra: dict = None) -> str:
+        pairs = list(zip(self.labels, key)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+
+        return "{" + ",".join(f'{l}="{self._escape(v)}"' for l, v in pairs) + "}"
+
+    @staticmethod
+    def _format_value(value) -> str:
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+    def clear(self):
+        self._values.clear()
+
+    def samples(self) -> Iterable[str]:
+        for key, value in self._values.items():
+            yield f"{self.name}{self._format_labels(key)} {self._format_value(value)}"
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self.samples()
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    # For counters kept elsewhere (ex: the crawler stats), copied on collect
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels: Iterable[str] = (), buckets: Iterable[float] = ()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            state[0][i] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self) -> Iterable[str]:
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{self._format_labels(key, {'le': self._format_value(float(bound))})} {cumulative}"
+
+            yield f"{self.name}_bucket{self._format_labels(key, {'le': '+Inf'})} {count}"
+            yield f"{self.name}_sum{self._format_labels(key)} {self._format_value(total)}"
+            yield f"{self.name}_count{self._format_labels(key)} {count}"
+
+class MetricsRegistry:
+    CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+        self._collectors: list[Callable[[], None]] = []
+
+    def _add(self, metric: Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Duplicated metric {metric.name}")
+
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()) -> Gauge:
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=()) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    # Called before every render, to update the metrics sampled from elsewhere
+    def add_collector(self, collector: Callable[[], None]):
+        self._collectors.append(collector)
+
+    def render(self) -> bytes:
+        for collector in self._collectors:
+            collector()
+
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+
+        return ("\n".join(lines) + "\n").encode()
@@ -131,6 +131,18 @@ class PathInfo:
     def make_picture_path(self, election):
         return PathInfo.get_picture_path(election, self.state, self.sqcand)
 
+    # Path of an indexed file, some are only known with the metadata stored along (voting machine files, pictures)
+    def make_indexed_path(self, metadata):
+        if self.path:
+            return self.path
+
+        if self.match == "voting_machine" and metadata:
+            return self.make_voting_machine_file_path(metadata["state"], metadata["hash"])
+        elif self.match == "picture" and metadata:
+            return self.make_picture_path(metadata["election"])
+
+        return None
+
     @staticmethod
     def get_local_path(settings, path):
         if path.startswith("comum/"):
@@ -138,6 +150,10 @@ class PathInfo:
 
         return os.path.join(settings["FILES_STORE"], settings["ENVIRONMENT"], settings["CYCLE"], path)
 
+    @staticmethod
+    def get_index_path(settings, spider_name):
+        return os.path.join(settings["FILES_STORE"], settings["ENVIRONMENT"], f"index_{spider_name}_{settings['PLEA']}.db")
+
     @staticmethod
     def get_full_url(settings, path):
         if path.startswith("comum/"):
@@ -145,6 +161,17 @@ class PathInfo:
 
         return os.path.join(f"{settings['HOST']}/{settings['ENVIRONMENT']}/{settings['CYCLE']}", path)
 
+    # Old versions are moved to a .ver dir besides the file, optionally packed later on into its _pack.zip
+    @staticmethod
+    def get_version_path(local_path, version):
+        dirname, filename = os.path.split(local_path)
+        root, ext = os.path.splitext(filename)
+        return os.path.join(dirname, ".ver", f"{root}_{version:04}{ext}")
+
+    @staticmethod
+    def get_version_pack_path(local_path):
+        return os.path.join(os.path.dirname(local_path), ".ver", "_pack.zip")
+
     @staticmethod
     def get_state_index_path(election, state):
         return f"{election}/config/{state}/{state}-e{election:0>6}-i.json"
@@ -169,6 +196,11 @@ class PathInfo:
     def get_sections_config_path(plea, state):
         return f"arquivo-urna/{plea}/config/{state}/{state}-p{plea:0>6}-cs.json"
 
+    # Voting machine files appended into shards (see ShardStore) instead of the section dirs
+    @staticmethod
+    def get_shards_path(plea):
+        return f"arquivo-urna/{plea}/shards"
+
     @staticmethod
     def _get_section_base_path(plea, state, city, zone, section):
         return f"arquivo-urna/{plea}/dados/{state}/{city:0>5}/{zone:0>4}/{section:0>4}"
@@ -0,0 +1,104 @@
+import collections
+import functools
+import inspect
+import os
+import sys
+import threading
+import time
+from typing import Callable
+
+# Cumulative time of the calls by name, nested calls included (ex: parse_file includes its persist_response)
+class CallTimings:
+    def __init__(self):
+        self._timings: dict[str, list] = {}     # By name: [calls, seconds, max seconds]
+
+    def record(self, name, seconds):
+        timing = self._timings.get(name)
+        if timing is None:
+            timing = self._timings[name] = [0, 0.0, 0.0]
+
+        timing[0] += 1
+        timing[1] += seconds
+        if seconds > timing[2]:
+            timing[2] = seconds
+
+    # Generators (most scrapy callbacks) are timed on each step, not counting the time spent by the consumer
+    def wrap(self, name, func: Callable) -> Callable:
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                elapsed = 0.0
+                start_time = time.perf_counter()
+                try:
+                    gen = func(*args, **kwargs)
+                    while True:
+                        try:
+                            item = next(gen)
+                        except StopIteration:
+                            return
+                        finally:
+                            elapsed += time.perf_counter() - start_time
+
+                        yield item
+                        start_time = time.perf_counter()
+                finally:
+                    self.record(name, elapsed)
+
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start_time)
+
+        return wrapper
+
+    # <prefix>/<name>/calls, seconds (cumulative), per_call_ms and max_ms
+    def update_stats(self, stats, prefix="profile"):
+        for name, (calls, seconds, max_seconds) in self._timings.items():
+            stats.set_value(f"{prefix}/{name}/calls", calls)
+            stats.set_value(f"{prefix}/{name}/seconds", round(seconds, 3))
+            stats.set_value(f"{prefix}/{name}/per_call_ms", round(seconds * 1000 / calls, 3))
+            stats.set_value(f"{prefix}/{name}/max_ms", round(max_seconds * 1000, 3))
+
+# Samples the stack of a thread (the reactor one) from another, much cheaper than cProfile on a long crawl, dumped
+# as collapsed stacks, one "frame;frame;... count" per line (as flamegraph.pl, speedscope, etc take)
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id=None, interval=0.005):
+        super().__init__(name="StackSampler", daemon=True)
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.samples = 0
+        self.stacks = collections.Counter()
+        self._stop_event = threading.Event()
+
+    @staticmethod
+    def format_frame(frame) -> str:
+        code = frame.f_code
+        return f"{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}"
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(self.format_frame(frame))
+                frame = frame.f_back
+
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
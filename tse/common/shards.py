@@ -0,0 +1,197 @@
+import datetime
+import logging
+import mmap
+import os
+import struct
+import zlib
+from typing import BinaryIO, Iterable, NamedTuple, Optional
+
+from tse.common.pathinfo import PathInfo
+
+# Where a file is inside a shard, kept along the other metadata of its index entry
+class ShardLocation(NamedTuple):
+    shard: str      # Shard name, relative to the shards dir (ex: sp, or sp-71072 per city)
+    offset: int     # Of the contents
+    size: int
+
+    @classmethod
+    def from_metadata(cls, metadata) -> Optional["ShardLocation"]:
+        if not metadata or "shard" not in metadata:
+            return None
+
+        return cls(metadata["shard"], metadata["offset"], metadata["size"])
+
+    def to_metadata(self) -> dict:
+        return self._asdict()
+
+    @classmethod
+    def strip_metadata(cls, metadata: dict) -> dict:
+        return {k: v for k, v in metadata.items() if k not in cls._fields}
+
+class ShardMember(NamedTuple):
+    filename: str
+    offset: int
+    size: int
+    mtime: int      # Epoch
+    crc32: int
+
+# Append-only shard files for the voting machine files (see URNA_SHARDS), instead of millions of small files and dirs
+# Each member is a header (magic, name length, size, mtime, crc32) followed by its name and contents, the offsets are
+# kept in the index metadata (see ShardLocation), but the shards can also be scanned on their own (see scan)
+# Members are never rewritten, new contents of a file are appended and the index entry moves to them
+# Reads are memory mapped, a view (see view) is a zero copy slice of the shard, release it before close
+class ShardStore:
+    SUFFIX = ".shard"
+    MAGIC = b"TSH1"
+    HEADER = struct.Struct("<4sHIqI")
+
+    # granularity: "state" or "city", None only reads
+    def __init__(self, shards_dir: Optional[str] = None, granularity: Optional[str] = None):
+        if granularity not in (None, "state", "city"):
+            raise ValueError(f"Unknown shard granularity {granularity}")
+
+        self.shards_dir = shards_dir
+        self.granularity = granularity
+
+        self._writers: dict[str, BinaryIO] = {}     # By shard name
+        self._maps: dict[str, mmap.mmap] = {}       # By shard path
+
+    @classmethod
+    def from_settings(cls, settings) -> "ShardStore":
+        return cls(PathInfo.get_local_path(settings, PathInfo.get_shards_path(settings["PLEA"])), settings.get("URNA_SHARDS"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for f in self._writers.values():
+            f.close()
+        self._writers.clear()
+
+        for m in self._maps.values():
+            m.close()
+        self._maps.clear()
+
+    def get_shard_name(self, state, city) -> str:
+        return state if self.granularity == "state" else f"{state}-{city:0>5}"
+
+    @staticmethod
+    def get_shard_state(shard_path) -> str:
+        return os.path.basename(shard_path).split("-")[0].split(".")[0]
+
+    def get_shard_path(self, shard) -> str:
+        return os.path.join(self.shards_dir, shard + self.SUFFIX)
+
+    @classmethod
+    def _read_member(cls, f: BinaryIO, pos: int, size: int) -> Optional[ShardMember]:
+        f.seek(pos)
+        header = f.read(cls.HEADER.size)
+        if len(header) < cls.HEADER.size:
+            return None
+
+        magic, name_size, member_size, mtime, crc32 = cls.HEADER.unpack(header)
+        offset = pos + cls.HEADER.size + name_size
+        if magic != cls.MAGIC or offset + member_size > size:
+            return None
+
+        return ShardMember(f.read(name_size).decode(), offset, member_size, mtime, crc32)
+
+    # Every member in append order, a file replaced later on shows up again, stops at a torn tail
+    @classmethod
+    def scan(cls, shard_path) -> Iterable[ShardMember]:
+        with open(shard_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            pos = 0
+            while pos < size:
+                member = cls._read_member(f, pos, size)
+                if member is None:
+                    logging.warning("Shard %s torn at %d of %d bytes", shard_path, pos, size)
+                    return
+
+                yield member
+                pos = member.offset + member.size
+
+    # A crash midway an append leaves a partial member at the end, never referenced by the index (it's written after)
+    def _recover(self, shard_path):
+        if not os.path.exists(shard_path):
+            return
+
+        end = 0
+        for member in self.scan(shard_path):
+            end = member.offset + member.size
+
+        if end < os.path.getsize(shard_path):
+            logging.warning("Truncating shard %s to %d bytes", shard_path, end)
+            os.truncate(shard_path, end)
+
+    def _get_writer(self, shard) -> BinaryIO:
+        f = self._writers.get(shard)
+        if f is None:
+            shard_path = self.get_shard_path(shard)
+            os.makedirs(self.shards_dir, exist_ok=True)
+            self._recover(shard_path)
+            f = self._writers[shard] = open(shard_path, "ab")
+
+        return f
+
+    # Flushed right away, so the index never points past what readers can see
+    def append(self, state, city, filename, body: bytes, mtime: datetime.datetime) -> ShardLocation:
+        if not self.granularity:
+            raise RuntimeError("Read only shard store")
+
+        shard = self.get_shard_name(state, city)
+        f = self._get_writer(shard)
+
+        name = filename.encode()
+        epoch = int(mtime.replace(tzinfo=datetime.timezone.utc).timestamp())
+        pos = f.tell()
+        f.write(self.HEADER.pack(self.MAGIC, len(name), len(body), epoch, zlib.crc32(body)) + name)
+        f.write(body)
+        f.flush()
+
+        return ShardLocation(shard, pos + self.HEADER.size + len(name), len(body))
+
+    # Remapped when the shard grew past the current map (appended after it was mapped), the old map is left to be
+    # collected along with any view still into it
+    def _get_map(self, shard_path, end) -> mmap.mmap:
+        m = self._maps.get(shard_path)
+        if m is None or len(m) < end:
+            with open(shard_path, "rb") as f:
+                m = self._maps[shard_path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            if len(m) < end:
+                raise ValueError(f"Member at {end} past the end of {shard_path}")
+
+        return m
+
+    def view_at(self, shard_path, offset, size) -> memoryview:
+        return memoryview(self._get_map(shard_path, offset + size))[offset:offset + size]
+
+    def view(self, location: ShardLocation) -> memoryview:
+        return self.view_at(self.get_shard_path(location.shard), location.offset, location.size)
+
+    def read(self, location: ShardLocation) -> bytes:
+        with self.view(location) as view:
+            return bytes(view)
+
+    # Header of the member at the location, None if it isn't there (ex: a shard truncated or from another crawl)
+    def get_member(self, location: ShardLocation, filename) -> Optional[ShardMember]:
+        shard_path = self.get_shard_path(location.shard)
+        pos = location.offset - self.HEADER.size - len(filename.encode())
+        if pos < 0 or not os.path.exists(shard_path):
+            return None
+
+        with open(shard_path, "rb") as f:
+            member = self._read_member(f, pos, os.fstat(f.fileno()).st_size)
+
+        if member is None or member.filename != filename or member.offset != location.offset or member.size != location.size:
+            return None
+
+        return member
+
+    @staticmethod
+    def verify(member: ShardMember, view: memoryview) -> bool:
+        return zlib.crc32(view) == member.crc32
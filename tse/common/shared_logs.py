@@ -0,0 +1,87 @@
+import io
+from multiprocessing.shared_memory import SharedMemory
+from typing import Iterable, NamedTuple, Optional
+
+# Decompressed logs handed between processes through a single shared memory block, only the block name
+# and the member offsets are pickled, the readers parse straight from the shared pages
+class SharedLogsBlock(NamedTuple):
+    class Member(NamedTuple):
+        key: str        # Section key the log belongs to
+        filename: str   # Log source name, as returned by read_compressed_logs
+        offset: int
+        size: int
+
+    name: Optional[str]     # None when there's nothing to share
+    size: int
+    members: tuple[Member, ...]
+
+    # Copies the logs into a new block, owned by whoever calls open_block later on
+    @classmethod
+    def pack(cls, logs: list[tuple[str, str, bytes]]) -> "SharedLogsBlock":
+        size = sum(len(data) for _, _, data in logs)
+        if size == 0:
+            return cls(None, 0, tuple(cls.Member(key, filename, 0, 0) for key, filename, _ in logs))
+
+        shm = SharedMemory(create=True, size=size)
+        try:
+            members = []
+            offset = 0
+            for key, filename, data in logs:
+                shm.buf[offset:offset + len(data)] = data
+                members.append(cls.Member(key, filename, offset, len(data)))
+                offset += len(data)
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+
+        shm.close()
+        return cls(shm.name, size, tuple(members))
+
+# Read-only file over a memoryview, so the text decoding reads from the shared pages without an intermediate copy
+class MemoryViewReader(io.RawIOBase):
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), len(self._view) - self._pos)
+        buffer[:size] = self._view[self._pos:self._pos + size]
+        self._pos += size
+        return size
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        super().close()
+
+# Attaches to a block and unlinks it once done, every view handed out must be closed before
+class SharedLogsReader:
+    def __init__(self, block: SharedLogsBlock):
+        self.block = block
+        self._shm = SharedMemory(block.name) if block.name else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def members(self) -> Iterable[tuple[SharedLogsBlock.Member, io.BufferedReader]]:
+        for member in self.block.members:
+            view = self._shm.buf[member.offset:member.offset + member.size] if self._shm else memoryview(b"")
+            yield member, io.BufferedReader(MemoryViewReader(view))
+
+    def close(self):
+        if self._shm:
+            try:
+                self._shm.close()
+            except BufferError:
+                # A log wasn't fully read (ex: failed section), the mapping goes away with the last view
+                pass
+            self._shm.unlink()
+            self._shm = None
@@ -0,0 +1,160 @@
+import gzip
+import os
+from typing import Optional
+
+from tse.common.pathinfo import PathInfo
+
+# At rest encoding of the downloaded files, they're still indexed by their original name and the etag and mtime
+# (set on the stored file) are the same as a raw file would have. Reads find any form, so trees with both are fine
+# and reading .zst files works even with the codec off (zstandard is only imported when needed)
+# Besides the codec, responses can be stored as received, still gzip encoded (see KeepGzipMiddleware)
+class StorageCodec:
+    ZSTD_SUFFIX = ".zst"
+    GZIP_SUFFIX = ".gz"
+
+    ENCODING_SUFFIXES = {"zstd": ZSTD_SUFFIX, "gzip": GZIP_SUFFIX}
+    SUFFIX_ENCODINGS = {v: k for k, v in ENCODING_SUFFIXES.items()}
+
+    # codec: None (raw) or "zstd"
+    # dict_dir: optional trained dictionaries, one per file type (<type>.dict, ex: v.dict), see train_zstd_dicts
+    def __init__(self, codec: Optional[str] = None, level: int = 10, dict_dir: Optional[str] = None, extensions=("json",)):
+        if codec not in (None, "zstd"):
+            raise ValueError(f"Unknown storage codec {codec}")
+
+        self.codec = codec
+        self.level = level
+        self.dict_dir = dict_dir
+        self.extensions = frozenset(extensions)
+
+        self._dicts = None          # By file type
+        self._dicts_by_id = None
+        self._compressors = {}      # By file type
+        self._decompressors = {}    # By dict id
+
+        if codec == "zstd":
+            import zstandard # Fails early if missing
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get("STORAGE_CODEC"), int(settings.get("STORAGE_ZSTD_LEVEL", 10)), settings.get("STORAGE_ZSTD_DICT_DIR"))
+
+    @classmethod
+    def get_encoding(cls, stored_path) -> Optional[str]:
+        return cls.SUFFIX_ENCODINGS.get(os.path.splitext(stored_path)[1])
+
+    @classmethod
+    def strip_suffix(cls, path):
+        return os.path.splitext(path)[0] if cls.get_encoding(path) else path
+
+    # Every stored form of a path, raw first
+    @classmethod
+    def get_stored_paths(cls, local_path) -> list[str]:
+        return [local_path] + [local_path + suffix for suffix in cls.SUFFIX_ENCODINGS]
+
+    @staticmethod
+    def get_file_type(path) -> Optional[str]:
+        try:
+            return PathInfo(os.path.basename(path)).type
+        except ValueError:
+            return None
+
+    def _load_dicts(self):
+        import zstandard
+
+        self._dicts = {}
+        self._dicts_by_id = {}
+        if not self.dict_dir or not os.path.isdir(self.dict_dir):
+            return
+
+        for entry in os.scandir(self.dict_dir):
+            file_type, ext = os.path.splitext(entry.name)
+            if ext != ".dict":
+                continue
+
+            with open(entry.path, "rb") as f:
+                dict_data = zstandard.ZstdCompressionDict(f.read())
+
+            self._dicts[file_type] = dict_data
+            self._dicts_by_id[dict_data.dict_id()] = dict_data
+
+    def encodes(self, local_path) -> bool:
+        return self.codec == "zstd" and os.path.splitext(local_path)[1][1:] in self.extensions
+
+    # Stored file of local_path, raw or encoded, None if there's none
+    def find(self, local_path) -> Optional[str]:
+        for stored_path in self.get_stored_paths(local_path):
+            if os.path.exists(stored_path):
+                return stored_path
+
+        return None
+
+    def encode(self, local_path, body: bytes) -> bytes:
+        import zstandard
+
+        if self._dicts is None:
+            self._load_dicts()
+
+        file_type = self.get_file_type(local_path)
+        compressor = self._compressors.get(file_type)
+        if compressor is None:
+            compressor = self._compressors[file_type] = zstandard.ZstdCompressor(level=self.level,
+                dict_data=self._dicts.get(file_type))
+
+        return compressor.compress(body)
+
+    def decode(self, stored_path, data: bytes) -> bytes:
+        return self.decode_body(self.get_encoding(stored_path), data, stored_path)
+
+    def decode_body(self, encoding: Optional[str], data: bytes, name=None) -> bytes:
+        if encoding is None:
+            return data
+
+        if encoding == "gzip":
+            return gzip.decompress(data)
+
+        import zstandard
+
+        # The frame tells which dictionary it was compressed with, regardless of the current settings
+        dict_id = zstandard.get_frame_parameters(data).dict_id
+        decompressor = self._decompressors.get(dict_id)
+        if decompressor is None:
+            dict_data = None
+            if dict_id:
+                if self._dicts_by_id is None:
+                    self._load_dicts()
+
+                dict_data = self._dicts_by_id.get(dict_id)
+                if dict_data is None:
+                    raise ValueError(f"Missing zstd dictionary {dict_id} for {name}")
+
+            decompressor = self._decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=dict_data)
+
+        return decompressor.decompress(data)
+
+    def read(self, local_path) -> bytes:
+        stored_path = self.find(local_path)
+        if stored_path is None:
+            raise FileNotFoundError(local_path)
+
+        with open(stored_path, "rb") as f:
+            return self.decode(stored_path, f.read())
+
+    # Writes the body, already encoded when encoding is given (stored as is), returns the stored path, the other forms
+    # are removed so reads don't find stale contents
+    def write(self, local_path, body: bytes, encoding: Optional[str] = None) -> str:
+        if encoding:
+            stored_path = local_path + self.ENCODING_SUFFIXES[encoding]
+        elif self.encodes(local_path):
+            stored_path = local_path + self.ZSTD_SUFFIX
+            body = self.encode(local_path, body)
+        else:
+            stored_path = local_path
+
+        with open(stored_path, "wb") as f:
+            f.write(body)
+
+        for stale_path in self.get_stored_paths(local_path):
+            if stale_path != stored_path and os.path.exists(stale_path):
+                os.remove(stale_path)
+
+        return stored_path
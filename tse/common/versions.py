@@ -0,0 +1,102 @@
+import datetime
+import os
+import zipfile
+from typing import NamedTuple, Optional
+
+from tse.common.index import Index
+from tse.common.pathinfo import PathInfo
+from tse.common.storage import StorageCodec
+
+# Contents of any indexed version of a file, the current one from the file local path, older ones from its
+# .ver dir, either loose or packed into the dir _pack.zip (see manage_versions), in any stored form (see StorageCodec)
+class VersionReader:
+    def __init__(self, settings):
+        self.settings = settings
+        self.storage = StorageCodec.from_settings(settings)
+        self._packs: dict[str, zipfile.ZipFile] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for pack in self._packs.values():
+            pack.close()
+        self._packs.clear()
+
+    def get_local_path(self, version: Index.Version) -> str:
+        path = PathInfo(version.filename).make_indexed_path(version.entry.metadata)
+        if not path:
+            raise FileNotFoundError(f"Unknown path for {version.filename}")
+
+        return PathInfo.get_local_path(self.settings, path)
+
+    def get_version_path(self, version: Index.Version) -> str:
+        return PathInfo.get_version_path(self.get_local_path(version), version.version)
+
+    def _get_pack(self, local_path):
+        pack_path = PathInfo.get_version_pack_path(local_path)
+
+        pack = self._packs.get(pack_path)
+        if pack is None and os.path.exists(pack_path):
+            pack = self._packs[pack_path] = zipfile.ZipFile(pack_path, "r")
+
+        return pack
+
+    def read(self, version: Index.Version) -> bytes:
+        local_path = self.get_local_path(version)
+        if version.current:
+            return self.storage.read(local_path)
+
+        ver_path = PathInfo.get_version_path(local_path, version.version)
+        if self.storage.find(ver_path):
+            return self.storage.read(ver_path)
+
+        pack = self._get_pack(local_path)
+        if pack is not None:
+            for name in StorageCodec.get_stored_paths(os.path.basename(ver_path)):
+                try:
+                    return self.storage.decode(name, pack.read(name))
+                except KeyError:
+                    pass
+
+        raise FileNotFoundError(f"Version {version.version} of {version.filename} not found")
+
+# Which old versions to keep, a version is kept if any of the rules keeps it, the current one always is
+class RetentionPolicy(NamedTuple):
+    keep_last: int = 0                                      # The latest N versions of each file
+    bucket: Optional[datetime.timedelta] = None             # The latest version of each index date bucket
+    snapshots: tuple[datetime.datetime, ...] = ()           # The versions current at these index dates (as snapshot_at)
+
+    # Splits the versions of a file (oldest first, as Index.get_versions) into kept and pruned
+    def select(self, versions: list[Index.Version]) -> tuple[list[Index.Version], list[Index.Version]]:
+        keep = {v.version for v in versions if v.current}
+
+        if self.keep_last > 0:
+            keep.update(v.version for v in versions[-self.keep_last:])
+
+        dated = sorted((v for v in versions if v.entry.index_date is not None), 
+            key=lambda v: (v.entry.index_date, v.version))
+
+        if self.bucket:
+            bucket_seconds = int(self.bucket.total_seconds())
+            buckets = {}
+            for v in dated:
+                buckets[Index.to_epoch(v.entry.index_date) // bucket_seconds] = v.version
+            keep.update(buckets.values())
+
+        for ts in self.snapshots:
+            current = None
+            for v in dated:
+                if v.entry.index_date > ts:
+                    break
+                current = v.version
+
+            if current is not None:
+                keep.add(current)
+
+        kept = [v for v in versions if v.version in keep]
+        pruned = [v for v in versions if v.version not in keep]
+        return kept, pruned
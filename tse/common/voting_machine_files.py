@@ -1,3 +1,4 @@
+import array
 import csv
 import datetime
 import io
@@ -52,6 +53,70 @@ class VotingMachineFiles:
 import py7zr
 from tse.common.grok import GrokProcessor
 
+# Decodes the "dd/mm/yyyy hh:mm:ss" log timestamps, rows come in bursts so most share the previous row's second
+class LogTimestampDecoder:
+    _epoch_ordinal = datetime.date(1970, 1, 1).toordinal()
+
+    def __init__(self, maxsize: int = 64):
+        self.maxsize = maxsize
+        # Keeps the last decoded strings, in insertion order, cheaper than moving entries around on each hit
+        self._cache = {}
+        self._days = {}
+        self._last_text = None
+        self._last_value = None
+
+    # strptime is slower, raises ValueError on malformed timestamps
+    @staticmethod
+    def parse(text: str) -> datetime.datetime:
+        return datetime.datetime(int(text[6:10]), int(text[3:5]), int(text[:2]),
+                                    int(text[11:13]), int(text[14:16]), int(text[17:]))
+
+    # Same naive datetime as parse, shared between rows of the same second
+    def decode(self, text: str) -> datetime.datetime:
+        if text == self._last_text:
+            return self._last_value
+
+        value = self._cache.get(text)
+        if value is None:
+            value = self.parse(text)
+            if len(self._cache) >= self.maxsize:
+                del self._cache[next(iter(self._cache))]
+            self._cache[text] = value
+
+        self._last_text = text
+        self._last_value = value
+        return value
+
+    # Seconds since epoch of the naive local time, as if it were UTC, same as the naive datetime timestamps in parquet
+    def decode_epoch(self, text: str) -> int:
+        if len(text) != 19:
+            raise ValueError(f"Invalid timestamp {text!r}")
+
+        date = text[:10]
+        day = self._days.get(date)
+        if day is None:
+            day = self._days[date] = (datetime.date(int(text[6:10]), int(text[3:5]), int(text[:2])).toordinal() - self._epoch_ordinal) * 86400
+
+        # Same ranges as datetime, so the malformed rows dropped by parse are dropped here too
+        hour, minute, second = int(text[11:13]), int(text[14:16]), int(text[17:19])
+        if not (0 <= hour <= 23 and 0 <= minute <= 59 and 0 <= second <= 59):
+            raise ValueError(f"Invalid timestamp {text!r}")
+
+        return day + hour * 3600 + minute * 60 + second
+
+    # Batch mode, runs of the same second are decoded once
+    def decode_epochs(self, texts: Iterable[str]) -> array.array:
+        values = array.array("q")
+        last_text = None
+        last_value = 0
+        for text in texts:
+            if text != last_text:
+                last_value = self.decode_epoch(text)
+                last_text = text
+            values.append(last_value)
+
+        return values
+
 class VotingMachineLogProcessor:
 
     class Row(NamedTuple):
@@ -64,31 +129,127 @@ class VotingMachineLogProcessor:
         message_template: str
         message_params: Optional[Union[dict, list]]
         hash: int
+        message_template_id: int = 0
+
+    # Compact per file alternative to a list of rows: low cardinality fields (and repeated messages) are dictionary coded,
+    # numbers are kept in typed arrays and timestamps as naive epoch seconds
+    class Columns:
+        class Dictionary:
+            __slots__ = ("codes", "values", "_index")
+
+            def __init__(self, typecode: str = "H"):
+                self.codes = array.array(typecode)
+                self.values = []
+                self._index = {}
+
+            def append(self, value):
+                code = self._index.get(value)
+                if code is None:
+                    code = self._index[value] = len(self.values)
+                    self.values.append(value)
+                self.codes.append(code)
+
+            def code(self, value) -> Optional[int]:
+                return self._index.get(value)
+
+            def __len__(self):
+                return len(self.codes)
+
+            def __getitem__(self, index):
+                return self.values[self.codes[index]]
+
+            def __iter__(self):
+                values = self.values
+                return (values[code] for code in self.codes)
+
+        __slots__ = ("source_name", "number", "timestamp", "level", "vm_id", "app", "message", "message_template",
+                        "message_template_id", "message_params", "hash")
+
+        def __init__(self, source_name: str):
+            self.source_name = source_name
+            self.number = array.array("i")
+            self.timestamp = array.array("q")
+            self.level = self.Dictionary()
+            self.vm_id = self.Dictionary()
+            self.app = self.Dictionary()
+            self.message = self.Dictionary("I")
+            self.message_template = self.Dictionary("I")
+            self.message_template_id = array.array("H")
+            self.message_params = []
+            self.hash = array.array("Q")
+
+        def __len__(self):
+            return len(self.number)
+
+        # Same rows parse_log would return
+        def __iter__(self) -> Iterable["VotingMachineLogProcessor.Row"]:
+            epoch = datetime.datetime(1970, 1, 1)
+            last_seconds = None
+            timestamp = None
+            for i, seconds in enumerate(self.timestamp):
+                if seconds != last_seconds:
+                    last_seconds = seconds
+                    timestamp = epoch + datetime.timedelta(seconds=seconds)
+
+                yield VotingMachineLogProcessor.Row(number=self.number[i], timestamp=timestamp, level=self.level[i],
+                    vm_id=self.vm_id[i], app=self.app[i], message=self.message[i], message_template=self.message_template[i],
+                    message_params=self.message_params[i], hash=self.hash[i], message_template_id=self.message_template_id[i])
+
+    # Ids are only read here, new matchers need python -m tse.utils.update_matcher_ids
+    MATCHERS_FILE = "data/voting_machine_logs_matchers.txt"
+    MATCHERS_IDS_FILE = "data/voting_machine_logs_matchers.ids"
 
     _grok_processor: GrokProcessor
+    _timestamp_decoder: LogTimestampDecoder
 
     def __init__(self):
+        self._timestamp_decoder = LogTimestampDecoder()
         self._grok_processor = GrokProcessor({
                                         "NAPI_EXCEPTION": r"N\dapi\d+C.*ExceptionE - \((?:Código \(%{INT:code:int}\))?\) ",
                                         "ST_ERROR": r"St\d{2}.+?_error - \(\) "
-                                    }).load_matchers_from_file("data/voting_machine_logs_matchers.txt")
+                                    }).load_matchers_from_file(self.MATCHERS_FILE, ids_file=self.MATCHERS_IDS_FILE)
+
+    def get_param_types(self) -> dict[str, str]:
+        return self._grok_processor.get_param_types()
+
+    # Stable template ids, 0 is used for messages that don't match any template
+    def get_template_schemas(self) -> dict[int, tuple[tuple[str, str], ...]]:
+        return self._grok_processor.get_template_schemas()
+
+    # Template id -> matcher source line
+    def get_templates(self) -> dict[int, str]:
+        return self._grok_processor.get_templates()
+
+    def match_template(self, message: str) -> Tuple[int, Optional[tuple]]:
+        return self._grok_processor.match_template(message)
 
-    def read_compressed_logs(self, file: Union[BinaryIO, str, os.PathLike], source_name: str = None) ->  Iterable[Tuple[str, BinaryIO]]:
+    # Doesn't need the grok processor, so it can also be used by processes that only decompress
+    @classmethod
+    def read_compressed_logs(cls, file: Union[BinaryIO, str, os.PathLike], source_name: str = None) ->  Iterable[Tuple[str, BinaryIO]]:
         if not source_name and isinstance(file, str):
             source_name = os.path.relpath(file)
 
         with py7zr.SevenZipFile(file, 'r', mp = False) as zip:
-            for filename, bio in zip.readall().items():
-                if os.path.splitext(filename)[1] == ".jez":
-                    yield from self.read_compressed_logs(bio, os.path.join(source_name, filename))
-                    continue
+            # Only decompress the wanted members, the archive also carries other files we don't use
+            targets = [f for f in zip.getnames() if f == "logd.dat" or os.path.splitext(f)[1] == ".jez"]
+
+            # One member at a time, in archive order, a nested contingency archive is only read when iterated into
+            # The archive stays open in between, each read after the first starts over from a reset
+            for i, filename in enumerate(targets):
+                if i > 0:
+                    zip.reset()
 
-                if filename != "logd.dat":
+                bio = zip.read([filename]).get(filename)
+                if bio is None:
                     continue
 
-                yield (source_name, bio)
+                if filename == "logd.dat":
+                    yield (source_name, bio)
+                else:
+                    yield from cls.read_compressed_logs(bio, os.path.join(source_name, filename))
 
-    def parse_log(self, bio: BinaryIO, source_name: str, *, pos_msg_params: bool = False) ->  Iterable[Row]:
+    # Yields (row number, timestamp, fields, hash, template id, template, params) of the valid rows
+    def _read_rows(self, bio: BinaryIO, source_name: str, decode_timestamp, pos_msg_params: bool):
         with io.TextIOWrapper(bio, encoding="latin_1", newline="") as wrapper:
             try:
                 reader = csv.reader(wrapper, delimiter="\t")
@@ -107,18 +268,37 @@ class VotingMachineLogProcessor:
                         except ValueError:
                             raise ValueError("Malformed hash")
 
-                        # strptime is slower
-                        # dd/mm/yyyy hh:mm:ss
-                        dt = row[0]
-                        timestamp = ((datetime.datetime( 
-                                int(dt[6:10]), int(dt[3:5]), int(dt[:2]),
-                                int(dt[11:13]), int(dt[14:16]), int(dt[17:]))))
+                        timestamp = decode_timestamp(row[0])
 
-                        message_template, message_params = self._grok_processor.match(row[4], pos_msg_params=pos_msg_params)
-                        yield VotingMachineLogProcessor.Row(number=row_number, timestamp=timestamp, level=row[1], vm_id=row[2], app=row[3], 
-                            message=row[4], message_template=message_template, message_params=message_params, hash=hash)
+                        message_template_id, message_template, message_params = self._grok_processor.match_with_id(row[4], pos_msg_params=pos_msg_params)
+                        yield row_number, timestamp, row, hash, message_template_id, message_template, message_params
                     except ValueError as ex:
                         logging.warning("Error reading %s @ %d: %s", source_name, row_number, repr(ex))
                         continue
             except csv.Error as ex:
                 logging.warning("Invalid file %s: %s", source_name, repr(ex))
+
+    def parse_log(self, bio: BinaryIO, source_name: str, *, pos_msg_params: bool = False) ->  Iterable[Row]:
+        for row_number, timestamp, row, hash, message_template_id, message_template, message_params in \
+                self._read_rows(bio, source_name, self._timestamp_decoder.decode, pos_msg_params):
+            yield VotingMachineLogProcessor.Row(number=row_number, timestamp=timestamp, level=row[1], vm_id=row[2], app=row[3], 
+                message=row[4], message_template=message_template, message_params=message_params, hash=hash,
+                message_template_id=message_template_id)
+
+    def parse_log_columns(self, bio: BinaryIO, source_name: str, *, pos_msg_params: bool = False) -> Columns:
+        columns = VotingMachineLogProcessor.Columns(source_name)
+
+        for row_number, timestamp, row, hash, message_template_id, message_template, message_params in \
+                self._read_rows(bio, source_name, self._timestamp_decoder.decode_epoch, pos_msg_params):
+            columns.number.append(row_number)
+            columns.timestamp.append(timestamp)
+            columns.level.append(row[1])
+            columns.vm_id.append(row[2])
+            columns.app.append(row[3])
+            columns.message.append(row[4])
+            columns.message_template.append(message_template)
+            columns.message_template_id.append(message_template_id)
+            columns.message_params.append(message_params)
+            columns.hash.append(hash)
+
+        return columns
@@ -0,0 +1,126 @@
+from typing import Iterable
+
+import numpy as np
+import pyarrow as pa
+
+from tse.common.voting_machine_files import VotingMachineLogProcessor
+
+# Per section voting activity from the logs, one row per section, computed from the template ids and timestamps of the
+# columnar logs (all the voting machines of the section, including contingency ones, are summed up)
+class VotingTimeline:
+    # Messages without parameters aren't grok templates, they're matched verbatim
+    VOTE_MESSAGE = "O voto do eleitor foi computado"
+
+    # Matcher source lines, resolved to their stable template ids
+    CONFIRMATION_TEMPLATE = "Voto confirmado para [%{DATA:position}]"
+    IDLE_TEMPLATE = "Eleitor sem atividade por %{POSINT:idle_time:int} segundos"
+    BIOMETRIC_FAILURE_TEMPLATES = (
+        "Digital capturada não corresponde a digital do eleitor: Polegar Direito [score %{INT:rt_score:int}], Polegar Esquerdo [score %{INT:lt_score:int}], Indicador Direito [score %{INT:rp_score:int}], Indicador Esquerdo [score %{INT:lp_score:int}]",
+        "Timeout de reconhecimento do dedo. Tentativa [%{POSINT:cur:int}] de [%{POSINT:tot:int}]",
+    )
+
+    # Gaps between consecutive votes at least this long are counted as idle periods
+    IDLE_GAP_SECONDS = 600
+
+    _dict_string = pa.dictionary(pa.int32(), pa.string())
+
+    schema = pa.schema([
+        ("state", _dict_string),
+        ("city", _dict_string),
+        ("zone", pa.string()),
+        ("section", pa.string()),
+        ("votes", pa.uint32()),
+        ("confirmations", pa.uint32()),
+        ("first_vote", pa.timestamp("s")),
+        ("last_vote", pa.timestamp("s")),
+        ("minute_start", pa.timestamp("s")),                # Minute of the first vote, start of votes_per_minute
+        ("votes_per_minute", pa.list_(pa.uint16())),
+        ("biometric_failures", pa.uint32()),
+        ("idle_events", pa.uint32()),                       # "Eleitor sem atividade" events and their total seconds
+        ("idle_seconds", pa.uint64()),
+        ("idle_gaps", pa.uint32()),                         # Gaps between votes of at least IDLE_GAP_SECONDS
+        ("idle_gap_seconds", pa.uint64()),
+        ("longest_gap_seconds", pa.uint32()),
+    ])
+
+    def __init__(self, templates: dict[int, str]):
+        ids = {source: id for id, source in templates.items()}
+        self.confirmation_id = ids[self.CONFIRMATION_TEMPLATE]
+        self.idle_id = ids[self.IDLE_TEMPLATE]
+        self.biometric_failure_ids = np.array([ids[s] for s in self.BIOMETRIC_FAILURE_TEMPLATES], dtype=np.uint16)
+        self._rows = {f.name: [] for f in self.schema}
+
+    def __len__(self):
+        return len(self._rows["section"])
+
+    @staticmethod
+    def _view(values) -> np.ndarray:
+        return np.frombuffer(values, dtype=values.typecode)
+
+    def add_section(self, keyfields: dict, logs: Iterable[VotingMachineLogProcessor.Columns]):
+        vote_times = []
+        confirmations = 0
+        biometric_failures = 0
+        idle_events = 0
+        idle_seconds = 0
+
+        for columns in logs:
+            if len(columns) == 0:
+                continue
+
+            timestamps = self._view(columns.timestamp)
+            template_ids = self._view(columns.message_template_id)
+
+            vote_code = columns.message.code(self.VOTE_MESSAGE)
+            if vote_code is not None:
+                vote_times.append(timestamps[self._view(columns.message.codes) == vote_code])
+
+            confirmations += np.count_nonzero(template_ids == self.confirmation_id)
+            biometric_failures += np.count_nonzero(np.isin(template_ids, self.biometric_failure_ids))
+
+            idle = np.flatnonzero(template_ids == self.idle_id)
+            idle_events += len(idle)
+            idle_seconds += sum((columns.message_params[i] or {}).get("idle_time", 0) for i in idle)
+
+        row = {
+            "state": keyfields["state"],
+            "city": keyfields["city"],
+            "zone": keyfields["zone"],
+            "section": keyfields["section"],
+            "votes": 0,
+            "confirmations": confirmations,
+            "first_vote": None,
+            "last_vote": None,
+            "minute_start": None,
+            "votes_per_minute": None,
+            "biometric_failures": biometric_failures,
+            "idle_events": idle_events,
+            "idle_seconds": idle_seconds,
+            "idle_gaps": 0,
+            "idle_gap_seconds": 0,
+            "longest_gap_seconds": None,
+        }
+
+        votes = np.sort(np.concatenate(vote_times)) if len(vote_times) > 0 else np.empty(0, np.int64)
+        if len(votes) > 0:
+            minute_start = votes[0] // 60 * 60
+            gaps = np.diff(votes)
+            idle_gaps = gaps[gaps >= self.IDLE_GAP_SECONDS]
+
+            row["votes"] = len(votes)
+            row["first_vote"] = int(votes[0])
+            row["last_vote"] = int(votes[-1])
+            row["minute_start"] = int(minute_start)
+            row["votes_per_minute"] = np.bincount((votes - minute_start) // 60).astype(np.uint16)
+            row["idle_gaps"] = len(idle_gaps)
+            row["idle_gap_seconds"] = int(idle_gaps.sum())
+            row["longest_gap_seconds"] = int(gaps.max()) if len(gaps) > 0 else 0
+
+        for key, value in row.items():
+            self._rows[key].append(value)
+
+    # Returns the sections added so far and starts over
+    def to_table(self) -> pa.Table:
+        table = pa.Table.from_pydict(self._rows, schema=self.schema)
+        self._rows = {f.name: [] for f in self.schema}
+        return table
@@ -0,0 +1,122 @@
+import io
+import logging
+import os
+import struct
+import sys
+import zipfile
+import zlib
+from typing import BinaryIO
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from tse.common.voting_machine_files import VotingMachineFiles
+
+# Compact listing of the voting machine files inside the transmitted zips, one row per section and file type,
+# picking the contingency preferred file, with enough information to read the member without parsing the zip again
+class ZipManifest:
+    schema = pa.schema([
+        ("zip", pa.dictionary(pa.int32(), pa.string())),
+        ("section", pa.string()),
+        ("type", pa.dictionary(pa.int8(), pa.string())),
+        ("member", pa.string()),
+        ("offset", pa.uint64()),
+        ("compressed_size", pa.uint64()),
+        ("file_size", pa.uint64()),
+    ])
+
+    _local_header = struct.Struct("<4sHHHHHIIIHH")
+
+    @classmethod
+    def scan_zip(cls, path: str) -> pa.Table:
+        zip_name = os.path.basename(path)
+
+        sections = {}
+        with zipfile.ZipFile(path, "r") as zip:
+            for info in zip.infolist():
+                if info.is_dir():
+                    continue
+
+                stem, ext = os.path.splitext(info.filename)
+                if ext[1:] not in VotingMachineFiles.INV_VOTING_MACHINE_FILES_EXTENSIONS:
+                    continue
+
+                sections.setdefault(sys.intern(stem), {})[info.filename] = info
+
+        columns = {f.name: [] for f in cls.schema}
+        for stem, infos in sections.items():
+            for type, member in VotingMachineFiles.get_voting_machine_files_map(infos.keys()).items():
+                info = infos[member]
+                columns["zip"].append(zip_name)
+                columns["section"].append(stem)
+                columns["type"].append(type.name.lower())
+                columns["member"].append(member)
+                columns["offset"].append(info.header_offset)
+                columns["compressed_size"].append(info.compress_size)
+                columns["file_size"].append(info.file_size)
+
+        return pa.Table.from_pydict(columns, schema=cls.schema)
+
+    @staticmethod
+    def _stat_key(path: str) -> dict[bytes, bytes]:
+        stat = os.stat(path)
+        return {b"zip_mtime_ns": str(stat.st_mtime_ns).encode(), b"zip_size": str(stat.st_size).encode()}
+
+    # Cached as one parquet per zip, rebuilt when the zip mtime or size changes
+    @classmethod
+    def load(cls, path: str, cache_dir: str) -> pa.Table:
+        stat_key = cls._stat_key(path)
+        cache_path = os.path.join(cache_dir, os.path.basename(path) + ".parquet")
+
+        try:
+            metadata = pq.read_schema(cache_path).metadata or {}
+            if all(metadata.get(k) == v for k, v in stat_key.items()):
+                return pq.read_table(cache_path).replace_schema_metadata(None)
+        except FileNotFoundError:
+            pass
+
+        logging.info("Building manifest for %s", os.path.basename(path))
+        table = cls.scan_zip(path)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = cache_path + ".tmp"
+        pq.write_table(table.replace_schema_metadata(stat_key), tmp_path, compression="zstd")
+        os.replace(tmp_path, cache_path)
+
+        return table
+
+    @classmethod
+    def load_dir(cls, dir: str, cache_dir: str = None) -> pa.Table:
+        cache_dir = cache_dir or os.path.join(dir, ".manifest")
+
+        tables = []
+        for entry in sorted(os.scandir(dir), key=lambda e: e.name):
+            if not entry.is_file() or entry.name.startswith(".") or os.path.splitext(entry.name)[1] != ".zip":
+                continue
+
+            tables.append(cls.load(entry.path, cache_dir))
+
+        return pa.concat_tables(tables) if tables else cls.schema.empty_table()
+
+    # Reads a member straight from its local header offset, skipping the central directory parsing done by zipfile.ZipFile
+    @classmethod
+    def read_member(cls, file: BinaryIO, offset: int, compressed_size: int) -> bytes:
+        file.seek(offset)
+        header = file.read(cls._local_header.size)
+        signature, _, _, method, _, _, _, _, _, name_len, extra_len = cls._local_header.unpack(header)
+        if signature != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f"Bad local header at {offset}")
+
+        file.seek(name_len + extra_len, io.SEEK_CUR)
+        data = file.read(compressed_size)
+
+        if method == zipfile.ZIP_STORED:
+            return data
+        elif method == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -15)
+
+        raise NotImplementedError(f"Unsupported compression method {method}")
+
+    @classmethod
+    def open_member(cls, file: BinaryIO, offset: int, compressed_size: int) -> BinaryIO:
+        return io.BytesIO(cls.read_member(file, offset, compressed_size))
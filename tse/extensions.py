@@ -1,8 +1,21 @@
+import cProfile
+import datetime
 import logging
+import os
+import pstats
+import time
+import urllib.parse
 
 from scrapy import signals
 from scrapy.exceptions import NotConfigured
-from twisted.internet import task
+from twisted.internet import reactor, task
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from tse.common.metrics import MetricsRegistry
+from tse.common.pathinfo import PathInfo
+from tse.common.profiling import CallTimings, StackSampler
+from tse.signals import index_opened
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +49,12 @@ class LogStatsDivulga:
         logger.info("Divulga - pending: %(pending)d, dupes: %(dupes)d, skipped_dupes: %(skipped_dupes)d, bumped: %(bumped)d, reindexes: %(reindexes)d", 
             {"pending": pending, "dupes": dupes, "skipped_dupes": skipped_dupes, "bumped": bumped, "reindexes": reindexes}, 
             extra={"spider": spider})
+
+        if hasattr(spider, "freshness"):
+            spider.freshness.update_stats(self.stats)
+            line = spider.freshness.format_line()
+            if line:
+                logger.info("Divulga freshness - %s", line, extra={"spider": spider})
         return
 
     def spider_closed(self, spider, reason):
@@ -82,4 +101,246 @@ class LogStatsUrna:
 
     def spider_closed(self, spider, reason):
         if self.task and self.task.running:
-            self.task.stop()            
\ No newline at end of file
+            self.task.stop()
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, registry: MetricsRegistry):
+        super().__init__()
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type", MetricsRegistry.CONTENT_TYPE)
+        return self.registry.render()
+
+# Serves the crawler metrics to be scraped by Prometheus at http://METRICS_HOST:METRICS_PORT/metrics, from the reactor
+# itself, the rates are also there as gauges over the last METRICS_RATE_INTERVAL for a quick look without Prometheus
+class PrometheusMetrics:
+    LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0)
+    INDEX_OP_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    # Stats with a per second rate gauge, by rate name
+    RATE_STATS = {
+        "bytes": "downloader/response_bytes",
+        "responses": "downloader/response_count",
+        "not_modified": "downloader/response_status_count/304",
+        "dupes": "divulga/dupes",
+        "skipped_dupes": "divulga/skipped_dupes",
+        "bumped": "divulga/bumped",
+        "reindexes": "divulga/reindexes",
+        "voting_machine_files": "urna/processed_voting_machine_files",
+    }
+
+    def __init__(self, crawler, host, port, rate_interval=10.0):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.host = host
+        self.port = port
+        self.rate_interval = rate_interval
+
+        self.spider = None
+        self.index = None
+        self.listener = None
+        self.task = None
+        self._last_rates = None
+
+        registry = self.registry = MetricsRegistry()
+        self.latency = registry.histogram("tse_request_latency_seconds", "Download latency by file type", ("type",), self.LATENCY_BUCKETS)
+        self.responses = registry.counter("tse_responses_total", "Responses by file type and status", ("type", "status"))
+        self.response_bytes = registry.counter("tse_response_bytes_total", "Response body bytes (as received) by file type", ("type",))
+        self.not_modified_ratio = registry.gauge("tse_not_modified_ratio", "Share of 304 responses since the start")
+        self.rates = registry.gauge("tse_rate_per_second", "Per second rates over the last interval", ("rate",))
+        self.queue_depth = registry.gauge("tse_queue_depth", "Requests waiting in the scheduler, in the downloader and files pending", ("queue",))
+        self.state_age = registry.gauge("tse_state_index_age_seconds", "Seconds since the state index was last parsed", ("state",))
+        self.state_lag = registry.gauge("tse_state_index_lag_seconds", 
+            "Latest file date published in the state index minus the latest persisted one", ("state",))
+        self.index_ops = registry.histogram("tse_index_op_seconds", "Index (sqlite) operations time", ("op",), self.INDEX_OP_BUCKETS)
+        self.crawler_stats = registry.gauge("tse_stat", "Numeric crawler stats", ("stat",))
+        registry.add_collector(self.collect)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        port = crawler.settings.getint("METRICS_PORT")
+        if not port:
+            raise NotConfigured
+
+        o = cls(crawler, crawler.settings.get("METRICS_HOST", "127.0.0.1"), port, crawler.settings.getfloat("METRICS_RATE_INTERVAL", 10.0))
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(o.response_received, signal=signals.response_received)
+        crawler.signals.connect(o.index_opened, signal=index_opened)
+        return o
+
+    def spider_opened(self, spider):
+        self.spider = spider
+
+        root = Resource()
+        root.putChild(b"metrics", MetricsResource(self.registry))
+        self.listener = reactor.listenTCP(self.port, Site(root), interface=self.host)
+        logger.info("Metrics at http://%s:%d/metrics", self.host, self.listener.getHost().port)
+
+        self.task = task.LoopingCall(self.update_rates)
+        self.task.start(self.rate_interval)
+
+    def spider_closed(self, spider, reason):
+        if self.task and self.task.running:
+            self.task.stop()
+
+        if self.index is not None:
+            self.index.observers.remove(self.observe_index_op)
+            self.index = None
+
+        if self.listener:
+            self.listener.stopListening()
+            self.listener = None
+
+    def index_opened(self, index, spider):
+        self.index = index
+        index.observers.append(self.observe_index_op)
+
+    def observe_index_op(self, op, seconds):
+        self.index_ops.observe(seconds, op=op)
+
+    @staticmethod
+    def get_file_type(url):
+        try:
+            info = PathInfo(os.path.basename(urllib.parse.urlparse(url).path))
+        except ValueError:
+            return "other"
+
+        return info.type or info.ext or "other"
+
+    def response_received(self, response, request, spider):
+        file_type = self.get_file_type(response.url)
+        self.responses.inc(type=file_type, status=response.status)
+        self.response_bytes.inc(len(response.body), type=file_type)
+
+        latency = request.meta.get("download_latency")
+        if latency is not None:
+            self.latency.observe(latency, type=file_type)
+
+    def update_rates(self):
+        now = time.monotonic()
+        values = {name: self.stats.get_value(stat, 0) for name, stat in self.RATE_STATS.items()}
+
+        if self._last_rates:
+            last_time, last_values = self._last_rates
+            elapsed = max(now - last_time, 1e-6)
+            for name, value in values.items():
+                self.rates.set((value - last_values[name]) / elapsed, rate=name)
+
+        self._last_rates = (now, values)
+
+    def collect(self):
+        responses = self.stats.get_value("downloader/response_count", 0)
+        not_modified = self.stats.get_value("downloader/response_status_count/304", 0)
+        self.not_modified_ratio.set(not_modified / responses if responses else 0.0)
+
+        self.crawler_stats.clear()
+        for stat, value in self.stats.get_stats().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.crawler_stats.set(value, stat=stat)
+
+        # The engine slot went private in newer scrapy versions
+        engine = self.crawler.engine
+        slot = (engine._slot if hasattr(engine, "_slot") else engine.slot) if engine else None
+        if slot:
+            self.queue_depth.set(len(slot.scheduler), queue="scheduler")
+            self.queue_depth.set(len(engine.downloader.active), queue="downloader")
+
+        if hasattr(self.spider, "pending"):
+            self.queue_depth.set(len(self.spider.pending), queue="pending")
+
+        now = time.time()
+        for state, freshness in getattr(self.spider, "state_freshness", {}).items():
+            if freshness.checked is not None:
+                self.state_age.set(now - freshness.checked, state=state)
+            if freshness.published and freshness.persisted:
+                self.state_lag.set(max((freshness.published - freshness.persisted).total_seconds(), 0.0), state=state)
+
+
+# Times the spider methods in PROFILE_METHODS (callbacks, persist_response, etc) and the index operations into the
+# stats (profile/<method>/..., profile/index.<op>/...), with PROFILE_DUMP "cprofile" (every call, slow) or "sampling"
+# (the reactor stack every PROFILE_SAMPLE_INTERVAL) a profile of the whole crawl is also dumped to PROFILE_DIR on close
+class CallbackProfiler:
+    def __init__(self, stats, methods, dump=None, dump_dir="data/profiles", sample_interval=0.005, interval=60.0):
+        if dump not in (None, "cprofile", "sampling"):
+            raise ValueError(f"Unknown profile dump {dump}")
+
+        self.stats = stats
+        self.methods = methods
+        self.dump = dump
+        self.dump_dir = dump_dir
+        self.sample_interval = sample_interval
+        self.interval = interval
+
+        self.timings = CallTimings()
+        self.index = None
+        self.profiler = None
+        self.sampler = None
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("PROFILE_CALLBACKS"):
+            raise NotConfigured
+
+        o = cls(crawler.stats, crawler.settings.getlist("PROFILE_METHODS"), crawler.settings.get("PROFILE_DUMP"),
+            crawler.settings.get("PROFILE_DIR", "data/profiles"), crawler.settings.getfloat("PROFILE_SAMPLE_INTERVAL", 0.005),
+            crawler.settings.getfloat("LOGSTATS_INTERVAL") or 60.0)
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(o.index_opened, signal=index_opened)
+        return o
+
+    # Wrapped on the instance, before the first start request, so every request made takes the wrapped callbacks
+    def spider_opened(self, spider):
+        for name in self.methods:
+            method = getattr(spider, name, None)
+            if method is not None:
+                setattr(spider, name, self.timings.wrap(name, method))
+
+        if self.dump == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.dump == "sampling":
+            self.sampler = StackSampler(interval=self.sample_interval)
+            self.sampler.start()
+
+        self.task = task.LoopingCall(self.timings.update_stats, self.stats)
+        self.task.start(self.interval, now=False)
+
+    def index_opened(self, index, spider):
+        self.index = index
+        index.observers.append(self.observe_index_op)
+
+    def observe_index_op(self, op, seconds):
+        self.timings.record(f"index.{op}", seconds)
+
+    def spider_closed(self, spider, reason):
+        if self.task and self.task.running:
+            self.task.stop()
+
+        if self.index is not None:
+            self.index.observers.remove(self.observe_index_op)
+            self.index = None
+
+        self.timings.update_stats(self.stats)
+
+        if self.profiler or self.sampler:
+            os.makedirs(self.dump_dir, exist_ok=True)
+            path = os.path.join(self.dump_dir, f"{spider.name}-{datetime.datetime.now():%Y%m%d-%H%M%S}")
+
+        if self.profiler:
+            self.profiler.disable()
+            self.profiler.dump_stats(path + ".prof")
+            with open(path + ".txt", "w", encoding="utf-8") as f:
+                pstats.Stats(self.profiler, stream=f).sort_stats("cumulative").print_stats(100)
+            logger.info("Profile dumped to %s.prof", path)
+
+        if self.sampler:
+            self.sampler.stop()
+            self.sampler.dump(path + ".folded")
+            logger.info("Profile of %d samples dumped to %s.folded", self.sampler.samples, path)
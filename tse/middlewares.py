@@ -1,13 +1,18 @@
 from __future__ import absolute_import, division, unicode_literals
 
 import logging
+import re
+import time
 from scrapy.downloadermiddlewares.retry import RetryMiddleware
+from scrapy.exceptions import NotConfigured
 from scrapy.utils.response import response_status_message
 
 import twisted.internet.task
 from twisted.internet import reactor
 
 DELAY_META = '__defer_delay'
+KEPT_ENCODING_META = '__kept_encoding'
+SENT_TIME_META = '__sent_time'
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +30,39 @@ class DeferMiddleware(object):
 
         return twisted.internet.task.deferLater(reactor, delay, lambda: None)
 
+# Stamps when a request is handed to the downloader, placed after the other middlewares so their delays (deferred and
+# retried requests) are behind it, stamped again on every attempt, the downloader slot wait and the transfer come after it
+class SentTimeMiddleware(object):
+    def process_request(self, request, spider):
+        request.meta[SENT_TIME_META] = time.time()
+
+# Keeps gzip responses as received for the urls matching KEEP_GZIP_PATTERN, placed before HttpCompressionMiddleware (590)
+# on the response path it drops the header so that one doesn't decompress them, the encoding goes in the meta
+# for persist_response, which stores them still compressed, decompression only happens when the contents are read
+class KeepGzipMiddleware(object):
+    ENCODINGS = ([b"gzip"], [b"x-gzip"])
+
+    def __init__(self, pattern):
+        self.pattern = re.compile(pattern) if pattern else None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("KEEP_GZIP_RESPONSES"):
+            raise NotConfigured
+
+        return cls(crawler.settings.get("KEEP_GZIP_PATTERN"))
+
+    def process_response(self, request, response, spider):
+        if request.method == "HEAD" or (self.pattern and not self.pattern.search(request.url)):
+            return response
+
+        if [e.lower() for e in response.headers.getlist("Content-Encoding")] not in self.ENCODINGS:
+            return response
+
+        del response.headers["Content-Encoding"]
+        request.meta[KEPT_ENCODING_META] = "gzip"
+        return response
+
 # TODO: Allow bursting
 # https://docs.aws.amazon.com/waf/latest/developerguide/waf-rule-statement-type-rate-based.html 
 class TooManyRequestsRetryMiddleware(RetryMiddleware):
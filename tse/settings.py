@@ -34,6 +34,8 @@ DOWNLOADER_MIDDLEWARES = {
     'scrapy.downloadermiddlewares.useragent.UserAgentMiddleware': None,    
     'scrapy.downloadermiddlewares.retry.RetryMiddleware': None,
     'tse.middlewares.TooManyRequestsRetryMiddleware': 432,
+    'tse.middlewares.KeepGzipMiddleware': 595,
+    'tse.middlewares.SentTimeMiddleware': 990,
 }
 
 # Where to put downloaded files
@@ -69,6 +71,53 @@ DOWNLOAD_PICTURES = True
 # Keep backups of files when overwritten (at .ver directories)
 KEEP_OLD_VERSIONS = True
 
+# At rest compression of the downloaded json files, "zstd" stores them as .json.zst,
+# reading handles both forms, so it can be switched on an existing tree
+STORAGE_CODEC = None
+STORAGE_ZSTD_LEVEL = 10
+
+# Optional dir of trained zstd dictionaries per file type (<type>.dict), see tse.utils.train_zstd_dicts
+STORAGE_ZSTD_DICT_DIR = None
+
+# Store the gzip encoded responses of the files matching the pattern as received (.gz), they're only decompressed when
+# parsed (ex: index and fixed files), files only archived (ex: variable results) never are, takes over STORAGE_CODEC
+KEEP_GZIP_RESPONSES = False
+KEEP_GZIP_PATTERN = r"-(f|v|i)\.json$"
+
+# Append the voting machine files into shard files, one per "state" or "city", at arquivo-urna/<plea>/shards instead of
+# millions of loose files, their offsets go in the index metadata (see ShardStore), tse.utils.export_shards undoes it
+URNA_SHARDS = None
+
+# Serves the crawler metrics at http://METRICS_HOST:METRICS_PORT/metrics for Prometheus (latencies by file type,
+# rates, queues, index freshness and operation timings), off when None
+METRICS_PORT = None
+METRICS_HOST = "127.0.0.1"
+METRICS_RATE_INTERVAL = 10.0
+
+# Hours from UTC of the index dates (TSE publishes in Brasília time), to measure the publication to disk latency
+# of the divulga files (see FreshnessTracker), over the latest FRESHNESS_WINDOW files of each type and state
+INDEX_DATE_UTC_OFFSET = -3
+FRESHNESS_WINDOW = 1000
+
+# Times the spider methods below and the index operations into the stats (profile/...), PROFILE_DUMP also dumps 
+# a profile of the crawl to PROFILE_DIR on close, "cprofile" (.prof, exact but slows the crawl down) or "sampling"
+# (.folded collapsed stacks, for flame graphs)
+PROFILE_CALLBACKS = False
+PROFILE_METHODS = [
+    "parse_config", "parse_index", "parse_file", "parse_picture", "parse_section_config", "parse_section", 
+    "parse_voting_machine_file", "parse_sigfile", "persist_response", "persist_to_shard", "make_request",
+    "get_valid_index_entry", "write_result_file", "archive_version",
+]
+PROFILE_DUMP = None
+PROFILE_DIR = "data/profiles"
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# Index database memory mapped bytes, shared with the read-only handles (Index.open_readonly) through the page cache
+INDEX_MMAP_SIZE = 256 * 1024 * 1024
+
+# Seconds between index WAL checkpoints while crawling
+INDEX_CHECKPOINT_INTERVAL = 30.0
+
 # Optional regex to filter filenames to narrow scope
 
 # Examples
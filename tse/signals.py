@@ -0,0 +1,4 @@
+# Signals sent by the spiders besides the scrapy ones (https://docs.scrapy.org/en/latest/topics/signals.html)
+
+# The spider index is open, after the spider is (it's opened on the first start request), args: index, spider
+index_opened = object()
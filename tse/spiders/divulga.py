@@ -2,14 +2,17 @@ import datetime
 import orjson
 import logging
 import os
+import time
+from typing import NamedTuple
 
 from scrapy.downloadermiddlewares.retry import get_retry_request
 from scrapy.spidermiddlewares.httperror import HttpError
 
 from tse.common.index import Index
 from tse.common.basespider import BaseSpider
+from tse.common.freshness import FreshnessTracker
 from tse.common.pathinfo import PathInfo
-from tse.middlewares import defer_request
+from tse.middlewares import SENT_TIME_META, defer_request
 from tse.parsers import FixedParser, IndexParser
 
 
@@ -17,17 +20,30 @@ class DivulgaSpider(BaseSpider):
     name = "divulga"
 
     custom_settings = {
+        # Replaces the project EXTENSIONS
         "EXTENSIONS": {
             'tse.extensions.LogStatsDivulga': 543,
+            'tse.extensions.PrometheusMetrics': 500,
+            'tse.extensions.CallbackProfiler': 501,
         }
     }
 
+    # Per state, the latest file date published in its index and persisted, and when the index was last parsed
+    class StateFreshness(NamedTuple):
+        published: datetime.datetime = None
+        persisted: datetime.datetime = None
+        checked: float = None       # Epoch
+
     def __init__(self, continuous=False, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.continuous = continuous
+        self.state_freshness: dict[str, DivulgaSpider.StateFreshness] = {}
+        self.freshness = FreshnessTracker()
 
     def continue_requests(self, config_data):
         self.pending = dict()
+        self.freshness = FreshnessTracker(self.settings.getfloat("INDEX_DATE_UTC_OFFSET", -3.0), 
+            self.settings.getint("FRESHNESS_WINDOW", 1000))
 
         for election in self.elections:
             logging.info("Scheduling election: %s", election)
@@ -100,6 +116,7 @@ class DivulgaSpider(BaseSpider):
 
         size = 0
         added = 0
+        published = None
 
         transferring = self.crawler.engine.downloader.slots[response.meta["download_slot"]].transferring
 
@@ -113,6 +130,9 @@ class DivulgaSpider(BaseSpider):
             if self.ignore_pattern and self.ignore_pattern.match(info.filename):
                 continue
 
+            if not published or new_index_date > published:
+                published = new_index_date
+
             index_entry = self.index.get(info.filename)
             if index_entry and index_entry.index_date and new_index_date <= index_entry.index_date:
                 continue
@@ -127,12 +147,14 @@ class DivulgaSpider(BaseSpider):
                     in_transfer = next(filter(find_req, transferring), None)
                     if in_transfer == None:
                         self.pending[info.filename] = new_index_date
+                        self.freshness.schedule(info.filename)
                         logging.debug("Bumped date for %s to [%s > %s]", info.filename, self.pending[info.filename], new_index_date)
                         self.crawler.stats.inc_value("divulga/bumped")
                 
                 continue
 
             self.pending[info.filename] = new_index_date
+            self.freshness.schedule(info.filename)
             added += 1
 
             logging.debug("Scheduling file %s [%s > %s], p:%d", 
@@ -141,6 +163,9 @@ class DivulgaSpider(BaseSpider):
             yield self.make_request(info.path, self.parse_file, errback=self.errback_file, 
                 priority=priority, cb_kwargs={"info": info})
 
+        freshness = self.state_freshness.get(state, self.StateFreshness())
+        self.state_freshness[state] = freshness._replace(published=published or freshness.published, checked=time.time())
+
         if added > 0 or response.request.meta.get("reindex_count", 0) == 0:
             logging.info("Parsed index for %s-%s, size %d, added %d, total pending %s", election, state, size, added, len(self.pending))
 
@@ -160,6 +185,8 @@ class DivulgaSpider(BaseSpider):
         if not index_date:
             return
 
+        sent = response.meta.get(SENT_TIME_META, time.time())
+
         result = self.persist_response(response)
 
         # Server may send a version that wasn't updated yet
@@ -176,12 +203,18 @@ class DivulgaSpider(BaseSpider):
                 yield retry_request
             else:
                 self.crawler.stats.inc_value("divulga/skipped_dupes")
+                self.freshness.discard(info.filename)
                 logging.debug("File %s dupe skipped up [%s > %s]", info.filename, result.index_entry.index_date, index_date)
                 self.index[info.filename] = result.index_entry._replace(index_date=index_date)
 
             return
 
         self.index[info.filename] = result.index_entry._replace(index_date=index_date)
+        self.freshness.persisted(info.type, info.state, info.filename, index_date, sent)
+
+        freshness = self.state_freshness.get(info.state)
+        if freshness and (not freshness.persisted or index_date > freshness.persisted):
+            self.state_freshness[info.state] = freshness._replace(persisted=index_date)
 
         if not self.crawler.crawling:
             return
@@ -195,6 +228,11 @@ class DivulgaSpider(BaseSpider):
     def errback_file(self, failure):
         logging.error("Failure downloading %s - %s", str(failure.request), str(failure.value))
         self.pending.pop(failure.request.cb_kwargs["info"].filename, None)
+        self.freshness.discard(failure.request.cb_kwargs["info"].filename)
+
+    def closed(self, reason):
+        self.freshness.update_stats(self.crawler.stats)
+        super().closed(reason)
 
     def process_fixed(self, data, election):
         sqcands = (cand["sqcand"] for cand in FixedParser.expand_candidates(data))
@@ -247,16 +285,15 @@ class DivulgaSpider(BaseSpider):
 
     def generate_missing_pictures_requests(self):
         sqcands_map = {}
-        indexed_sqcands = {os.path.splitext(p)[0] for p,_ in self.index.search("%%.jpeg")}
+        indexed_sqcands = {os.path.splitext(p)[0] for p in self.index.find_files(match="picture")}
 
-        for filename, _ in self.index.search("%%-f.json"):
+        for filename in self.index.find_files(type="f", ext="json"):
             info = PathInfo(filename)
 
             try:
-                with open(self.get_local_path(info.path), "rb") as f:
-                    data = orjson.loads(f.read())
-                    sqcands = (cand["sqcand"] for cand in FixedParser.expand_candidates(data))
-                    sqcands_map.setdefault(info.election, set()).update(sqcands)
+                data = orjson.loads(self.storage.read(self.get_local_path(info.path)))
+                sqcands = (cand["sqcand"] for cand in FixedParser.expand_candidates(data))
+                sqcands_map.setdefault(info.election, set()).update(sqcands)
             except orjson.JSONDecodeError:
                 logging.debug("Malformed json at %s, skipping parse", info.filename)
 
@@ -3,9 +3,12 @@ import logging
 import os
 
 from scrapy.spidermiddlewares.httperror import HttpError
+from twisted.web.client import ResponseFailed
 
 from tse.common.basespider import BaseSpider
+from tse.common.index import Index
 from tse.common.pathinfo import PathInfo
+from tse.common.shards import ShardLocation, ShardStore
 from tse.parsers import (SectionAuxParser, SectionsConfigParser)
 
 
@@ -13,8 +16,11 @@ class UrnaSpider(BaseSpider):
     name = "urna"
 
     custom_settings = {
+        # Replaces the project EXTENSIONS
         "EXTENSIONS": {
             'tse.extensions.LogStatsUrna': 543,
+            'tse.extensions.PrometheusMetrics': 500,
+            'tse.extensions.CallbackProfiler': 501,
         }
     }
 
@@ -27,9 +33,16 @@ class UrnaSpider(BaseSpider):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+    def open_storage(self):
+        super().open_storage()
+
+        # Always there to read the sharded files, only appended to when enabled
+        self.shards = ShardStore.from_settings(self.settings)
+        if self.shards.granularity:
+            logging.info("Voting machine files shards: %s (per %s)", self.shards.shards_dir, self.shards.granularity)
+
     def load_json(self, path):
-        with open(path, "rb") as f:
-            return orjson.loads(f.read())
+        return orjson.loads(self.storage.read(path))
 
     def query_sigfile(self, source_path, force=False):
         sig_path = os.path.splitext(source_path)[0] + ".sig"
@@ -134,18 +147,52 @@ class UrnaSpider(BaseSpider):
 
             metadata = {"state": state, "hash": hash}
 
-            if not os.path.exists(local_path):
+            if not self.is_voting_machine_file_stored(filename, local_path):
                 yield self.make_request(path, self.parse_voting_machine_file, errback=self.errback_voting_machine_file,
                     priority=1, cb_kwargs={"hashdate": hashdate, "metadata": metadata})
             else:
                 self.crawler.stats.inc_value("urna/processed_voting_machine_files")
 
+    # Either loose or in a shard, the index is only looked up when sharding, the sharded entries are validated
+    # along the rest of the index (VALIDATE_INDEX)
+    def is_voting_machine_file_stored(self, filename, local_path):
+        if os.path.exists(local_path):
+            return True
+
+        if not self.shards.granularity:
+            return False
+
+        entry = self.index.get(filename)
+        return entry is not None and ShardLocation.from_metadata(entry.metadata) is not None
+
     def parse_voting_machine_file(self, response, hashdate, metadata):
-        result = self.persist_response(response)
-        if result.is_new_file:
-            self.index[result.filename] = result.index_entry._replace(index_date=hashdate, metadata=metadata)
+        if self.shards.granularity:
+            self.persist_to_shard(response, hashdate, metadata)
+        else:
+            result = self.persist_response(response)
+            if result.is_new_file:
+                self.index[result.filename] = result.index_entry._replace(index_date=hashdate, metadata=metadata)
 
         self.crawler.stats.inc_value("urna/processed_voting_machine_files")
 
+    # Appended to the shard instead of written loose, the location goes in the index metadata, the voting machine 
+    # files are immutable, contents replaced anyway are left behind in the shard
+    def persist_to_shard(self, response, hashdate, metadata):
+        filename = os.path.basename(self.get_path_from_url(response.url))
+        index_entry = self.index.get(filename)
+        if response.status == 304:
+            if index_entry:
+                return
+            else:
+                raise ResponseFailed(response)
+
+        last_modified, etag = self.get_index_validators(response)
+        if index_entry and index_entry.etag == etag and ShardLocation.from_metadata(index_entry.metadata):
+            return
+
+        location = self.shards.append(metadata["state"], PathInfo(filename).city, filename, response.body, last_modified)
+        self.index[filename] = Index.Entry(last_modified, etag, hashdate, metadata | location.to_metadata())
+        self.crawler.stats.inc_value("urna/sharded_bytes", len(response.body))
+
     def errback_voting_machine_file(self, failure):
         logging.error("Failure downloading %s - %s", str(failure.request), str(failure.value))
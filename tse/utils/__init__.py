@@ -15,7 +15,7 @@ def log_progress(iterable, total=None, format=None, batch_size=None):
         batch_size = batch_size or 1
         format = "%d"
 
-    batch_size = int(batch_size)
+    batch_size = max(int(batch_size), 1)
 
     count = 0
     for item in iterable:
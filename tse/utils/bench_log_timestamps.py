@@ -0,0 +1,94 @@
+import argparse
+import csv
+import io
+import logging
+import os
+import time
+from datetime import timezone
+
+from tse.common.voting_machine_files import LogTimestampDecoder, VotingMachineLogProcessor
+
+# Per row cost of decoding the log timestamps, on a real log
+# Ex: python -m tse.utils.bench_log_timestamps data/download/.../o00406-0100700090001.logjez
+
+def getargs():
+    parser = argparse.ArgumentParser(description="Benchmarks the voting machine log timestamp decoding")
+    parser.add_argument("path", help="A .logjez archive or an already decompressed logd.dat")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Runs of each case, the fastest is reported")
+    parser.add_argument("--cache-size", type=int, default=64, help="Timestamp strings memoized by the decoder")
+    return parser.parse_args()
+
+def read_timestamps(path) -> list[str]:
+    if os.path.splitext(path)[1] == ".dat":
+        with open(path, "rb") as f:
+            logs = [f.read()]
+    else:
+        logs = [bio.read() for _, bio in VotingMachineLogProcessor.read_compressed_logs(path)]
+
+    timestamps = []
+    for data in logs:
+        reader = csv.reader(io.StringIO(data.decode("latin_1"), newline=""), delimiter="\t")
+        timestamps.extend(row[0] for row in reader if len(row) == 6)
+
+    return timestamps
+
+def bench(name, func, timestamps, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func(timestamps)
+        best = min(best, time.perf_counter() - start_time)
+
+    logging.info("%-40s %7.1f ns/row", name, best * 1e9 / len(timestamps))
+    return best
+
+def main():
+    args = getargs()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    timestamps = read_timestamps(args.path)
+    logging.info("%d rows, %d distinct timestamps (%.1f rows per second of log)", len(timestamps), len(set(timestamps)),
+        len(timestamps) / max(len(set(timestamps)), 1))
+
+    def baseline(texts):
+        for t in texts:
+            LogTimestampDecoder.parse(t)
+
+    def baseline_astimezone(texts):
+        for t in texts:
+            LogTimestampDecoder.parse(t).astimezone()
+
+    def memoized(texts):
+        decode = LogTimestampDecoder(args.cache_size).decode
+        for t in texts:
+            decode(t)
+
+    def memoized_tz(texts):
+        decode = LogTimestampDecoder(args.cache_size).decode
+        tz = timezone(decode(texts[0]).astimezone().utcoffset())
+        last = aware = None
+        for t in texts:
+            value = decode(t)
+            if value is not last:
+                last = value
+                aware = value.replace(tzinfo=tz)
+
+    def epochs(texts):
+        decode_epoch = LogTimestampDecoder(args.cache_size).decode_epoch
+        for t in texts:
+            decode_epoch(t)
+
+    def epochs_batch(texts):
+        LogTimestampDecoder(args.cache_size).decode_epochs(texts)
+
+    before = bench("datetime per row (before)", baseline, timestamps, args.repeat)
+    bench("datetime + astimezone per row (before)", baseline_astimezone, timestamps, args.repeat)
+    after = bench("memoized datetime", memoized, timestamps, args.repeat)
+    bench("memoized datetime + tz once per second", memoized_tz, timestamps, args.repeat)
+    bench("epoch per row", epochs, timestamps, args.repeat)
+    batch = bench("epoch batch", epochs_batch, timestamps, args.repeat)
+
+    logging.info("Speedup: memoized %.1fx, epoch batch %.1fx", before / after, before / batch)
+
+if __name__ == "__main__":
+    main()
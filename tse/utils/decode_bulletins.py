@@ -0,0 +1,153 @@
+import argparse
+import itertools
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable
+
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from tse.common.bulletin import BulletinDecoder, BulletinVotesTable
+from tse.common.pathinfo import PathInfo
+from tse.common.voting_machine_files import VotingMachineFiles
+from tse.utils.process_logs import (DOWNLOAD_DIR, URNA_DIR, LogSection, batched, init_readers, read_section, scan_urna_tree,
+                                        scan_zips, write_batch_tables)
+
+SAMPLE_PATH = "data/bulletin_sample.bu"
+SAMPLE_REFERENCE_PATH = "data/bulletin_sample.json"
+
+# Decodes the bulletins (.bu/.busa, the contingency one when there are both) of every section into a single votes table
+# Ex: python -m tse.utils.decode_bulletins --zips -o data/bulletins.parquet
+
+def getargs():
+    parser = argparse.ArgumentParser(description="Decodes the voting machine bulletins into a columnar votes table")
+    parser.add_argument('-v', '--verbose',
+        action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.INFO,
+        help="Be verbose",
+    )
+
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--urna", metavar="DIR", nargs="?", const=URNA_DIR, help=f"Scan the urna spider download tree (default: {URNA_DIR})")
+    source.add_argument("--zips", metavar="DIR", nargs="?", const=DOWNLOAD_DIR, help=f"Scan the dadosabertos transmitted zips (default: {DOWNLOAD_DIR})")
+
+    parser.add_argument("-o", "--output", default="data/bulletins.parquet", help="Output parquet file")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--batch-size", type=int, default=256, help="Sections sent to a worker at once")
+    parser.add_argument("--row-group-size", type=int, default=1_000_000, help="Rows per parquet row group")
+    parser.add_argument("--log-interval", type=float, default=10.0, help="Seconds between progress logs")
+    parser.add_argument("--check", type=int, metavar="N", nargs="?", const=100,
+        help=f"Only check the decoder, against the reference of {SAMPLE_PATH} and the totals of the first N sections (default: 100)")
+
+    return parser.parse_args()
+
+# Per worker process state, kept warm between batches
+_table: BulletinVotesTable = None
+
+def init_worker():
+    global _table
+
+    init_readers()
+    _table = BulletinVotesTable()
+
+def process_section(section: LogSection):
+    info = PathInfo(os.path.basename(section.path))
+    keyfields = {
+        "state": section.state,
+        "city": info.city,
+        "zone": info.zone,
+        "section": info.section,
+    }
+
+    # Decoded fully before adding, so a malformed bulletin leaves no partial rows behind, sharded ones without copying
+    with read_section(section) as data:
+        votes = list(BulletinDecoder.decode(data))
+
+    problems = BulletinDecoder.check_totals(votes)
+    if problems:
+        raise ValueError("Inconsistent totals: " + "; ".join(problems))
+
+    _table.add_section(keyfields, votes)
+
+def process_batch(sections: list[LogSection]) -> tuple[pa.Table, int, int]:
+    failed = 0
+    for section in sections:
+        try:
+            process_section(section)
+        except Exception as ex:
+            logging.warning("Failed processing %s: %s", section.key, repr(ex))
+            failed += 1
+
+    return _table.to_table(), len(sections) - failed, failed
+
+# The sample decoded as its reference, then real bulletins decoded with consistent totals (see check_totals)
+def check(sections: Iterable[LogSection], count: int) -> bool:
+    with open(SAMPLE_PATH, "rb") as f:
+        votes = list(BulletinDecoder.decode(f.read()))
+
+    with open(SAMPLE_REFERENCE_PATH, "rb") as f:
+        expected = [BulletinDecoder.Vote(**v) for v in orjson.loads(f.read())]
+
+    ok = votes == expected
+    if ok:
+        logging.info("Sample %s decoded as its reference (%d votes)", SAMPLE_PATH, len(votes))
+    else:
+        for i, (vote, expected_vote) in enumerate(itertools.zip_longest(votes, expected)):
+            if vote != expected_vote:
+                logging.error("Sample %s vote %d decoded as %s, expected %s", SAMPLE_PATH, i, vote, expected_vote)
+                break
+
+    init_worker()
+    checked = 0
+    for section in itertools.islice(sections, count):
+        try:
+            process_section(section)
+            checked += 1
+        except Exception as ex:
+            logging.error("Failed checking %s: %s", section.key, repr(ex))
+            ok = False
+
+    logging.info("Checked %d sections, %d rows", checked, _table.to_table().num_rows)
+    return ok
+
+def main():
+    args = getargs()
+    logging.basicConfig(level=args.loglevel, format="%(asctime)s %(message)s")
+
+    file_type = VotingMachineFiles.FileType.BULLETIN
+    sections = scan_urna_tree(args.urna, file_type) if args.urna else scan_zips(args.zips, file_type)
+
+    if args.check is not None:
+        sys.exit(0 if check(sections, args.check) else 1)
+
+    total_sections = 0
+    total_failed = 0
+    total_votes = 0
+    total_rows = 0
+    start_time = time.monotonic()
+
+    def on_result(table: pa.Table, done: int, failed: int):
+        nonlocal total_sections, total_failed, total_votes, total_rows
+        total_rows += table.num_rows
+        total_sections += done
+        total_failed += failed
+        total_votes += pc.sum(table["votes"]).as_py() or 0
+
+    def on_log(now):
+        logging.info("Decoded %d sections (%.1f/s), %d rows, %d votes, %d failed",
+            total_sections, total_sections / (now - start_time), total_rows, total_votes, total_failed)
+
+    with ProcessPoolExecutor(args.jobs, initializer=init_worker) as executor:
+        write_batch_tables(executor, process_batch, batched(sections, args.batch_size), args.output, BulletinVotesTable.schema,
+            queue_depth=args.jobs * 4, row_group_size=args.row_group_size, log_interval=args.log_interval,
+            on_result=on_result, on_log=on_log)
+
+    elapsed = max(time.monotonic() - start_time, 1e-6)
+    logging.info("Finished %d sections (%.1f/s), %d rows, %d votes, %d failed in %.0fs, written to %s",
+        total_sections, total_sections / elapsed, total_rows, total_votes, total_failed, elapsed, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import argparse
+import datetime
+import logging
+import os
+
+from scrapy.utils.project import get_project_settings
+
+from tse.common.index import Index
+from tse.common.pathinfo import PathInfo
+from tse.common.shards import ShardLocation, ShardStore
+from tse.utils import log_progress
+
+# Exports the voting machine files appended into shards (see URNA_SHARDS) back to the loose section dirs, by the
+# offsets in the index, checking their crc (run from the project root, paths come from the settings)
+# Ex: python -m tse.utils.export_shards --update-index
+
+def getargs():
+    parser = argparse.ArgumentParser(description="Exports the sharded voting machine files to the loose layout")
+    parser.add_argument('-v', '--verbose',
+        action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.INFO,
+        help="Be verbose",
+    )
+
+    parser.add_argument("--index", metavar="PATH", help="Index database (default: the urna one, from the project settings)")
+    parser.add_argument("-w", "--where", action="append", default=[], metavar="COLUMN=VALUE",
+        help=f"Only files matching a structured index column ({', '.join(Index.PATH_COLUMNS)}), ex: state=sp, can be repeated")
+    parser.add_argument("--update-index", action="store_true",
+        help="Drop the shard offsets from the exported entries, the spider then uses the loose files (the shards can be removed afterwards)")
+    parser.add_argument("--overwrite", action="store_true", help="Write the files already there again")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Entries per index transaction")
+
+    return parser.parse_args()
+
+def main():
+    args = getargs()
+    logging.basicConfig(level=args.loglevel, format="%(asctime)s %(message)s")
+
+    settings = get_project_settings()
+    index_path = args.index or PathInfo.get_index_path(settings, "urna")
+    where = dict(w.split("=", 1) for w in args.where)
+
+    mmap_size = settings.getint("INDEX_MMAP_SIZE")
+    index = Index(index_path, mmap_size=mmap_size) if args.update_index else Index.open_readonly(index_path, mmap_size)
+
+    stats = {"files": 0, "written": 0, "bytes": 0, "skipped": 0, "failed": 0}
+
+    with index, ShardStore.from_settings(settings) as shards:
+        entries = [(f, e) for f, e in index.find(match="voting_machine", **where) if ShardLocation.from_metadata(e.metadata)]
+        logging.info("Found %d sharded files", len(entries))
+
+        updated = []
+        for filename, entry in log_progress(entries, len(entries)):
+            stats["files"] += 1
+            location = ShardLocation.from_metadata(entry.metadata)
+            local_path = PathInfo.get_local_path(settings, PathInfo(filename).make_indexed_path(entry.metadata))
+
+            if args.overwrite or not os.path.exists(local_path) or os.path.getsize(local_path) != location.size:
+                member = shards.get_member(location, filename)
+                if member is None:
+                    logging.warning("Shard member not found %s", filename)
+                    stats["failed"] += 1
+                    continue
+
+                with shards.view(location) as view:
+                    if not shards.verify(member, view):
+                        logging.warning("Shard member crc mismatch %s", filename)
+                        stats["failed"] += 1
+                        continue
+
+                    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                    with open(local_path, "wb") as f:
+                        f.write(view)
+
+                dt_epoch = entry.last_modified.replace(tzinfo=datetime.timezone.utc).timestamp()
+                os.utime(local_path, (dt_epoch, dt_epoch))
+
+                stats["written"] += 1
+                stats["bytes"] += location.size
+            else:
+                stats["skipped"] += 1
+
+            if args.update_index:
+                updated.append((filename, entry._replace(metadata=ShardLocation.strip_metadata(entry.metadata))))
+                if len(updated) >= args.batch_size:
+                    index.add_many(updated)
+                    updated = []
+
+        if len(updated) > 0:
+            index.add_many(updated)
+
+    logging.info("Files: %d, written: %d (%.1f MB), already there: %d, failed: %d%s", stats["files"], stats["written"],
+        stats["bytes"] / 1e6, stats["skipped"], stats["failed"], ", index updated" if args.update_index else "")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import argparse
+import datetime
+import logging
+import os
+import shutil
+import zipfile
+
+from scrapy.utils.project import get_project_settings
+
+import tse.utils.zipfile_remove # Adds ZipFile.remove_many
+from tse.common.index import Index
+from tse.common.pathinfo import PathInfo
+from tse.common.storage import StorageCodec
+from tse.common.versions import RetentionPolicy, VersionReader
+from tse.utils import log_progress
+
+# Prunes old versions of the downloaded files by retention rules, from the .ver dirs, their _pack.zip and the index,
+# in small transactions so it can run while crawling (run from the project root, paths come from the settings)
+# Ex: python -m tse.utils.gc_versions --keep-last 3 --keep-every 15 --keep-at 2022-10-02T20:00
+
+def getargs():
+    parser = argparse.ArgumentParser(description="Garbage collects old file versions")
+    parser.add_argument('-v', '--verbose',
+        action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.INFO,
+        help="Be verbose",
+    )
+
+    parser.add_argument("--spider", default="divulga", help="Spider whose index and files are collected")
+    parser.add_argument("--index", metavar="PATH", help="Index database (default: the spider one, from the project settings)")
+
+    parser.add_argument("--keep-last", type=int, default=0, metavar="N", help="Keep the latest N versions of each file")
+    parser.add_argument("--keep-every", type=float, metavar="MINUTES", help="Keep the latest version of each file per index date bucket")
+    parser.add_argument("--keep-at", type=datetime.datetime.fromisoformat, action="append", default=[], metavar="DATETIME",
+        help="Keep the versions of a snapshot at this index date (as Index.snapshot_at), can be repeated")
+
+    parser.add_argument("-w", "--where", action="append", default=[], metavar="COLUMN=VALUE",
+        help=f"Only files matching a structured index column ({', '.join(Index.PATH_COLUMNS)}), ex: type=v, can be repeated")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Files per index transaction")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be reclaimed")
+    parser.add_argument("--no-vacuum", dest="vacuum", action="store_false", help="Don't vacuum the index at the end (it blocks the crawler writes meanwhile)")
+
+    args = parser.parse_args()
+    if not args.keep_last and not args.keep_every and not args.keep_at:
+        parser.error("At least one of --keep-last, --keep-every or --keep-at is required")
+
+    return args
+
+def get_db_size(path):
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+# Loose .ver copies go right away, pack members are gathered to compact each pack only once at the end
+def remove_version_file(reader: VersionReader, version: Index.Version, pack_members: dict, stats: dict, dry_run):
+    try:
+        local_path = reader.get_local_path(version)
+    except FileNotFoundError:
+        stats["missing"] += 1
+        return
+
+    ver_path = reader.storage.find(PathInfo.get_version_path(local_path, version.version))
+    if not ver_path:
+        ver_name = os.path.basename(PathInfo.get_version_path(local_path, version.version))
+        pack_members.setdefault(PathInfo.get_version_pack_path(local_path), set()).add(ver_name)
+        return
+
+    stats["ver_files"] += 1
+    stats["ver_bytes"] += os.path.getsize(ver_path)
+    if not dry_run:
+        os.remove(ver_path)
+
+def compact_pack(pack_path, names: set[str], stats: dict, dry_run):
+    if not os.path.exists(pack_path):
+        stats["missing"] += len(names)
+        return
+
+    size = os.path.getsize(pack_path)
+    with zipfile.ZipFile(pack_path, "r") as zip:
+        members = [info for info in zip.infolist() if StorageCodec.strip_suffix(info.filename) in names]
+        remaining = len(zip.infolist()) - len(members)
+
+    stats["missing"] += len(names) - len(members)
+    stats["pack_members"] += len(members)
+    if len(members) == 0:
+        return
+
+    if dry_run:
+        stats["pack_bytes"] += sum(info.compress_size for info in members)
+        return
+
+    if remaining == 0:
+        os.remove(pack_path)
+        stats["pack_bytes"] += size
+        return
+
+    # Compacted in place, restored from the backup if anything goes wrong midway
+    backup_path = os.path.join(os.path.dirname(pack_path), ".bpk__pack.zip")
+    shutil.copyfile(pack_path, backup_path)
+    try:
+        logging.debug("Compacting %s, - %d members", pack_path, len(members))
+        with zipfile.ZipFile(pack_path, "a") as zip:
+            zip.remove_many([zip.getinfo(info.filename) for info in members])
+    except Exception:
+        os.replace(backup_path, pack_path)
+        raise
+
+    os.remove(backup_path)
+    stats["pack_bytes"] += size - os.path.getsize(pack_path)
+
+def main():
+    args = getargs()
+    logging.basicConfig(level=args.loglevel, format="%(asctime)s %(message)s")
+
+    settings = get_project_settings()
+    index_path = args.index or PathInfo.get_index_path(settings, args.spider)
+    policy = RetentionPolicy(args.keep_last, datetime.timedelta(minutes=args.keep_every) if args.keep_every else None, tuple(args.keep_at))
+    where = dict(w.split("=", 1) for w in args.where)
+
+    logging.info("Collecting %s with %s%s", index_path, policy, " (dry run)" if args.dry_run else "")
+
+    stats = {"files": 0, "versions": 0, "kept": 0, "rows": 0, "ver_files": 0, "ver_bytes": 0, "pack_members": 0,
+        "pack_bytes": 0, "missing": 0}
+    index_bytes = get_db_size(index_path)
+    pack_members = {}
+
+    mmap_size = settings.getint("INDEX_MMAP_SIZE")
+    index = Index.open_readonly(index_path, mmap_size) if args.dry_run else Index(index_path, mmap_size=mmap_size)
+
+    with index, VersionReader(settings) as reader:
+        filenames = index.get_versioned_files(**where)
+        logging.info("Found %d files with old versions", len(filenames))
+
+        batches = range(0, len(filenames), args.batch_size)
+        for start in log_progress(batches, len(batches)):
+            pruned = []
+            for versions in index.get_versions(filenames[start:start + args.batch_size]).values():
+                kept, prunable = policy.select(versions)
+                stats["files"] += 1
+                stats["versions"] += len(versions)
+                stats["kept"] += len(kept)
+                pruned.extend(prunable)
+
+            if len(pruned) == 0:
+                continue
+
+            # Rows go first, a crash midway leaves unreferenced files behind instead of rows pointing to nothing
+            if not args.dry_run:
+                stats["rows"] += index.remove_versions((v.filename, v.version) for v in pruned)
+            else:
+                stats["rows"] += len(pruned)
+
+            for version in pruned:
+                remove_version_file(reader, version, pack_members, stats, args.dry_run)
+
+        for pack_path, names in log_progress(pack_members.items(), len(pack_members)):
+            compact_pack(pack_path, names, stats, args.dry_run)
+
+        if args.vacuum and not args.dry_run and stats["rows"] > 0:
+            logging.info("Vacuuming index...")
+            index.vacuum()
+
+    index_reclaimed = index_bytes - get_db_size(index_path)
+
+    logging.info("Files: %d, versions: %d, kept: %d, index rows removed: %d",
+        stats["files"], stats["versions"], stats["kept"], stats["rows"])
+    logging.info("Reclaimed%s: .ver files %d (%.1f MB), pack members %d (%.1f MB), index %.1f MB, missing files: %d",
+        " (would be)" if args.dry_run else "", stats["ver_files"], stats["ver_bytes"] / 1e6, stats["pack_members"],
+        stats["pack_bytes"] / 1e6, index_reclaimed / 1e6, stats["missing"])
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,21 @@
-from collections import deque
+import argparse
 import os
-from threading import Thread, Event
-import zipfile
+from threading import Lock, Thread
 import logging
-import base64
-from datetime import datetime, timezone, time
-import mmh3
+from time import perf_counter
 import re
-import numpy as np
-import orjson
 from distributed.utils_perf import disable_gc_diagnosis
 from distributed import Client, LocalCluster, get_worker, wait
 import pandas as pd
-from tse.common.voting_machine_files import VotingMachineFiles, VotingMachineLogProcessor
+import pyarrow.compute as pc
+from tse.common.city_catalog import CityCatalog
+from tse.common.log_sinks import AdaptiveChunkSize, ElasticsearchSink, LogSink, NdjsonSink, NullSink, ParquetSink, get_index_id_bytes
+from tse.common.voting_machine_files import VotingMachineLogProcessor
+from tse.common.zip_manifest import ZipManifest
 from tse.utils import log_progress
-from tse.parsers import CityConfigParser
 
-from elasticsearch import Elasticsearch, TransportError
-from elasticsearch.helpers import bulk, parallel_bulk
+from elasticsearch import Elasticsearch
 
-import queue
 import gc
 
 pd.options.mode.string_storage = "pyarrow"
@@ -27,52 +23,15 @@ DOWNLOAD_DIR = "data/download/dadosabertos/transmitted"
 
 ELASTIC_PASSWORD = os.getenv("ELASTIC_PASSWORD")
 CLOUD_ID = os.getenv("CLOUD_ID")
+ELASTIC_URL = os.getenv("ELASTIC_URL")
 
-def scan_dir(dir):
-    with os.scandir(dir) as it:
-        for entry in it:
-            if not entry.is_file() or entry.name.startswith('.'): 
-                continue
-
-            if os.path.splitext(entry.name)[1] == ".zip":
-                # if not "_PI" in entry.name:
-                #     continue
-
-                with zipfile.ZipFile(entry.path, "r") as zip:
-                    for info in zip.infolist():
-                        if not info.is_dir() and not info.filename == "leiame.pdf":
-                            yield os.path.join(entry.name, info.filename)
-
-def load_json(path):
-    with open(path, "rb") as f:
-        return orjson.loads(f.read())
-
-def read_tse_cities():
-    data = list(CityConfigParser.expand_cities(load_json("data/mun-default-cm.json")))
-
-    df = pd.DataFrame(data,
-                        columns=["SG_UF", "CD_MUNICIPIO",
-                            "CD_MUNICIPIO_IBGE", "NM_MUNICIPIO", "MUNICIPIO_CAPITAL", "MUNICIPIO_ZONAS"])
-
-    df["SG_UF"] = df["SG_UF"].str.upper().astype(pd.CategoricalDtype())
-    df["CD_MUNICIPIO"] = df["CD_MUNICIPIO"].astype(pd.CategoricalDtype())
-    df["CD_MUNICIPIO_IBGE"] = df["CD_MUNICIPIO_IBGE"].astype(pd.CategoricalDtype())
-    df["NM_MUNICIPIO"] = df["NM_MUNICIPIO"].astype(pd.CategoricalDtype())
-    df["MUNICIPIO_CAPITAL"] = df["MUNICIPIO_CAPITAL"].astype(bool)
-    return df.set_index(["SG_UF", "CD_MUNICIPIO"]).sort_index()
+# Log files already acknowledged by elasticsearch, one append-only file per worker process
+LEDGER_DIR = "data/parse_logs_ledger"
+# Offline sinks keep their own ledger inside the output directory
+OUTPUT_DIR = "data/logs"
 
 def get_index_id(filename, row_num = 0):
-    return base64.urlsafe_b64encode(mmh3.hash_bytes(filename + str(row_num))).decode("ascii").rstrip("=") 
-
-def dict_process(d):
-    if not d:
-        return None
-
-    for k,v in d.items():
-        if isinstance(v, time):
-            d[k] = v.strftime("%H:%M:%S") 
-
-    return d
+    return get_index_id_bytes(filename, row_num).decode("ascii")
 
 def worker_name():
     try:
@@ -80,27 +39,90 @@ def worker_name():
     except ValueError:
         return ""
 
-def expand_logs_thread(df, q, e, wname):
+def make_es_client(**kwargs):
+    # ELASTIC_URL allows pointing to a local cluster instead of the cloud deployment
+    if ELASTIC_URL:
+        return Elasticsearch(ELASTIC_URL, basic_auth=("elastic", ELASTIC_PASSWORD) if ELASTIC_PASSWORD else None, **kwargs)
+
+    return Elasticsearch(cloud_id=CLOUD_ID, basic_auth=("elastic", ELASTIC_PASSWORD), **kwargs)
+
+# Append-only record of fully written log files, a file is written only after the sink made all its docs durable
+class Ledger:
+    def __init__(self, dir):
+        os.makedirs(dir, exist_ok=True)
+        self.file = open(os.path.join(dir, f"ledger-{os.getpid()}.txt"), "a", encoding="utf-8")
+        self._lock = Lock()
+
+    # Called by the sinks, possibly from their sender threads
+    def done(self, key, success):
+        if not success:
+            return
+
+        with self._lock:
+            self.file.write(key + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def read_ledger(dir) -> set[str]:
+    indexed = set()
+    if not os.path.isdir(dir):
+        return indexed
+
+    for entry in os.scandir(dir):
+        if entry.name.startswith("ledger-") and entry.name.endswith(".txt"):
+            with open(entry.path, "r", encoding="utf-8") as f:
+                indexed.update(f.read().splitlines())
+
+    return indexed
+
+BULK_CHUNK_DOCS = 5000
+BULK_QUEUE_BYTES = 64 * 1024 * 1024
+BULK_THREADS = 8
+
+SINKS = ["elasticsearch", "ndjson", "parquet", "null"]
+
+def open_sink(sink_name, output_dir, log_processor: VotingMachineLogProcessor, on_done) -> LogSink:
+    if sink_name == "elasticsearch":
+        es_client = make_es_client(http_compress=True, connections_per_node=BULK_THREADS)
+        return ElasticsearchSink(es_client, threads=BULK_THREADS, queue_bytes=BULK_QUEUE_BYTES,
+                                    chunk_size=AdaptiveChunkSize(BULK_CHUNK_DOCS), on_done=on_done)
+    elif sink_name == "ndjson":
+        os.makedirs(output_dir, exist_ok=True)
+        return NdjsonSink(os.path.join(output_dir, f"logs-{os.getpid()}.ndjson.zst"), on_done=on_done)
+    elif sink_name == "parquet":
+        return ParquetSink(output_dir, log_processor.get_param_types(), on_done=on_done)
+    elif sink_name == "null":
+        return NullSink(on_done=on_done)
+
+    raise ValueError(f"Unknown sink {sink_name}")
+
+def get_ledger_dir(sink_name, output_dir):
+    return LEDGER_DIR if sink_name == "elasticsearch" else os.path.join(output_dir, "_ledger")
+
+def expand_logs(df, sink: LogSink, log_processor: VotingMachineLogProcessor, stats: dict, wname):
     logger = logging.getLogger("distributed.worker")
-    log_processor = VotingMachineLogProcessor()
-    cities = read_tse_cities()
+    # Shared by all threads of the worker process, read-only
+    cities = CityCatalog.load()
 
     zip_regex = re.compile(r"^bu_imgbu_logjez_rdv_vscmr_(?P<year>\d{4})_(?P<round>\d{1})t_(?P<state>\w{2})\.(?P<ext>\w+)")
     file_regex = re.compile(r"^(o|s|t)(?P<plea>\d{5})-(?P<city>\d{5})(?P<zone>\d{4})(?P<section>\d{4})\.(?P<ext>\w+)")
 
-    for zip_filename, group in df.groupby(level=0):
+    for zip_filename, group in df.groupby("zip", observed=True, sort=True):
         zip_path = os.path.join(DOWNLOAD_DIR, zip_filename)
-        logger.info("%s | Opened zip %s", worker_name(), zip_filename)
+        logger.info("%s | Opened zip %s", wname, zip_filename)
 
         zip_match = zip_regex.match(zip_filename)
         year = zip_match.group("year")
         round = zip_match.group("round")
         state = zip_match.group("state")
+        state_key = state.lower()
 
-        with zipfile.ZipFile(zip_path, "r") as zip:
-            for entry in group.itertuples(True):
-                log_ext = VotingMachineFiles.get_voting_machine_files_map(entry.extensions)[VotingMachineFiles.FileType.LOG]
-                log_filename = entry.Index[1] + log_ext
+        # Members are read in disk order straight from their offsets
+        with open(zip_path, "rb") as zip:
+            for entry in group.sort_values("offset").itertuples(True):
+                log_filename = entry.member
 
                 file_match = file_regex.match(log_filename)
                 plea = file_match.group("plea").lstrip("0")
@@ -108,7 +130,7 @@ def expand_logs_thread(df, q, e, wname):
                 zone = file_match.group("zone").lstrip("0")
                 section = file_match.group("section").lstrip("0")
 
-                city_info = cities.loc[(state, city)]
+                city_info = cities[(state_key, city)]
 
                 commonfields = {
                     "year": int(year),
@@ -116,121 +138,100 @@ def expand_logs_thread(df, q, e, wname):
                     "plea": plea,
                     "state": state,
                     "city": city,
-                    "city_ibge": city_info["CD_MUNICIPIO_IBGE"],
-                    "city_name": city_info["NM_MUNICIPIO"],
+                    "city_ibge": city_info.ibge,
+                    "city_name": city_info.name,
                     "zone": zone,
                     "section": section,
                 }
-            
-                docs = []
 
-                with zip.open(log_filename) as file:
+                docs = 0
+                with ZipManifest.open_member(zip, entry.offset, entry.compressed_size) as file:
                     for filename, bio in log_processor.read_compressed_logs(file, log_filename):
-                        for row in log_processor.parse_log(bio, filename):
-                            doc = {
-                                "_index": "voting-machine-logs",
-                                "_id": get_index_id(filename, row.number),
-                            }
-                            doc.update(commonfields)
-                            doc.update({
-                                "logfilename": filename,
-                                "logtype": "contingency" if os.path.splitext(filename)[1] == ".jez" else "main",
-                                "rownum": row.number,
-                                "timestamp": row.timestamp.astimezone(timezone.utc),
-                                "level": row.level,
-                                "vm_id": row.vm_id,
-                                "app": row.app,
-                                "message": row.message,
-                                "message_template": row.message_template,
-                                "message_params": dict_process(row.message_params),
-                                "hash": "{:016X}".format(row.hash),
-                                "event": { "dataset": "vmlogs" }
-                            })
-                            docs.append(doc)
-                
-                doc = {
-                    "_index": "voting-machine-logfiles",
-                    "_id": get_index_id(filename),
-                }
-                doc.update(commonfields)
-                doc.update({
-                    "logfilename": log_filename,
-                    "timestamp": datetime.utcnow(),
-                    "event": { "dataset": "vmlogfiles" }
-                })
-                docs.append(doc)
-                
-                q.put((log_filename, docs))
-                logger.info("%s | Processed %s", wname, log_filename)
-    del cities
-    del log_processor
-    cities = None
-    log_processor = None
-    e.set()
-
-def part(partition):
+                        docs += sink.write_log_file(log_processor, commonfields, filename, bio)
+
+                sink.end_section(entry.Index, commonfields, log_filename)
+                stats["docs"] += docs
+                logger.info("%s | Processed %s (%d docs)", wname, log_filename, docs)
+
+def part(partition, sink_name = "elasticsearch", output_dir = OUTPUT_DIR):
     logger = logging.getLogger("distributed.worker")
     disable_gc_diagnosis()
 
-    df = (
-        partition.reset_index().
-        assign(zip_filename=lambda p: p["index"].apply(os.path.dirname)).
-        assign(log_filename=lambda p: p["index"].apply(os.path.basename)).
-        drop(columns="index").
-        rename(columns={"paths": "extensions"}).
-        set_index(["zip_filename", "log_filename"]).sort_index()
-    )
-
-    que = queue.Queue(10)
-    evt = Event()
-    Thread(target=expand_logs_thread, args=(df, que, evt, worker_name())).start()
+    start_time = perf_counter()
+    stats = {
+        "zip": str(partition["zip"].iloc[0]) if len(partition) > 0 else None,
+        "sections": len(partition),
+        "bytes": int(partition["compressed_size"].sum()),
+        "docs": 0,
+    }
 
     es_loggers = logging.getLogger("elastic_transport.transport")
     es_loggers.setLevel(logging.WARNING)
 
-    es_client = Elasticsearch(
-        cloud_id=CLOUD_ID,
-        basic_auth=("elastic", ELASTIC_PASSWORD),
-        http_compress=True,
-    )
+    log_processor = VotingMachineLogProcessor()
+    # Nothing is written with the null sink, so there's nothing to resume from
+    ledger = Ledger(get_ledger_dir(sink_name, output_dir)) if sink_name != "null" else None
+    sink = open_sink(sink_name, output_dir, log_processor, ledger.done if ledger else None)
+
+    try:
+        expand_logs(partition, sink, log_processor, stats, worker_name())
+    finally:
+        sink.close()
+        if ledger:
+            ledger.close()
+        if isinstance(sink, ElasticsearchSink):
+            sink.client.close()
 
-    def get_docs():
-        while not evt.is_set():
-            log_filename, docs = que.get()
-            yield from docs
-            logger.info("%s | Sent %s (%d docs)", worker_name(), log_filename, len(docs))
-            que.task_done()
-    
-    pb = parallel_bulk(client=es_client, actions=get_docs(), chunk_size=5000, thread_count=8, raise_on_error=False)
-    while True:
-        try:
-            next(pb)
-        except StopIteration:
-            break
-        except TransportError:
-            continue
-
-    evt.wait()
-    del df
-    del que
-    del pb
-    df = None
-    que = None
-    pb = None
     gc.collect()
-    logger.info("Finished part")
-    return None
-
-def collect_all_files() -> pd.Series:
-    expected_total = 2360133
-    logging.info("Scanning %s...", DOWNLOAD_DIR)
-    df = pd.Series(log_progress(scan_dir(DOWNLOAD_DIR), total=expected_total), dtype=pd.StringDtype(), name="paths")
-    logging.info("Found %d files", len(df))
-    
-    logging.info("Grouping...")
-    df = df.groupby(lambda x: os.path.splitext(df[x])[0]).apply(list)
-    df = df.map(lambda l: [os.path.splitext(x)[1] for x in l])
-    logging.info("Grouped into %d items", len(df))
+
+    stats["seconds"] = perf_counter() - start_time
+    stats["sink"] = sink.get_stats()
+    logger.info("%s | Finished part of %s, %d sections, %.1f MB in %.1fs (%.2f MB/s, %.0f docs/s)", worker_name(), stats["zip"],
+        stats["sections"], stats["bytes"] / 1e6, stats["seconds"], stats["bytes"] / 1e6 / stats["seconds"], stats["docs"] / stats["seconds"])
+    sink.metrics.log(logger, f"{worker_name()} | ")
+    return stats
+
+# Partitions never span zips, so each one opens a single zip once, and are balanced by compressed size
+# so big sections (ex: capitals) don't turn into stragglers, biggest ones are returned first
+def split_partitions(df: pd.DataFrame, target_bytes: int) -> list[pd.DataFrame]:
+    partitions = []
+    for _, group in df.groupby("zip", observed=True, sort=True):
+        group = group.sort_values("offset")
+        sizes = group["compressed_size"].astype("int64")
+        buckets = (sizes.cumsum() - sizes) // target_bytes
+        partitions.extend(p for _, p in group.groupby(buckets))
+
+    partitions.sort(key=lambda p: p["compressed_size"].sum(), reverse=True)
+    return partitions
+
+def log_partition_stats(results: list[dict]):
+    results = [r for r in results if r and r["sections"] > 0]
+    if len(results) == 0:
+        return
+
+    seconds = pd.Series([r["seconds"] for r in results])
+    throughput = pd.Series([r["bytes"] / 1e6 / r["seconds"] for r in results])
+    logging.info("Partitions: %d, seconds p50: %.1f p90: %.1f max: %.1f, MB/s p10: %.2f p50: %.2f", len(results),
+        seconds.quantile(0.5), seconds.quantile(0.9), seconds.max(), throughput.quantile(0.1), throughput.quantile(0.5))
+
+    for r in sorted(results, key=lambda r: r["seconds"], reverse=True)[:5]:
+        logging.info("Slowest: %s, %d sections, %.1f MB in %.1fs", r["zip"], r["sections"], r["bytes"] / 1e6, r["seconds"])
+
+    sinks = pd.DataFrame([r["sink"] for r in results])
+    logging.info("Sink %s: %d docs, %.1f MB, %d batches (%.1f ms avg), %d retries, %d failed docs, docs/s per partition p50: %.0f",
+        sinks["sink"].iloc[0], sinks["docs"].sum(), sinks["bytes"].sum() / 1e6, sinks["batches"].sum(),
+        1000 * sinks["busy_seconds"].sum() / max(sinks["batches"].sum(), 1), sinks["retries"].sum(), sinks["failures"].sum(),
+        sinks["docs_per_second"].quantile(0.5))
+
+# Log file of each section, indexed by <zip>/<section>, from the cached zips manifest
+def collect_all_files() -> pd.DataFrame:
+    logging.info("Loading manifest of %s...", DOWNLOAD_DIR)
+    manifest = ZipManifest.load_dir(DOWNLOAD_DIR)
+
+    logs = manifest.filter(pc.equal(manifest["type"], "log")).drop(["type"])
+    df = logs.to_pandas()
+    df.index = df["zip"].astype(str) + "/" + df["section"]
+    logging.info("Found %d log files", len(df))
     return df
 
 def collect_indexed_files(client: Elasticsearch):
@@ -265,6 +266,18 @@ def collect_indexed_files(client: Elasticsearch):
 
     return df
 
+# Adds to the ledger what is indexed on elasticsearch but missing locally (ex: indexed before the ledger existed)
+# Meant to run in background, anything found is only skipped on the next run
+def reconcile_ledger(client: Elasticsearch, dir, indexed: set[str]):
+    missing = [f for f in collect_indexed_files(client) if f not in indexed]
+
+    if len(missing) > 0:
+        os.makedirs(dir, exist_ok=True)
+        with open(os.path.join(dir, "ledger-reconciled.txt"), "a", encoding="utf-8") as f:
+            f.writelines(m + "\n" for m in missing)
+
+    logging.info("Reconciled ledger with elasticsearch, added %d missing", len(missing))
+
 def create_voting_machine_logs_index(client: Elasticsearch):
     if client.indices.exists(index="voting-machine-logs"):
         return
@@ -352,32 +365,47 @@ def create_voting_machine_logfiles_index(client):
         }
     )
 
+def getargs():
+    parser = argparse.ArgumentParser(description="Indexes the voting machine logs on elasticsearch")
+    parser.add_argument("--sink", choices=SINKS, default="elasticsearch",
+        help="Where to write the parsed logs, ndjson (zstd compressed) and parquet are written locally, null only parses")
+    parser.add_argument("-o", "--output", default=OUTPUT_DIR, help="Output directory of the local sinks")
+    parser.add_argument("--reconcile", action="store_true", help="Also collect already indexed files from elasticsearch in background into the ledger")
+    parser.add_argument("--partition-mb", type=float, default=8.0, help="Target compressed size of the logs in each partition")
+    return parser.parse_args()
+
 def main():
+    args = getargs()
     logging.basicConfig(level=logging.INFO)
 
-    es_client = Elasticsearch(
-        cloud_id=CLOUD_ID,
-        basic_auth=("elastic", ELASTIC_PASSWORD),
-    )
-    es_loggers = logging.getLogger("elastic_transport.transport")
-    es_loggers.setLevel(logging.WARNING)
+    es_client = None
+    if args.sink == "elasticsearch":
+        es_client = make_es_client()
+        es_loggers = logging.getLogger("elastic_transport.transport")
+        es_loggers.setLevel(logging.WARNING)
 
-    create_voting_machine_logs_index(es_client)
-    create_voting_machine_logfiles_index(es_client)
+        create_voting_machine_logs_index(es_client)
+        create_voting_machine_logfiles_index(es_client)
 
     with Client(LocalCluster(processes = True, n_workers=4, threads_per_worker=1, silence_logs=False)) as client:
         disable_gc_diagnosis()
         logging.info("Init client: %s, dashboard: %s", client, client.dashboard_link)
 
+        already_indexed = read_ledger(get_ledger_dir(args.sink, args.output)) if args.sink != "null" else set()
+        logging.info("Found %d already indexed in the ledger", len(already_indexed))
+
+        if args.reconcile and es_client:
+            Thread(target=reconcile_ledger, args=(es_client, LEDGER_DIR, already_indexed), daemon=True).start()
+
         all_files = collect_all_files()
-        already_indexed = collect_indexed_files(es_client)
         to_index = all_files[~all_files.index.isin(already_indexed)]
 
-        split = max(int(len(to_index) / 50), 1)
-        logging.info("Will index %d files in %d chunks", len(to_index), split)
+        partitions = split_partitions(to_index, int(args.partition_mb * 1e6))
+        logging.info("Will index %d files (%.1f MB) in %d partitions", len(to_index), to_index["compressed_size"].sum() / 1e6, len(partitions))
 
-        c = client.map(part, np.array_split(to_index, split), pure=False)
+        c = client.map(part, partitions, sink_name=args.sink, output_dir=args.output, pure=False)
         wait(c)
+        log_partition_stats(client.gather(c, errors="skip"))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,492 @@
+import argparse
+import contextlib
+import io
+import logging
+import os
+import re
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, Executor, ProcessPoolExecutor, wait
+from multiprocessing import resource_tracker
+from multiprocessing.util import Finalize
+from typing import BinaryIO, Callable, Iterable, Iterator, NamedTuple, Optional, Union
+
+from tse.common.log_sinks import LogSink, NdjsonSink, NullSink, ParquetSink
+from tse.common.pathinfo import PathInfo
+from tse.common.shards import ShardStore
+from tse.common.shared_logs import SharedLogsBlock, SharedLogsReader
+from tse.common.voting_machine_files import VotingMachineFiles, VotingMachineLogProcessor
+
+# Standalone multi-core log processing, without a cluster nor a search engine
+# Ex: python -m tse.utils.process_logs --zips data/download/dadosabertos/transmitted -o data/logs
+
+URNA_DIR = "data/download/oficial/ele2022/arquivo-urna"
+DOWNLOAD_DIR = "data/download/dadosabertos/transmitted"
+
+zip_regex = re.compile(r"^bu_imgbu_logjez_rdv_vscmr_(?P<year>\d{4})_(?P<round>\d{1})t_(?P<state>\w{2})\.(?P<ext>\w+)")
+
+def getargs():
+    parser = argparse.ArgumentParser(description="Parses the voting machine logs using all cores")
+    parser.add_argument('-v', '--verbose',
+        action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.INFO,
+        help="Be verbose",
+    )
+
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--urna", metavar="DIR", nargs="?", const=URNA_DIR, help=f"Scan the urna spider download tree (default: {URNA_DIR})")
+    source.add_argument("--zips", metavar="DIR", nargs="?", const=DOWNLOAD_DIR, help=f"Scan the dadosabertos transmitted zips (default: {DOWNLOAD_DIR})")
+
+    parser.add_argument("-o", "--output", default="data/logs", help="Output directory")
+    parser.add_argument("-f", "--format", choices=["ndjson", "ndjson.zst", "parquet", "null"], default="ndjson",
+        help="Output format, null only parses to measure the parsing throughput")
+    parser.add_argument("--row-group-size", type=int, default=1_000_000, help="Maximum rows per parquet row group")
+    parser.add_argument("--no-compact", action="store_true", help="Keep the parquet files written per batch, without merging them per city at the end")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--decompress-jobs", type=int, default=0,
+        help="Processes only decompressing, handing the logs to the parsers through shared memory (default: 0, parsers decompress)")
+    parser.add_argument("--queue-depth", type=int,
+        help="Batches in flight, with --decompress-jobs bounds the decompressed batches held in shared memory (default: 4 * jobs, or 2 * jobs + decompress jobs)")
+    parser.add_argument("--batch-size", type=int, help="Sections sent to a worker at once, never mixing cities (default: 16, 64 for parquet)")
+    parser.add_argument("--checkpoint", help="Checkpoint file of processed sections (default: <output>/_checkpoint.txt)")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and process everything again")
+    parser.add_argument("--log-interval", type=float, default=10.0, help="Seconds between throughput logs")
+
+    return parser.parse_args()
+
+# A file of a section, picked among the contingency ones, the log file unless asked otherwise
+class LogSection(NamedTuple):
+    key: str                    # Unique section key stored in the checkpoint
+    container: Optional[str]    # Zip path when reading from dadosabertos, shard path when sharded, None for loose files
+    path: str                   # Member name inside the zip or shard, or local path
+    state: str
+    member: Optional[tuple[int, int]] = None    # Offset and size inside a shard
+
+def is_file_type(filename, file_type: VotingMachineFiles.FileType):
+    ext = os.path.splitext(filename)[1][1:]
+    return VotingMachineFiles.INV_VOTING_MACHINE_FILES_EXTENSIONS.get(ext) == file_type
+
+def is_log_file(filename):
+    return is_file_type(filename, VotingMachineFiles.FileType.LOG)
+
+# Contingency preferred file of the type
+def pick_file(filenames, file_type: VotingMachineFiles.FileType):
+    return VotingMachineFiles.get_voting_machine_files_map(filenames)[file_type]
+
+def pick_log_file(filenames):
+    return pick_file(filenames, VotingMachineFiles.FileType.LOG)
+
+# Latest copy of each file in a shard (the one the index points to), grouped by section in the loose tree order
+def scan_shard(shard_path, root, file_type: VotingMachineFiles.FileType) -> Iterable[LogSection]:
+    members = {}
+    for member in ShardStore.scan(shard_path):
+        if is_file_type(member.filename, file_type):
+            members[member.filename] = member
+
+    sections = {}
+    for filename in members:
+        sections.setdefault(os.path.splitext(filename)[0], []).append(filename)
+
+    key_prefix = os.path.relpath(shard_path, root)
+    state = ShardStore.get_shard_state(shard_path)
+    for _, filenames in sorted(sections.items()):
+        member = members[pick_file(filenames, file_type)]
+        yield LogSection(os.path.join(key_prefix, member.filename), shard_path, member.filename, state, (member.offset, member.size))
+
+def scan_urna_tree(root, file_type: VotingMachineFiles.FileType = VotingMachineFiles.FileType.LOG) -> Iterable[LogSection]:
+    # arquivo-urna/<plea>/dados/<state>/<city>/<zone>/<section>/<hash>/<file>
+    # arquivo-urna/<plea>/shards/<state>[-<city>].shard (see URNA_SHARDS)
+    for path, dirs, files in os.walk(root):
+        dirs.sort()
+        for shard in sorted(f for f in files if f.endswith(ShardStore.SUFFIX)):
+            yield from scan_shard(os.path.join(path, shard), root, file_type)
+
+        files = [f for f in files if is_file_type(f, file_type)]
+        if len(files) == 0:
+            continue
+
+        local_path = os.path.join(path, pick_file(files, file_type))
+        key = os.path.relpath(local_path, root)
+        state = key.split(os.sep)[-6]
+        yield LogSection(key, None, local_path, state)
+
+def scan_zips(dir, file_type: VotingMachineFiles.FileType = VotingMachineFiles.FileType.LOG) -> Iterable[LogSection]:
+    for entry in sorted(os.scandir(dir), key=lambda e: e.name):
+        if not entry.is_file() or entry.name.startswith('.'):
+            continue
+
+        zip_match = zip_regex.match(entry.name)
+        if not zip_match:
+            continue
+
+        state = zip_match.group("state").lower()
+
+        sections = {}
+        with zipfile.ZipFile(entry.path, "r") as zip:
+            for info in zip.infolist():
+                if info.is_dir() or not is_file_type(info.filename, file_type):
+                    continue
+                sections.setdefault(os.path.splitext(info.filename)[0], []).append(info.filename)
+
+        for filenames in sections.values():
+            filename = pick_file(filenames, file_type)
+            yield LogSection(os.path.join(entry.name, filename), entry.path, filename, state)
+
+def get_partition(section: LogSection):
+    return (section.state, PathInfo(os.path.basename(section.path)).city)
+
+def read_checkpoint(path) -> set[str]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return {l.rstrip("\n") for l in f if l != "\n"}
+    except FileNotFoundError:
+        return set()
+
+# Per worker process state, kept warm between batches
+_log_processor: VotingMachineLogProcessor = None
+_sink: LogSink = None
+_zips: dict[str, zipfile.ZipFile] = None
+_shards: ShardStore = None
+
+def init_worker(output_dir, format, row_group_size):
+    global _log_processor, _sink
+
+    init_readers()
+    _log_processor = VotingMachineLogProcessor()
+
+    if format == "parquet":
+        _sink = ParquetSink(output_dir, _log_processor.get_param_types(), row_group_size=row_group_size)
+    elif format == "null":
+        _sink = NullSink()
+    else:
+        _sink = NdjsonSink(os.path.join(output_dir, f"logs-{os.getpid()}.{format}"))
+
+    Finalize(None, close_worker, exitpriority=10)
+
+def close_worker():
+    _sink.close()
+    _sink.metrics.log(prefix=f"Worker {os.getpid()} ")
+
+# Zips and shards the sections are read from, kept open between batches, for every pool reading sections (also the
+# decompression only one, when the stages are split, and the other tools scanning the same sources)
+def init_readers():
+    global _zips, _shards
+
+    _zips = {}
+    _shards = ShardStore()
+    Finalize(None, close_readers, exitpriority=10)
+
+def close_readers():
+    for zip in _zips.values():
+        zip.close()
+    _zips.clear()
+    _shards.close()
+
+def open_section(section: LogSection) -> BinaryIO:
+    if not section.container:
+        return open(section.path, "rb")
+
+    if section.member:
+        with _shards.view_at(section.container, *section.member) as view:
+            return io.BytesIO(view)
+
+    zip = _zips.get(section.container)
+    if not zip:
+        zip = _zips[section.container] = zipfile.ZipFile(section.container, "r")
+
+    return zip.open(section.path)
+
+# Whole contents of the section file, straight from the shard map when sharded (valid until the context exits)
+@contextlib.contextmanager
+def read_section(section: LogSection) -> Iterator[Union[bytes, memoryview]]:
+    if section.member:
+        with _shards.view_at(section.container, *section.member) as view:
+            yield view
+    else:
+        with open_section(section) as file:
+            yield file.read()
+
+def parse_section(section: LogSection, logs: Iterable[tuple[str, BinaryIO]]) -> int:
+    info = PathInfo(os.path.basename(section.path))
+    commonfields = {
+        "plea": info.plea,
+        "state": section.state,
+        "city": info.city,
+        "zone": info.zone,
+        "section": info.section,
+    }
+
+    lines = 0
+    for filename, bio in logs:
+        lines += _sink.write_log_file(_log_processor, commonfields, filename, bio)
+
+    _sink.end_section(section.key, commonfields, os.path.basename(section.path))
+    return lines
+
+def process_section(section: LogSection) -> int:
+    with open_section(section) as file:
+        return parse_section(section, VotingMachineLogProcessor.read_compressed_logs(file, section.key))
+
+class BatchResult(NamedTuple):
+    done: list[str]
+    failed: int
+    lines: int
+    seconds: float      # Worker time spent on the batch
+
+# Without a block the sections are decompressed by the parser worker itself, otherwise they're parsed from the block,
+# which is unlinked afterwards
+def process_batch(sections: list[LogSection], block: SharedLogsBlock = None) -> BatchResult:
+    start_time = time.perf_counter()
+    done = []
+    failed = 0
+    lines = 0
+
+    if block is None:
+        for section in sections:
+            try:
+                lines += process_section(section)
+                done.append(section.key)
+            except Exception as ex:
+                logging.warning("Failed processing %s: %s", section.key, repr(ex))
+                _sink.discard_section()
+                failed += 1
+    else:
+        with SharedLogsReader(block) as reader:
+            logs = {}
+            for member, bio in reader.members():
+                logs.setdefault(member.key, []).append((member.filename, bio))
+
+            try:
+                for section in sections:
+                    try:
+                        lines += parse_section(section, logs.get(section.key, ()))
+                        done.append(section.key)
+                    except Exception as ex:
+                        logging.warning("Failed processing %s: %s", section.key, repr(ex))
+                        _sink.discard_section()
+                        failed += 1
+            finally:
+                # Views into the block must be released before it's closed
+                for section_logs in logs.values():
+                    for _, bio in section_logs:
+                        bio.close()
+
+    # Only report as done what is already on disk
+    _sink.flush()
+    return BatchResult(done, failed, lines, time.perf_counter() - start_time)
+
+class DecompressResult(NamedTuple):
+    block: SharedLogsBlock
+    failed: list[str]
+    seconds: float
+
+def decompress_batch(sections: list[LogSection]) -> DecompressResult:
+    start_time = time.perf_counter()
+    logs = []
+    failed = []
+
+    for section in sections:
+        try:
+            with open_section(section) as file:
+                section_logs = [(section.key, filename, bio.getbuffer()) for filename, bio in
+                                    VotingMachineLogProcessor.read_compressed_logs(file, section.key)]
+            logs.extend(section_logs)
+        except Exception as ex:
+            logging.warning("Failed decompressing %s: %s", section.key, repr(ex))
+            failed.append(section.key)
+
+    block = SharedLogsBlock.pack(logs)
+    return DecompressResult(block, failed, time.perf_counter() - start_time)
+
+def batched(iterable, size, key=None):
+    batch = []
+    batch_key = None
+    for item in iterable:
+        if key:
+            item_key = key(item)
+            if len(batch) > 0 and item_key != batch_key:
+                yield batch
+                batch = []
+            batch_key = item_key
+
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if len(batch) > 0:
+        yield batch
+
+# Runs process_batch on the pool over the batches keeping a bounded amount in flight, each returns a table (plus anything
+# else, passed along to on_result) written to a single parquet file in row groups, under a temporary name until complete
+def write_batch_tables(executor: Executor, process_batch: Callable, batches: Iterable[list[LogSection]], output, schema, *,
+                        queue_depth: int, row_group_size: int, log_interval: float, on_result: Callable, on_log: Callable[[float], None]):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    tmp_path = output + ".tmp"
+
+    with pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+        batches = iter(batches)
+        pending = set()
+        tables = []
+        buffered = 0
+        last_log_time = time.monotonic()
+
+        while True:
+            while len(pending) < queue_depth:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                pending.add(executor.submit(process_batch, batch))
+
+            if len(pending) == 0:
+                break
+
+            completed, pending = wait(pending, timeout=log_interval, return_when=FIRST_COMPLETED)
+            for future in completed:
+                table, *rest = future.result()
+                tables.append(table)
+                buffered += table.num_rows
+                on_result(table, *rest)
+
+            if buffered >= row_group_size:
+                writer.write_table(pa.concat_tables(tables), row_group_size=row_group_size)
+                tables = []
+                buffered = 0
+
+            now = time.monotonic()
+            if now - last_log_time >= log_interval:
+                on_log(now)
+                last_log_time = now
+
+        if len(tables) > 0:
+            writer.write_table(pa.concat_tables(tables), row_group_size=row_group_size)
+
+    os.replace(tmp_path, output)
+
+def main():
+    args = getargs()
+    logging.basicConfig(level=args.loglevel, format="%(asctime)s %(message)s")
+
+    os.makedirs(args.output, exist_ok=True)
+    checkpoint_path = args.checkpoint or os.path.join(args.output, "_checkpoint.txt")
+
+    processed = set() if args.restart else read_checkpoint(checkpoint_path)
+    if len(processed) > 0:
+        logging.info("Resuming, %d sections already processed", len(processed))
+
+    sections = scan_urna_tree(args.urna) if args.urna else scan_zips(args.zips)
+    sections = (s for s in sections if s.key not in processed)
+
+    total_sections = 0
+    total_failed = 0
+    total_lines = 0
+
+    # Busy seconds of each stage, against the wall time and worker count gives the utilization of each pool
+    parse_seconds = 0.0
+    decompress_seconds = 0.0
+    decompressed_bytes = 0
+    shared_bytes = 0
+
+    start_time = time.monotonic()
+    last_log_time = start_time
+    last_sections = 0
+    last_lines = 0
+
+    def log_throughput(now):
+        elapsed = max(now - last_log_time, 1e-6)
+        logging.info("Processed %d sections (%.1f/s), %d lines (%.0f/s), %d failed",
+            total_sections, (total_sections - last_sections) / elapsed,
+            total_lines, (total_lines - last_lines) / elapsed, total_failed)
+
+    def log_stages(now):
+        elapsed = max(now - start_time, 1e-6)
+        if decompressor:
+            logging.info("Stages: decompress %.1f MB (%.1f MB/s), utilization %.0f%% of %d, parse utilization %.0f%% of %d, "
+                "%d batches queued (%.1f MB shared)", decompressed_bytes / 1e6, decompressed_bytes / 1e6 / elapsed,
+                100 * decompress_seconds / elapsed / args.decompress_jobs, args.decompress_jobs,
+                100 * parse_seconds / elapsed / args.jobs, args.jobs, len(decompressing) + len(parsing), shared_bytes / 1e6)
+        else:
+            logging.info("Stages: decompress and parse utilization %.0f%% of %d", 100 * parse_seconds / elapsed / args.jobs, args.jobs)
+
+    decompressor = None
+    if args.decompress_jobs > 0:
+        # Blocks are created by the decompressors and unlinked by the parsers, both must report to the same tracker
+        resource_tracker.ensure_running()
+        decompressor = ProcessPoolExecutor(args.decompress_jobs, initializer=init_readers)
+
+    queue_depth = args.queue_depth or ((args.jobs * 2 + args.decompress_jobs) if decompressor else args.jobs * 4)
+
+    try:
+        with open(checkpoint_path, "w" if args.restart else "a", encoding="utf-8") as checkpoint, \
+                ProcessPoolExecutor(args.jobs, initializer=init_worker, initargs=(args.output, args.format, args.row_group_size)) as executor:
+            # Batches are flushed by the worker as a whole, keeping a single city per batch writes one file per batch on partitioned sinks,
+            # merged per city at the end
+            batch_size = args.batch_size or (64 if args.format == "parquet" else 16)
+            batches = batched(sections, batch_size, get_partition)
+            decompressing = {}
+            parsing = {}
+
+            while True:
+                # Keep a bounded amount of work in flight, the scan is lazy, with split stages it also bounds the shared memory
+                while len(decompressing) + len(parsing) < queue_depth:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+
+                    if decompressor:
+                        decompressing[decompressor.submit(decompress_batch, batch)] = batch
+                    else:
+                        parsing[executor.submit(process_batch, batch)] = 0
+
+                if len(decompressing) + len(parsing) == 0:
+                    break
+
+                completed, _ = wait(decompressing.keys() | parsing.keys(), timeout=args.log_interval, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    if future in decompressing:
+                        batch = decompressing.pop(future)
+                        block, failed, seconds = future.result()
+                        decompress_seconds += seconds
+                        decompressed_bytes += block.size
+                        total_failed += len(failed)
+
+                        failed = set(failed)
+                        parsing[executor.submit(process_batch, [s for s in batch if s.key not in failed], block)] = block.size
+                        shared_bytes += block.size
+                        continue
+
+                    shared_bytes -= parsing.pop(future)
+                    done, failed, lines, seconds = future.result()
+                    checkpoint.writelines(k + "\n" for k in done)
+                    total_sections += len(done)
+                    total_failed += failed
+                    total_lines += lines
+                    parse_seconds += seconds
+
+                checkpoint.flush()
+
+                now = time.monotonic()
+                if now - last_log_time >= args.log_interval:
+                    log_throughput(now)
+                    log_stages(now)
+                    last_log_time, last_sections, last_lines = now, total_sections, total_lines
+    finally:
+        if decompressor:
+            decompressor.shutdown()
+
+    if args.format == "parquet" and not args.no_compact:
+        from tse.common.log_parquet import compact
+        logging.info("Compacting %s...", args.output)
+        compacted = compact(args.output, row_group_size=args.row_group_size)
+        logging.info("Compacted %d files", compacted)
+
+    now = time.monotonic()
+    elapsed = max(now - start_time, 1e-6)
+    logging.info("Finished %d sections (%.1f/s), %d lines (%.0f/s), %d failed in %.0fs",
+        total_sections, total_sections / elapsed, total_lines, total_lines / elapsed, total_failed, elapsed)
+    log_stages(now)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import argparse
+import logging
+import os
+import random
+
+import zstandard
+from scrapy.utils.project import get_project_settings
+
+from tse.common.storage import StorageCodec
+
+# Trains a zstd dictionary per file type from the already downloaded json files, for STORAGE_ZSTD_DICT_DIR
+# Files compressed with a dictionary need it to be read back, so keep the old ones when retraining
+# Ex: python -m tse.utils.train_zstd_dicts -o data/zstd-dicts
+
+def getargs():
+    parser = argparse.ArgumentParser(description="Trains zstd dictionaries per file type for the storage codec")
+    parser.add_argument('-v', '--verbose',
+        action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.INFO,
+        help="Be verbose",
+    )
+
+    parser.add_argument("path", nargs="?", help="Dir to sample from (default: the environment dir of FILES_STORE)")
+    parser.add_argument("-o", "--output", default="data/zstd-dicts", help="Output dir")
+    parser.add_argument("--samples", type=int, default=2000, help="Max files sampled per type")
+    parser.add_argument("--dict-size", type=int, default=112 * 1024, help="Dictionary size in bytes")
+    parser.add_argument("--min-samples", type=int, default=20, help="Types with fewer files are skipped")
+    parser.add_argument("--level", type=int, default=10, help="Compression level for the report")
+
+    return parser.parse_args()
+
+def scan_files(root) -> dict[str, list[str]]:
+    files = {}
+    for path, dirs, filenames in os.walk(root):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+
+        for filename in filenames:
+            local_path = os.path.join(path, StorageCodec.strip_suffix(filename))
+            if os.path.splitext(local_path)[1] != ".json":
+                continue
+
+            file_type = StorageCodec.get_file_type(local_path)
+            if file_type:
+                files.setdefault(file_type, []).append(local_path)
+
+    return files
+
+def main():
+    args = getargs()
+    logging.basicConfig(level=args.loglevel, format="%(asctime)s %(message)s")
+
+    settings = get_project_settings()
+    root = args.path or os.path.join(settings["FILES_STORE"], settings["ENVIRONMENT"])
+    storage = StorageCodec.from_settings(settings)
+
+    os.makedirs(args.output, exist_ok=True)
+
+    for file_type, paths in sorted(scan_files(root).items()):
+        if len(paths) < args.min_samples:
+            logging.info("Skipping type %s, only %d files", file_type, len(paths))
+            continue
+
+        random.shuffle(paths)
+        samples = [storage.read(p) for p in paths[:args.samples]]
+
+        dict_data = zstandard.train_dictionary(args.dict_size, samples, level=args.level)
+        with open(os.path.join(args.output, f"{file_type}.dict"), "wb") as f:
+            f.write(dict_data.as_bytes())
+
+        raw_size = sum(len(s) for s in samples)
+        plain = zstandard.ZstdCompressor(level=args.level)
+        trained = zstandard.ZstdCompressor(level=args.level, dict_data=dict_data)
+        plain_size = sum(len(plain.compress(s)) for s in samples)
+        trained_size = sum(len(trained.compress(s)) for s in samples)
+
+        logging.info("Type %s: %d files, %d sampled (%.1f MB), ratio %.1fx, with dictionary %.1fx (id %d)",
+            file_type, len(paths), len(samples), raw_size / 1e6, raw_size / max(plain_size, 1),
+            raw_size / max(trained_size, 1), dict_data.dict_id())
+
+if __name__ == "__main__":
+    main()
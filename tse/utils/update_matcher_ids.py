@@ -0,0 +1,34 @@
+import argparse
+import logging
+
+from tse.common.grok import GrokProcessor
+from tse.common.voting_machine_files import VotingMachineLogProcessor
+
+# Assigns template ids to the new lines of the log matchers file, run after editing it (the log processor only reads them)
+# Ids are never reused, removed lines keep theirs in the ids file
+# Ex: python -m tse.utils.update_matcher_ids
+
+def getargs():
+    parser = argparse.ArgumentParser(description="Assigns template ids to new log matchers")
+    parser.add_argument('-v', '--verbose',
+        action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.INFO,
+        help="Be verbose",
+    )
+
+    parser.add_argument("--matchers", default=VotingMachineLogProcessor.MATCHERS_FILE, help="Matchers file")
+    parser.add_argument("--ids", default=VotingMachineLogProcessor.MATCHERS_IDS_FILE, help="Ids file")
+
+    return parser.parse_args()
+
+def main():
+    args = getargs()
+    logging.basicConfig(level=args.loglevel, format="%(asctime)s %(message)s")
+
+    added = GrokProcessor.update_ids_file(args.matchers, args.ids)
+    for source in added:
+        logging.debug("New matcher %s", source)
+
+    logging.info("Added %d ids to %s", len(added), args.ids)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from tse.common.pathinfo import PathInfo
+from tse.common.voting_machine_files import VotingMachineLogProcessor
+from tse.common.voting_timeline import VotingTimeline
+from tse.utils.process_logs import (DOWNLOAD_DIR, URNA_DIR, LogSection, batched, init_readers, open_section, scan_urna_tree,
+                                        scan_zips, write_batch_tables)
+
+# Summarizes the voting activity of every section in a single parallel pass over the logs
+# Ex: python -m tse.utils.voting_timeline --zips -o data/voting_timeline.parquet
+
+def getargs():
+    parser = argparse.ArgumentParser(description="Builds the per section voting timeline table from the voting machine logs")
+    parser.add_argument('-v', '--verbose',
+        action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.INFO,
+        help="Be verbose",
+    )
+
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--urna", metavar="DIR", nargs="?", const=URNA_DIR, help=f"Scan the urna spider download tree (default: {URNA_DIR})")
+    source.add_argument("--zips", metavar="DIR", nargs="?", const=DOWNLOAD_DIR, help=f"Scan the dadosabertos transmitted zips (default: {DOWNLOAD_DIR})")
+
+    parser.add_argument("-o", "--output", default="data/voting_timeline.parquet", help="Output parquet file")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--batch-size", type=int, default=64, help="Sections sent to a worker at once")
+    parser.add_argument("--row-group-size", type=int, default=100_000, help="Sections per parquet row group")
+    parser.add_argument("--log-interval", type=float, default=10.0, help="Seconds between progress logs")
+
+    return parser.parse_args()
+
+# Per worker process state, kept warm between batches
+_log_processor: VotingMachineLogProcessor = None
+_timeline: VotingTimeline = None
+
+def init_worker():
+    global _log_processor, _timeline
+
+    init_readers()
+    _log_processor = VotingMachineLogProcessor()
+    _timeline = VotingTimeline(_log_processor.get_templates())
+
+def process_section(section: LogSection):
+    info = PathInfo(os.path.basename(section.path))
+    keyfields = {
+        "state": section.state,
+        "city": info.city,
+        "zone": info.zone,
+        "section": info.section,
+    }
+
+    with open_section(section) as file:
+        logs = [_log_processor.parse_log_columns(bio, filename)
+                    for filename, bio in VotingMachineLogProcessor.read_compressed_logs(file, section.key)]
+
+    _timeline.add_section(keyfields, logs)
+
+def process_batch(sections: list[LogSection]) -> tuple[pa.Table, int]:
+    failed = 0
+    for section in sections:
+        try:
+            process_section(section)
+        except Exception as ex:
+            logging.warning("Failed processing %s: %s", section.key, repr(ex))
+            failed += 1
+
+    return _timeline.to_table(), failed
+
+def main():
+    args = getargs()
+    logging.basicConfig(level=args.loglevel, format="%(asctime)s %(message)s")
+
+    sections = scan_urna_tree(args.urna) if args.urna else scan_zips(args.zips)
+
+    total_sections = 0
+    total_failed = 0
+    total_votes = 0
+    start_time = time.monotonic()
+
+    def on_result(table: pa.Table, failed: int):
+        nonlocal total_sections, total_failed, total_votes
+        total_sections += table.num_rows
+        total_failed += failed
+        total_votes += pc.sum(table["votes"]).as_py() or 0
+
+    def on_log(now):
+        logging.info("Summarized %d sections (%.1f/s), %d votes, %d failed",
+            total_sections, total_sections / (now - start_time), total_votes, total_failed)
+
+    with ProcessPoolExecutor(args.jobs, initializer=init_worker) as executor:
+        write_batch_tables(executor, process_batch, batched(sections, args.batch_size), args.output, VotingTimeline.schema,
+            queue_depth=args.jobs * 4, row_group_size=args.row_group_size, log_interval=args.log_interval,
+            on_result=on_result, on_log=on_log)
+
+    elapsed = max(time.monotonic() - start_time, 1e-6)
+    logging.info("Finished %d sections (%.1f/s), %d votes, %d failed in %.0fs, written to %s",
+        total_sections, total_sections / elapsed, total_votes, total_failed, elapsed, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -75,6 +75,66 @@ def _zipfile_remove_member(self, member):
     fp.seek(self.start_dir)
 
 
+def zipfile_remove_many(self, members):
+    """Remove many files from the archive in a single pass, each kept entry is moved at most once. The archive must be open with mode 'a'"""
+
+    if self.mode != 'a':
+        raise RuntimeError("remove_many() requires mode 'a'")
+    if not self.fp:
+        raise ValueError(
+            "Attempt to write to ZIP archive that was already closed")
+    if self._writing:
+        raise ValueError(
+            "Can't write to ZIP archive while an open writing handle exists."
+        )
+
+    removed = {id(m if isinstance(m, ZipInfo) else self.getinfo(m)) for m in members}
+    if not removed:
+        return
+
+    fp = self.fp
+    entry_offset = 0
+    filelist = sorted(self.filelist, key=attrgetter('header_offset'))
+    for i in range(len(filelist)):
+        info = filelist[i]
+
+        # get the total size of the entry
+        if i == len(filelist) - 1:
+            entry_size = self.start_dir - info.header_offset
+        else:
+            entry_size = filelist[i + 1].header_offset - info.header_offset
+
+        if id(info) in removed:
+            entry_offset += entry_size
+            self.filelist.remove(info)
+            del self.NameToInfo[info.filename]
+            continue
+
+        if entry_offset == 0:
+            continue
+
+        # Move entry
+        fp.seek(info.header_offset)
+        entry_data = fp.read(entry_size)
+
+        info.header_offset -= entry_offset
+
+        fp.seek(info.header_offset)
+        fp.write(entry_data)
+
+    fp.flush()
+
+    # update state
+    self.start_dir -= entry_offset
+    self._didModify = True
+
+    # seek to the start of the central dir
+    fp.seek(self.start_dir)
+
+
 if not hasattr(ZipFile, "remove"):
     setattr(ZipFile, "_zipfile_remove_member", _zipfile_remove_member)
-    setattr(ZipFile, "remove", zipfile_remove)
\ No newline at end of file
+    setattr(ZipFile, "remove", zipfile_remove)
+
+if not hasattr(ZipFile, "remove_many"):
+    setattr(ZipFile, "remove_many", zipfile_remove_many)
\ No newline at end of file